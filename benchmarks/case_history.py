@@ -0,0 +1,84 @@
+"""
+Seeds a database with moderation cases and measures Case.history latency, failing if p99 is over budget.
+
+Queries mix "last N cases in a guild" and "last N cases against a user", both first pages and deep keyset pages.
+
+Usage: python -m benchmarks.case_history [--cases 1000000] [--guilds 100] [--users 5000] [--queries 2000]
+                                         [--max-p99-ms 5]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from chip.database import Database
+from chip.sql import Case
+
+ACTIONS = ("warn", "mute", "kick", "ban", "unban")
+
+
+def seed(path, cases, guilds, users):
+    # Plain sqlite3 with one big transaction - seeding speed isn't what's being measured.
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE cases ({});".format(", ".join(Case.__rows__)))
+    next_case = [0] * guilds
+    now = time.time()
+
+    def rows():
+        for n in range(cases):
+            guild = random.randrange(guilds)
+            next_case[guild] += 1
+            yield (
+                guild, next_case[guild], random.randrange(users), 1, random.choice(ACTIONS), None, now - cases + n
+            )
+
+    connection.executemany("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?);", rows())
+    for index, columns in Case.__indexes__.items():
+        connection.execute("CREATE INDEX {} ON cases ({});".format(index, ", ".join(columns)))
+    connection.commit()
+    connection.execute("ANALYZE;")
+    connection.close()
+
+
+async def measure(path, guilds, users, queries):
+    database = await Database.connect(path)
+    timings = []
+    for n in range(queries):
+        guild = random.randrange(guilds)
+        target = random.randrange(users) if n % 2 else None
+        start = time.perf_counter()
+        page = await Case.history(database, guild, target_id=target)
+        if page and n % 4 < 2:  # Half the queries also fetch the next page.
+            await Case.history(database, guild, target_id=target, before=page[-1])
+        timings.append((time.perf_counter() - start) * 1000)
+    await database.close()
+    timings.sort()
+    return {q: timings[min(len(timings) - 1, int(len(timings) * q / 100))] for q in (50, 95, 99)}
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cases.db")
+        start = time.perf_counter()
+        seed(path, args.cases, args.guilds, args.users)
+        print(f"Seeded {args.cases:,} cases in {time.perf_counter() - start:.1f}s")
+        percentiles = asyncio.run(measure(path, args.guilds, args.users, args.queries))
+
+    print(" ".join(f"p{q}={value:.2f}ms" for q, value in percentiles.items()))
+    if percentiles[99] > args.max_p99_ms:
+        print(f"FAIL: p99 is over the {args.max_p99_ms}ms budget.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--cases", type=int, default=1000000)
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--max-p99-ms", type=float, default=5.0)
+    main(parser.parse_args())
@@ -0,0 +1,63 @@
+"""
+Compares concurrent read throughput of a single aiosqlite connection against chip.database.Database's reader pool.
+
+Usage: python -m benchmarks.db_readers [--rows 10000] [--tasks 64] [--reads 200] [--readers 4]
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import aiosqlite
+
+from chip.database import Database
+from chip.sql import Guild
+
+QUERY = "SELECT prefix FROM guilds WHERE id=?"
+
+
+async def seed(path, rows):
+    database = await Database.connect(path, readers=0)
+    await Guild.create_table(database, name="guilds")
+    values = ((n, "!" if n % 10 == 0 else None) for n in range(rows))
+    await database.write("INSERT INTO guilds (id, prefix) VALUES (?, ?)", values, many=True)
+    await database.close()
+
+
+async def hammer(execute, rows, tasks, reads):
+    async def worker():
+        for _ in range(reads):
+            async with execute(QUERY, (random.randrange(rows),)) as cursor:
+                await cursor.fetchone()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(tasks)))
+    return tasks * reads / (time.perf_counter() - start)
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        await seed(path, args.rows)
+
+        single = await aiosqlite.connect(path)
+        single_rate = await hammer(single.execute, args.rows, args.tasks, args.reads)
+        await single.close()
+
+        pooled = await Database.connect(path, readers=args.readers)
+        pooled_rate = await hammer(pooled.execute, args.rows, args.tasks, args.reads)
+        await pooled.close()
+
+    print(f"single connection: {single_rate:,.0f} reads/s")
+    print(f"{args.readers} readers (WAL):   {pooled_rate:,.0f} reads/s ({pooled_rate / single_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--tasks", type=int, default=64)
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--readers", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,269 @@
+"""
+Replays a synthetic message stream through ChipBot.process_commands, without connecting to Discord, and reports
+throughput and where the time goes.
+
+The bot runs against a temporary SQLite database, with its HTTP client stubbed out (sends "succeed" instantly) and
+its guilds, channels and messages built locally instead of coming from the gateway. The stream mixes chatter (no
+prefix), commands with the default prefix, commands in guilds with a custom prefix and mention-prefixed commands.
+The commands read guild settings and case history, send replies and occasionally write, so the prefix getter, the
+models in chip/sql.py and the database are all on the path.
+
+Reported: messages/sec, per-stage latency (prefix resolution, each query, each command, and the whole message) and,
+with --allocations, memory allocated by a second, traced replay.
+
+Usage: python -m benchmarks.message_replay [--messages 20000] [--guilds 200] [--custom-prefix-ratio 0.3]
+                                           [--command-ratio 0.4] [--concurrency 1] [--allocations]
+                                           [--min-rate 0]
+"""
+import asyncio
+import gc
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+
+import discord
+from discord.ext import commands
+
+from chip.bot import ChipBot
+from chip.metrics import Histogram
+from chip.sql import Case, Guild
+
+BOT_ID = 1000
+CUSTOM_PREFIX = "?"
+COMMANDS = (("ping", 40), ("settings", 30), ("cases", 25), ("touch", 5))
+CHATTER = ("hello", "how is everyone", "lol", "did anyone see the game last night?", "//", "?", "brb", "gg")
+
+_snowflakes = itertools.count(10 ** 17)
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0001", "avatar": None, "bot": bot}
+
+
+def message_payload(channel_id: int, author_id: int, content: str, *, guild: bool = True) -> dict:
+    payload = {
+        "id": str(next(_snowflakes)),
+        "channel_id": str(channel_id),
+        "content": content,
+        "author": user_payload(author_id, bot=author_id == BOT_ID),
+        "attachments": [],
+        "embeds": [],
+        "mentions": [],
+        "mention_roles": [],
+        "mention_everyone": False,
+        "pinned": False,
+        "tts": False,
+        "type": 0,
+        "timestamp": datetime.utcnow().isoformat(),
+        "edited_timestamp": None,
+    }
+    if guild:
+        payload["member"] = {"roles": [], "joined_at": payload["timestamp"], "deaf": False, "mute": False}
+    return payload
+
+
+class ReplayCog(commands.Cog):
+    """Commands shaped like Chip's: a reply, a settings read, a case history read, and an occasional write."""
+
+    def __init__(self, bot: ChipBot):
+        self.bot = bot
+
+    @commands.command()
+    async def ping(self, ctx):
+        await ctx.send("pong")
+
+    @commands.command()
+    async def settings(self, ctx):
+        model = await Guild.get(self.bot.database, ctx.guild.id)
+        await ctx.send(f"prefix: {model.prefix if model else None}")
+
+    @commands.command()
+    async def cases(self, ctx):
+        page = await Case.history(self.bot.database, ctx.guild.id, limit=5)
+        await ctx.send("\n".join(f"#{case.case_id} {case.action}" for case in page) or "no cases")
+
+    @commands.command()
+    async def touch(self, ctx):
+        # Rewrites the guild's prefix with the same value: a write, and a prefix cache invalidation.
+        model = await Guild.get(self.bot.database, ctx.guild.id)
+        if model is not None:
+            await model.edit(["prefix"], [model.prefix])
+        await ctx.send("ok")
+
+
+def build_bot(directory: str) -> ChipBot:
+    with open("template_config.json") as template:
+        config = json.load(template)
+    config["sql"] = os.path.join(directory, "replay.db")
+    config["extensions"] = []
+    config["deferred_extensions"] = []
+    config["logging"] = {"level": "WARNING", "file": os.path.join(directory, "replay.log")}
+    config["cache_policy"]["chunking"] = "never"
+    config["cache"]["models"]["warm"] = False
+    config["metrics"]["prometheus_file"] = None
+    bot = ChipBot(config=config)
+
+    async def request(route, **kwargs):
+        # Anything that posts or edits a message gets a message back. Everything else gets an empty object.
+        if route.path.endswith("/messages") or "/messages/" in route.path:
+            payload = kwargs.get("json") or {}
+            return message_payload(route.channel_id, BOT_ID, payload.get("content") or "", guild=False)
+        return {}
+
+    bot.http.request = request
+    bot._connection.user = discord.ClientUser(state=bot._connection, data=user_payload(BOT_ID, bot=True))
+    bot.add_cog(ReplayCog(bot))
+    return bot
+
+
+async def seed(bot: ChipBot, guilds: int, custom_ratio: float) -> tuple:
+    await bot.prepare()
+    state = bot._connection
+    channels, custom_guilds = [], set()
+    rows, cases = [], []
+    for n in range(guilds):
+        guild_id = 2000 + n
+        guild = discord.Guild(data={"id": str(guild_id), "name": f"guild {n}", "member_count": 100}, state=state)
+        channel = discord.TextChannel(
+            state=state, guild=guild, data={"id": str(900000 + n), "type": 0, "name": "general", "position": 0}
+        )
+        guild._add_channel(channel)
+        state._add_guild(guild)
+        channels.append(channel)
+        custom = random.random() < custom_ratio
+        if custom:
+            custom_guilds.add(guild_id)
+        if custom or random.random() < 0.5:  # Some guilds have settings without a custom prefix.
+            rows.append({"id": guild_id, "prefix": CUSTOM_PREFIX if custom else None})
+        for case_id in range(1, 21):
+            cases.append({"guild_id": guild_id, "case_id": case_id, "target_id": random.randrange(500),
+                          "moderator_id": 1, "action": "warn", "reason": None, "created_at": time.time()})
+    await Guild.create_many(bot.database, rows, durable=True)
+    await Case.create_many(bot.database, cases, durable=True)
+    # Start cold, like a freshly started bot.
+    Guild._identity.clear()
+    Case._identity.clear()
+    bot.prefix_cache.clear()
+    return channels, custom_guilds
+
+
+def build_stream(channels: list, custom_guilds: set, messages: int, command_ratio: float) -> list:
+    state = channels[0]._state
+    names = [name for name, weight in COMMANDS for _ in range(weight)]
+    stream = []
+    for _ in range(messages):
+        channel = random.choice(channels)
+        if random.random() < command_ratio:
+            name = random.choice(names)
+            if random.random() < 0.1:
+                content = f"<@{BOT_ID}> {name}"
+            else:
+                content = (CUSTOM_PREFIX if channel.guild.id in custom_guilds else "//") + name
+        else:
+            content = random.choice(CHATTER)
+        data = message_payload(channel.id, random.randrange(3000, 8000), content)
+        stream.append(discord.Message(state=state, channel=channel, data=data))
+    return stream
+
+
+async def replay(bot: ChipBot, stream: list, concurrency: int) -> Histogram:
+    latencies = Histogram(len(stream))
+
+    async def one(message):
+        start = time.perf_counter()
+        await bot.process_commands(message)
+        latencies.observe(time.perf_counter() - start)
+
+    for index in range(0, len(stream), concurrency):
+        await asyncio.gather(*(one(message) for message in stream[index:index + concurrency]))
+    await bot.database.flush()
+    return latencies
+
+
+def time_prefixes(bot: ChipBot) -> Histogram:
+    histogram = Histogram(1 << 20)
+    getter = bot.command_prefix
+
+    async def timed(bot, message):
+        start = time.perf_counter()
+        try:
+            return await getter(bot, message)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    bot.command_prefix = timed
+    return histogram
+
+
+def row(name: str, histogram: Histogram) -> str:
+    p50, p95, p99 = (value * 1000 for value in histogram.percentiles(50, 95, 99))
+    return f"{name[:48]:<48} {histogram.count:>8} {p50:>9.3f} {p95:>9.3f} {p99:>9.3f} {histogram.max * 1000:>9.3f}"
+
+
+def report(bot: ChipBot, prefixes: Histogram, latencies: Histogram, elapsed: float, messages: int):
+    print(f"{messages:,} messages in {elapsed:.2f}s: {messages / elapsed:,.0f} msgs/sec")
+    print(f"{'stage':<48} {'count':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print(row("message (process_commands)", latencies))
+    print(row("prefix resolution", prefixes))
+    for name, histogram in sorted(bot.metrics.commands.items()):
+        print(row("command: " + name, histogram))
+    for name, histogram in sorted(bot.metrics.queries.items(), key=lambda item: -item[1].total):
+        print(row("query: " + name, histogram))
+    print(f"prefix cache: {bot.prefix_cache.stats}")
+    print(f"guild models: {Guild._identity.stats}")
+
+
+def main(args):
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        bot = build_bot(directory)
+        loop = bot.loop
+        channels, custom_guilds = loop.run_until_complete(seed(bot, args.guilds, args.custom_prefix_ratio))
+        stream = build_stream(channels, custom_guilds, args.messages, args.command_ratio)
+        prefixes = time_prefixes(bot)
+        bot.metrics.queries.clear()  # Forget the setup and seeding queries.
+
+        collections = sum(generation["collections"] for generation in gc.get_stats())
+        start = time.perf_counter()
+        latencies = loop.run_until_complete(replay(bot, stream, args.concurrency))
+        elapsed = time.perf_counter() - start
+        collections = sum(generation["collections"] for generation in gc.get_stats()) - collections
+        report(bot, prefixes, latencies, elapsed, len(stream))
+        print(f"gc collections during replay: {collections}")
+
+        if args.allocations:
+            # A second pass, with the caches now warm. Tracing is slow, so timings from this pass aren't reported.
+            tracemalloc.start()
+            loop.run_until_complete(replay(bot, stream, args.concurrency))
+            retained, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+            tracemalloc.stop()
+            print(f"allocations: peak {peak / 1024:,.0f} KiB, {retained / len(stream):,.0f} B/msg still allocated")
+            for statistic in top:
+                print(f"  {statistic}")
+
+        loop.run_until_complete(bot.close())
+
+    if args.min_rate and len(stream) / elapsed < args.min_rate:
+        print(f"FAIL: throughput is under {args.min_rate:,.0f} msgs/sec.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--custom-prefix-ratio", type=float, default=0.3)
+    parser.add_argument("--command-ratio", type=float, default=0.4)
+    parser.add_argument("--concurrency", type=int, default=1, help="How many messages to process at once.")
+    parser.add_argument("--allocations", action="store_true", help="Also trace allocations, in a second pass.")
+    parser.add_argument("--min-rate", type=float, default=0, help="Fail if msgs/sec is lower than this.")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
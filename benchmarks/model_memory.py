@@ -0,0 +1,56 @@
+"""
+Measures the memory used by resident Guild models with tracemalloc, comparing the old dict-backed layout against the
+current slot/tuple-backed one.
+
+Usage: python -m benchmarks.model_memory [--count 100000]
+"""
+import tracemalloc
+from argparse import ArgumentParser
+
+from chip.sql import Guild
+
+
+class LegacyGuild:
+    """The previous layout: a __dict__ per instance, holding a _state and a per-row _data dict."""
+
+    def __init__(self, data: dict, *, state):
+        object.__setattr__(self, "_state", state)
+        object.__setattr__(self, "_data", data)
+
+    def __getattr__(self, item):
+        try:
+            return self._data[item]
+        except KeyError:
+            raise AttributeError(item)
+
+
+def rows(count):
+    # Fresh ints past the small-int cache, like real snowflakes would be.
+    return [(10 ** 17 + n, "!" if n % 10 == 0 else None, None, None, n % 50) for n in range(count)]
+
+
+def measure(build, count):
+    data = rows(count)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    models = build(data)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    assert len(models) == count
+    return size
+
+
+def main(count):
+    legacy = measure(lambda data: [LegacyGuild(dict(zip(Guild.__columns__, row)), state=None) for row in data], count)
+    # list(row) so the row tuple is allocated inside the measurement, as the dicts are for the legacy layout.
+    compact = measure(lambda data: [Guild._from_row(list(row), None) for row in data], count)
+    print(f"{count:,} guilds")
+    print(f"dict-backed:  {legacy / 2 ** 20:7.2f} MiB ({legacy / count:.0f} B/row)")
+    print(f"slot-backed:  {compact / 2 ** 20:7.2f} MiB ({compact / count:.0f} B/row, {legacy / compact:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000)
+    main(parser.parse_args().count)
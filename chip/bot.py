@@ -1,36 +1,70 @@
+import asyncio
 import json
 import logging
 import sys
 import pathlib
+import time
 import traceback
 from os import path
 
-from .sql import Guild
+from .cases import CaseAllocator
+from .cooldowns import CooldownStore
+from .database import Database
+from .executors import ExecutorService
+from .logs import setup_logging
+from .maintenance import TASKS, MaintenanceService
+from .messages import MessageCache
+from .metrics import Metrics, write_atomically
+from .modlog import ModLogDispatcher
+from .monitor import LoopMonitor
+from .profiling import StartupProfile
+from .reloader import ExtensionReloader
+from .reports import render_tables
+from .stats import StatsService
+from .prefix import PrefixResolver
+from .sql import Case, Guild, GuildPrefix
+from .web import WebClient
 
-import aiosqlite
 import discord
 from discord.ext import commands
-from tabulate import tabulate
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)  # For verbose output, set INFO to DEBUG, or set it to WARNING for just warnings.
-handler = logging.FileHandler(filename="chip.log", encoding="utf-8", mode="a")
-handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s"))
-logger.addHandler(handler)
+logger = logging.getLogger(__name__)  # Handlers and the level are set up from the config, by chip.logs.
 
 
-def get_prefix_getter(default_prefix):
-    async def _fetch_prefix(bot, message):
-        if not message.guild:
-            return default_prefix
-        async with bot.db.execute("SELECT prefix FROM guilds WHERE id=?", (message.guild.id,)) as cursor:
-            _prefix = await cursor.fetchone() or "//"
-            logger.debug("Got prefix '{}' for guild '{}'.".format(_prefix, message.guild.id))
-            _resolved_prefix = _prefix
-        if bot.config["prefix"]["mention"]:
-            return commands.when_mentioned_or(_resolved_prefix)
-        return _resolved_prefix
-    return _fetch_prefix
+def build_intents(overrides: dict) -> discord.Intents:
+    """
+    Builds the gateway intents from the config's cache_policy.intents section.
+
+    :param overrides: Intent name -> whether to enable it. Anything not mentioned is enabled.
+    :return: discord.Intents
+    :raises ValueError: If an intent name isn't valid.
+    """
+    unknown = set(overrides) - set(discord.Intents.VALID_FLAGS)
+    if unknown:
+        raise ValueError("Unknown intent(s) in cache_policy: " + ", ".join(sorted(unknown)))
+    intents = discord.Intents.all()
+    for name, enabled in overrides.items():
+        setattr(intents, name, bool(enabled))
+    return intents
+
+
+def build_member_cache_flags(overrides: dict, intents: discord.Intents) -> discord.MemberCacheFlags:
+    """
+    Builds the member cache flags from the config's cache_policy.member_cache_flags section.
+
+    :param overrides: Flag name (online, voice or joined) -> whether to enable it. Anything not mentioned is whatever
+        the intents allow.
+    :param intents: The intents the bot will connect with.
+    :return: discord.MemberCacheFlags
+    :raises ValueError: If a flag name isn't valid.
+    """
+    unknown = set(overrides) - set(discord.MemberCacheFlags.VALID_FLAGS)
+    if unknown:
+        raise ValueError("Unknown member cache flag(s) in cache_policy: " + ", ".join(sorted(unknown)))
+    flags = discord.MemberCacheFlags.from_intents(intents)
+    for name, enabled in overrides.items():
+        setattr(flags, name, bool(enabled))
+    return flags
 
 
 class ChipBot(commands.Bot):
@@ -38,27 +72,68 @@ class ChipBot(commands.Bot):
     Chip's custom subclass of commands.Bot with a few extra useful features.
     """
 
-    def __init__(self):
+    def __init__(self, *, config: dict = None, cluster_id: int = None, startup: StartupProfile = None,
+                 print_startup_profile: bool = False, **options):
+        """
+        Nothing slow happens here - connecting to the database and loading extensions is done by prepare(), which
+        start() calls for you.
+
+        :param config: Optional[dict] - The configuration. Defaults to loading ./config.json.
+        :param cluster_id: Optional[int] - Which cluster this is, when running as several (see chip.cluster).
+        :param startup: Optional[StartupProfile] - A profile to keep marking, e.g. one started before imports.
+        :param print_startup_profile: Whether to print the startup profile once the bot is ready.
+        :param options: Passed to commands.Bot.
+        """
         self.__version__ = "0.1.0a"
-        logger.debug(f"Began initialising ChipBot v{self.__version__}.")
-        if not path.exists("./config.json"):
-            print("There is no configuration file. Please run `python3 main.py --setup`.")
-            sys.exit(4)
-
-        with open("./config.json") as config_raw:
-            self.config = json.load(config_raw)
-            safe_config = self.config.copy()
-            safe_config["tokens"] = "[expunged]"
-            logger.debug(f"Loaded configuration: {safe_config}")
-
-        if self.config["prefix"]["mention"]:
-            default_prefix = commands.when_mentioned_or(*self.config["prefix"]["set"])
-        else:
-            default_prefix = self.config["prefix"]["set"]
-        logger.debug("Set default prefix to: " + str(default_prefix))
+        self.startup = startup or StartupProfile()
+        self.print_startup_profile = print_startup_profile
+        self.cluster_id = cluster_id
+        self.ipc = None  # An IPCClient, set by the cluster launcher.
+        self._closing = None  # The task closing the bot, once something has asked it to.
+        if config is None:
+            if not path.exists("./config.json"):
+                print("There is no configuration file. Please run `python3 main.py --setup`.")
+                sys.exit(4)
+
+            with open("./config.json") as config_raw:
+                config = json.load(config_raw)
+        self.config = config
+        safe_config = self.config.copy()
+        safe_config["tokens"] = "[expunged]"
+        self._log_listener = setup_logging(self.config.get("logging", {}))
+        logger.debug("Began initialising ChipBot v%s.", self.__version__)
+        logger.debug("Loaded configuration: %s", safe_config)
+        self.startup.mark("config")
+
+        prefix_config = self.config["prefix"]
+        cache_config = self.config.get("cache", {})
+        prefix_cache_config = cache_config.get("prefix", {})
+        self.prefixes = PrefixResolver(
+            self,
+            prefix_config["set"],
+            mention=prefix_config["mention"],
+            custom=prefix_config.get("custom", True),
+            keep_defaults=prefix_config.get("keep_defaults", False),
+            max_size=prefix_cache_config.get("max_size", 10000),
+            ttl=prefix_cache_config.get("ttl", 3600),
+        )
+        self.prefix_cache = self.prefixes.cache  # guild ID -> PrefixMatcher
+        logger.debug("Set default prefixes to: %s", self.prefixes.defaults)
+        self._warm_models = cache_config.get("models", {}).get("warm", False)
+        Guild.set_cache_size(cache_config.get("models", {}).get("max_size", 10000))
+
+        policy = self.config.get("cache_policy", {})
+        intents = build_intents(policy.get("intents", {}))
+        # "startup" chunks every guild before on_ready, "lazy" chunks a guild the first time a command is used in it and
+        # "never" only caches members as they're seen. Chunking needs the members intent.
+        self.chunking = policy.get("chunking", "startup") if intents.members else "never"
+        if self.chunking not in ("startup", "lazy", "never"):
+            raise ValueError("cache_policy.chunking must be one of startup, lazy or never.")
+        self._chunking = set()  # IDs of guilds being chunked right now
+        logger.debug("Using intents %s, chunking %s.", intents, self.chunking)
 
         super().__init__(
-            get_prefix_getter(default_prefix),
+            self.prefixes.get_prefix,
             description="Chip - A multi-purpose, open-source, easy to use and powerful moderation bot.",
             case_insensitive=True,
             owner_ids=self.config["owners"] or None,
@@ -66,10 +141,102 @@ class ChipBot(commands.Bot):
             activity=discord.Activity(name=f"gears turn...", type=discord.ActivityType.watching),
             status=discord.Status.dnd,
             max_messages=self.config["control"]["max_messages"],
-            intents=discord.Intents.all(),
+            intents=intents,
+            member_cache_flags=build_member_cache_flags(policy.get("member_cache_flags", {}), intents),
+            chunk_guilds_at_startup=self.chunking == "startup",
             allowed_mentions=discord.AllowedMentions(**self.config["allowed_mentions"]),
+            **options
         )
 
+        self.database = None  # Set by prepare()
+        self.db = None  # The writer connection. Kept for backwards compatibility.
+        self.cases = None  # Set by prepare()
+        metrics_config = self.config.get("metrics", {})
+        self.metrics = Metrics(samples=metrics_config.get("samples", 1024))
+        executor_config = self.config.get("executors", {})
+        self.executors = ExecutorService(
+            executor_config.get("pools"),
+            processes=executor_config.get("processes", 2),
+            process_queue=executor_config.get("process_queue", 8),
+            samples=metrics_config.get("samples", 1024),
+        )
+        for pool in self.executors.pools.values():
+            self.metrics.add_gauge(f"chip_executor_{pool.name}_busy", lambda pool=pool: pool.busy)
+            self.metrics.add_gauge(f"chip_executor_{pool.name}_queued", lambda pool=pool: pool.queued + pool.waiting)
+        self._metrics_task = None
+        github_config = self.config.get("github", {})
+        self.web = WebClient(ttl=github_config.get("ttl", 3600), user_agent=f"ChipBot/{self.__version__}")
+        monitor_config = self.config.get("monitor", {})
+        self.monitor = LoopMonitor(
+            interval=monitor_config.get("interval", 0.5),
+            threshold=monitor_config.get("threshold", 0.1),
+            trace=monitor_config.get("trace", False),
+            keep=monitor_config.get("keep", 20),
+        )
+        self.monitor.start(self.loop)
+        stats_config = self.config.get("stats", {})
+        self.stats = StatsService(self, reconcile_every=stats_config.get("reconcile_every", 600))
+        self.stats.start()
+        message_config = self.config.get("message_cache", {})
+        # The moderation message cache, bounded by memory. discord.py's own (max_messages) only needs to be big enough
+        # for wait_for and reaction menus.
+        self.messages = MessageCache(
+            message_config.get("max_bytes", 64 * 1024 * 1024), ignore_bots=message_config.get("ignore_bots", True)
+        )
+        if message_config.get("enabled", True):
+            self.messages.listen(self)
+        cooldown_config = self.config.get("cooldowns", {})
+        self.cooldowns = CooldownStore(overrides=cooldown_config.get("overrides"))
+        # Shared cooldowns are enforced by the bot's own before-invoke hook, which then runs the one set with
+        # before_invoke() (if any) - so setting that hook can't turn cooldowns off.
+        self._extra_before_invoke = None
+        self._before_invoke = self._run_before_invoke
+        maintenance_config = self.config.get("maintenance", {})
+        self.maintenance = MaintenanceService(
+            self,
+            tick=maintenance_config.get("tick", 60),
+            quiet_events=maintenance_config.get("quiet_events", 20),
+            overdue=maintenance_config.get("overdue", 3),
+            pages=maintenance_config.get("vacuum_pages", 1000),
+            checkpoint_mode=maintenance_config.get("checkpoint_mode", "PASSIVE"),
+            analysis_limit=maintenance_config.get("analysis_limit", 1000),
+            cadences={task: maintenance_config.get(key, default) for task, (_, key, default) in TASKS.items()},
+        )
+        self.maintenance.add_sweeper("cooldowns", self.cooldowns.sweep)
+        if maintenance_config.get("enabled", True):
+            self.maintenance.start()
+        modlog_config = self.config.get("modlog", {})
+        self.modlog = ModLogDispatcher(
+            self,
+            window=modlog_config.get("window", 1.0),
+            max_queue=modlog_config.get("max_queue", 1000),
+            burst=modlog_config.get("burst", 5),
+            per=modlog_config.get("per", 5.0),
+            retries=modlog_config.get("retries", 5),
+        )
+        if modlog_config.get("message_events", False):
+            self.modlog.listen(self)
+        reload_config = self.config.get("reload", {})
+        self.reloader = ExtensionReloader(self, interval=reload_config.get("interval", 1.0))
+        if reload_config.get("watch", False):
+            self.reloader.start_watching()
+        for name in ("guilds", "channels", "members", "users", "emojis"):
+            self.metrics.add_gauge(f"chip_{name}", lambda name=name: getattr(self.stats.snapshot(), name))
+        self.metrics.add_gauge("chip_modlog_depth", lambda: self.modlog.depth)
+        self.metrics.add_gauge("chip_cooldown_buckets", lambda: len(self.cooldowns))
+        if metrics_config.get("prometheus_file"):
+            self._metrics_task = self.loop.create_task(
+                self._dump_metrics(metrics_config["prometheus_file"], metrics_config.get("interval", 15))
+            )
+        Guild.add_listener(self._on_guild_change)
+        GuildPrefix.add_listener(self._on_guild_prefix_change)
+        # Extensions that aren't needed to handle the first commands (e.g. jishaku) are loaded after on_ready.
+        self._deferred_extensions = list(self.config.get("deferred_extensions", []))
+        logger.debug("ChipBot initialised.")
+        self.event(self.on_ready)  # This is basically the @bot.event decor, just called internally.
+        self.startup.mark("client")
+
+    async def _connect_database(self):
         logger.debug("Connecting to database...")
         if not self.config["sql"]:
             logger.debug("No SQL directory specified. Using ./main.db")
@@ -77,40 +244,240 @@ class ChipBot(commands.Bot):
 
         logger.debug("Resolving path...")
         _path = pathlib.Path(self.config["sql"])
-        logger.debug("Resolved path - " + str(_path))
-        self.db = self.loop.run_until_complete(aiosqlite.connect(str(_path)))
-        self.loop.run_until_complete(Guild.create_table(self.db, name="guilds"))
+        logger.debug("Resolved path - %s", _path)
+        database_config = self.config.get("database", {})
+        database = await Database.connect(
+            str(_path),
+            readers=database_config.get("readers", 4),
+            pragmas=database_config.get("pragmas"),
+            flush_interval=database_config.get("flush_interval", 0.05),
+            max_batch=database_config.get("max_batch", 100),
+        )
+        database.metrics = self.metrics
+        await Guild.create_table(database, name="guilds")
+        await GuildPrefix.create_table(database)
+        await Case.create_table(database)
+        self.database = database
+        self.db = database.connection
+        self.cases = CaseAllocator(database, block_size=self.config.get("cases", {}).get("block_size", 50))
         logger.debug("Connected to database.")
 
-        # cogs = [
-        #     "jishaku",  # debugging
-        #     "chip.cogs.meta",  # meta cog
-        # ]
-        cogs = self.config["extensions"]
-        for extension in cogs:
+    def _load_extensions(self, extensions):
+        for extension in extensions:
             try:
                 self.load_extension(extension)
-                logger.debug(f"Loaded extension {extension}.")
+                logger.debug("Loaded extension %s.", extension)
             except Exception as e:
-                logger.warning(f"Failed to load extension {extension}.", exc_info=e)
-        logger.debug("ChipBot initialised.")
-        self.event(self.on_ready)  # This is basically the @bot.event decor, just called internally.
+                logger.warning("Failed to load extension %s.", extension, exc_info=e)
+            yield extension
+
+    async def prepare(self):
+        """
+        Connects to the database and loads the (non-deferred) extensions, overlapping the two.
+
+        The database's connections do their work on their own threads, so between importing each extension we yield
+        to the loop to let the database setup move on.
+        """
+        if self.database is not None:
+            return
+        database_task = self.loop.create_task(self._connect_database())
+        for _ in self._load_extensions(self.config["extensions"]):
+            await asyncio.sleep(0)
+        self.startup.mark("extensions")
+        await database_task
+        self.startup.mark("database (after extensions)")
+
+    async def start(self, *args, **kwargs):
+        await self.prepare()
+        try:
+            await super().start(*args, **kwargs)
+        finally:
+            # The gateway connection stops early in close(). Don't return (and let the loop be torn down) until the
+            # rest of it - flushing the database, stopping the executors - is done too.
+            await self.close()
+
+    async def login(self, *args, **kwargs):
+        await super().login(*args, **kwargs)
+        self.startup.mark("login")
+
+    def before_invoke(self, coro):
+        """
+        Registers a coroutine to run before every command, as in discord.py. It runs after the command's shared
+        cooldown has been checked, and replaces any hook registered before.
+
+        :param coro: The coroutine function, taking the invocation's Context.
+        :return: coro, so this works as a decorator.
+        """
+        if not asyncio.iscoroutinefunction(coro):
+            raise TypeError("The pre-invoke hook must be a coroutine.")
+        self._extra_before_invoke = coro
+        return coro
+
+    async def _run_before_invoke(self, ctx: commands.Context):
+        await self.cooldowns.before_invoke(ctx)
+        if self._extra_before_invoke is not None:
+            await self._extra_before_invoke(ctx)
 
     async def on_ready(self):
+        if self._deferred_extensions:
+            self.startup.mark("gateway ready")
+            deferred, self._deferred_extensions = self._deferred_extensions, []
+            for _ in self._load_extensions(deferred):
+                await asyncio.sleep(0)
+            self.startup.mark("deferred extensions")
+        if self._warm_models:
+            self._warm_models = False  # on_ready fires again on reconnects. Once is enough.
+            await self.warm_caches()
+            self.startup.mark("cache warm-up")
+        if self.print_startup_profile:
+            self.print_startup_profile = False
+            print(self.startup.report())
+
+        snapshot = self.stats.snapshot()
         tabulatable = {
             "Bot Name": [self.user.name],
-            "Guilds": [len(self.guilds)],
-            "Channels": [len(tuple(self.get_all_channels()))],
-            "Users": [len(self.users)],
-            "Emojis": [len(self.emojis)]
+            "Guilds": [snapshot.guilds],
+            "Channels": [snapshot.channels],
+            "Members": [snapshot.members],
+            "Emojis": [snapshot.emojis]
         }
-        table = tabulate(
-            tabulatable,
-            headers="keys",
-            tablefmt="pretty",
-        )
+        # In a thread rather than the CPU pool: one small table isn't worth starting processes for during startup.
+        table, = await self.executors.run(render_tables, [(tabulatable, "keys", {})], pool="render")
         print(table)
 
+    async def warm_caches(self):
+        """
+        Loads the rows for every guild the bot is in, in bulk, so the first message in each guild is a cache hit.
+        """
+        guild_ids = [guild.id for guild in self.guilds]
+        found = await Guild.get_many(self.database, guild_ids)
+        await self.prefixes.warm(guild_ids)
+        logger.debug("Warmed caches for %d guilds (%d with settings).", len(guild_ids), len(found))
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        Guild.evict(guild.id)
+        self.prefixes.invalidate(guild.id)
+
+    def request_chunk(self, guild: discord.Guild) -> None:
+        """
+        Starts chunking (fetching every member of) a guild in the background, unless it's chunked or being chunked.
+
+        :param guild: The guild to chunk
+        :return: None
+        """
+        if guild.chunked or guild.id in self._chunking:
+            return
+        self._chunking.add(guild.id)
+        task = self.loop.create_task(guild.chunk())
+        task.add_done_callback(lambda t: self._chunk_done(guild.id, t))
+
+    def _chunk_done(self, guild_id: int, task: asyncio.Task):
+        self._chunking.discard(guild_id)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to chunk guild %s.", guild_id, exc_info=task.exception())
+        else:
+            logger.debug("Chunked guild %s.", guild_id)
+
+    async def invoke(self, ctx):
+        if self.chunking == "lazy" and ctx.guild is not None:
+            self.request_chunk(ctx.guild)
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            if ctx.command is not None:
+                self.metrics.time_command(ctx.command.qualified_name, time.perf_counter() - start)
+
+    def dispatch(self, event_name, *args, **kwargs):
+        self.metrics.count_event(event_name)
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def _dump_metrics(self, file: str, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Render on the loop, which is what mutates the metrics; only the file write goes to a thread.
+                text = self.metrics.render_prometheus()
+                await self.executors.run(write_atomically, file, text)
+            except Exception as e:  # A bad gauge or a full disk shouldn't stop the next dump.
+                logger.warning("Failed to write metrics to %s.", file, exc_info=e)
+
+    async def close(self):
+        # The shutdown command, the cluster launcher and start() can all close the bot. Later calls wait for the first.
+        if self._closing is None:
+            self._closing = self.loop.create_task(self._close())
+        await asyncio.shield(self._closing)
+
+    async def _close(self):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+        self.monitor.stop()
+        self.stats.stop()
+        self.maintenance.stop()
+        self.reloader.stop_watching()
+        await self.modlog.close()  # While the HTTP client is still open.
+        await super().close()
+        await self.web.close()
+        if self.database is not None:
+            logger.debug("Flushing pending database writes...")
+            await self.cases.close()
+            await self.database.close()
+        if self.ipc is not None:
+            await self.ipc.close()
+        self.executors.shutdown()
+        self._log_listener.stop()
+
+    def load_extension(self, name):
+        super().load_extension(name)
+        self.reloader.loaded(name)
+
+    def unload_extension(self, name):
+        super().unload_extension(name)
+        self.reloader.forget(name)
+
+    async def reload_extensions(self, extensions: list = None, *, changed: bool = False) -> dict:
+        """
+        Reloads extensions, carrying on past any that fail.
+
+        :param extensions: Optional[list] - The extensions to reload. Defaults to every loaded extension.
+        :param changed: Instead, reload only the extensions whose source changed, and their dependents.
+        :return: dict - extension -> {"seconds", "error" (None if it reloaded), "reason"}
+        """
+        if changed:
+            results = await self.reloader.reload_changed()
+        else:
+            results = await self.reloader.reload(list(extensions or self.extensions))
+        return {result.extension: result.to_dict() for result in results}
+
+    def cluster_stats(self) -> dict:
+        """
+        A summary of this bot (or cluster), small enough to send over IPC.
+
+        :return: dict
+        """
+        if isinstance(self, commands.AutoShardedBot):
+            shards = sorted(self.shard_ids or self.shards)
+        else:
+            shards = [self.shard_id or 0]
+        snapshot = self.stats.snapshot()
+        return {
+            "cluster": self.cluster_id,
+            "shards": shards,
+            "guilds": snapshot.guilds,
+            "users": snapshot.users,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency == self.latency else None,  # NaN: no shards
+            "commands": sum(histogram.count for histogram in self.metrics.commands.values()),
+            "events": sum(self.metrics.events.values()),
+            "loop_lag_p99_ms": round(self.monitor.lag.percentiles(99)[0] * 1000, 1),
+        }
+
+    def _on_guild_change(self, guild_id: int, keys):
+        if keys is None or "prefix" in keys:
+            self.prefixes.invalidate(guild_id)
+
+    def _on_guild_prefix_change(self, key: tuple, keys):
+        self.prefixes.invalidate(key[0])
+
     async def on_error(self, event_method, *args, **kwargs):
         print('Ignoring exception in {}'.format(event_method), file=sys.stderr)
         traceback.print_exc()
@@ -119,3 +486,10 @@ class ChipBot(commands.Bot):
             *args,
             **kwargs
         )
+
+
+class ShardedChipBot(ChipBot, commands.AutoShardedBot):
+    """
+    ChipBot, running several shards in one process. Pass shard_ids and shard_count to run a subset of them, as the
+    cluster launcher does.
+    """
@@ -0,0 +1,129 @@
+# In-memory caches
+import time
+from collections import OrderedDict
+
+MISSING = object()  # Sentinel, since None is a perfectly valid (negative) cached value.
+
+
+class LRUCache:
+    """
+    A bounded mapping with least-recently-used eviction and an optional time-to-live.
+
+    Lookups and stores are O(1). Hit and miss counters are kept so callers can check that a hot path is actually
+    being served from memory.
+    """
+
+    __slots__ = ("max_size", "ttl", "hits", "misses", "_data")
+
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        """
+        :param max_size: The maximum number of entries to hold before the least recently used one is evicted.
+        :param ttl: Optional[float] - How many seconds an entry stays valid for. None means entries never expire.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        """
+        Fetches an entry, counting it as a hit or a miss.
+
+        :param key: The key to look up
+        :param default: What to return if the key is not cached (or has expired). Defaults to MISSING.
+        :return: The cached value, or default.
+        """
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=MISSING):
+        """
+        Fetches an entry without counting it or marking it as recently used.
+
+        :param key: The key to look up
+        :param default: What to return if the key is not cached (or has expired). Defaults to MISSING.
+        :return: The cached value, or default.
+        """
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= time.monotonic():
+            return default
+        return value
+
+    def set(self, key, value) -> None:
+        """
+        Stores an entry, evicting the least recently used one if the cache is full.
+
+        :param key: The key to store under
+        :param value: The value to store. May be None.
+        :return: None
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """Drops an entry, if it is cached."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drops every entry. Counters are left alone."""
+        self._data.clear()
+
+    def sweep(self) -> int:
+        """
+        Removes every expired entry.
+
+        :return: int - how many entries were removed
+        """
+        if self.ttl is None:
+            return 0
+        now = time.monotonic()
+        expired = [key for key, (_, expires) in self._data.items() if expires <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    @property
+    def stats(self) -> dict:
+        """
+        The cache's counters.
+
+        :return: dict - hits, misses, hit rate and size
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._data),
+            "max_size": self.max_size,
+        }
+
+    def __contains__(self, key):
+        # Doesn't touch the counters or the recency order.
+        try:
+            _, expires = self._data[key]
+        except KeyError:
+            return False
+        return expires is None or expires > time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
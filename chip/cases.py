@@ -0,0 +1,92 @@
+# Case numbering
+import asyncio
+import logging
+import weakref
+
+from .database import Database
+from .sql import Guild
+
+logger = logging.getLogger(__name__)
+
+RESERVE = """
+INSERT INTO guilds (id, case_id) VALUES (?, ?)
+ON CONFLICT(id) DO UPDATE SET case_id=COALESCE(case_id, 0) + ?;
+"""
+HIGH_WATER = "SELECT case_id FROM guilds WHERE id=?;"
+RELEASE = "UPDATE guilds SET case_id=? WHERE id=? AND case_id=?;"
+
+
+class CaseAllocator:
+    """
+    Hands out per-guild case numbers without a database round-trip per case.
+
+    Numbers are reserved from guilds.case_id in blocks, in a single write per block, and then handed out from memory.
+    guilds.case_id always holds the highest number reserved so far, so a crash can only leave gaps - never reuse a
+    number. On close, unused numbers are handed back where nothing else has reserved past them.
+    """
+
+    def __init__(self, database: Database, *, block_size: int = 50):
+        """
+        :param database: The database to reserve blocks in.
+        :param block_size: How many case numbers to reserve at once.
+        """
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1.")
+        self.database = database
+        self.block_size = block_size
+        self.reservations = 0
+        self._blocks = {}  # guild id: [next number, highest reserved number]
+        self._locks = weakref.WeakValueDictionary()  # Only alive while a guild is reserving, so this never piles up.
+
+    async def next(self, guild_id: int) -> int:
+        """
+        Allocates the next case number for a guild.
+
+        :param guild_id: The guild to allocate for
+        :return: int - the case number
+        """
+        block = self._blocks.get(guild_id)
+        if block is None or block[0] > block[1]:
+            lock = self._locks.setdefault(guild_id, asyncio.Lock())
+            async with lock:
+                block = self._blocks.get(guild_id)
+                if block is None or block[0] > block[1]:  # Someone else may have refilled it while we waited.
+                    block = self._blocks[guild_id] = await self._reserve(guild_id)
+        number = block[0]
+        block[0] += 1
+        return number
+
+    async def _reserve(self, guild_id: int) -> list:
+        async with self.database.writing() as (connection, _):
+            await connection.execute(RESERVE, (guild_id, self.block_size, self.block_size))
+            async with connection.execute(HIGH_WATER, (guild_id,)) as cursor:
+                high = (await cursor.fetchone())[0]
+        self.reservations += 1
+        self._sync_guild(guild_id, high)
+        logger.debug("Reserved cases %d-%d for guild %d.", high - self.block_size + 1, high, guild_id)
+        return [high - self.block_size + 1, high]
+
+    @staticmethod
+    def _sync_guild(guild_id: int, high: int):
+        # We write guilds.case_id behind the model's back, so keep its identity map honest.
+        if Guild.cached(guild_id) is None:
+            Guild.evict(guild_id)  # The row may not have existed before we reserved.
+        else:
+            Guild._patch_cached(guild_id, ("case_id",), (high,))
+
+    async def close(self) -> None:
+        """
+        Hands unused case numbers back by lowering each guild's high-water mark, so restarts don't leave gaps.
+
+        This only queues the writes - close the database afterwards to commit them.
+
+        :return: None
+        """
+        for guild_id, (number, high) in self._blocks.items():
+            if number > high:
+                continue
+            async with self._locks.setdefault(guild_id, asyncio.Lock()):
+                # Only if the mark is still ours, e.g. another process hasn't reserved past it.
+                await self.database.write(RELEASE, (number - 1, guild_id, high))
+            Guild.evict(guild_id)  # We can't tell whether the release applied, so let the next get() re-read it.
+        self._blocks.clear()
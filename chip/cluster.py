@@ -0,0 +1,279 @@
+# Multi-process cluster launcher
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import secrets
+import signal
+
+import discord
+
+from .ipc import IPCClient, LINE_LIMIT, encode
+
+logger = logging.getLogger(__name__)
+
+
+def shard_ranges(shard_count: int, clusters: int) -> list:
+    """
+    Splits shards between clusters as evenly as possible, keeping each cluster's shards contiguous.
+
+    :param shard_count: The total number of shards
+    :param clusters: How many clusters to split them between
+    :return: list - one list of shard IDs per cluster
+    :raises ValueError: If there are fewer shards than clusters.
+    """
+    if clusters < 1 or shard_count < clusters:
+        raise ValueError(f"Can't split {shard_count} shard(s) between {clusters} cluster(s).")
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster in range(clusters):
+        end = start + size + (cluster < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shard_count(token: str) -> int:
+    """
+    Asks Discord how many shards the bot should use.
+
+    :param token: The bot's token
+    :return: int
+    """
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(token.strip(), bot=True)
+        shards, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards
+
+
+def run_cluster(cluster_id: int, shard_ids: list, shard_count: int, address: tuple, secret: str, token: str,
+                fake_gateway: bool = False) -> None:
+    """
+    The entry point of a cluster's process: runs a ShardedChipBot for the given shards, connected to the launcher.
+
+    :param cluster_id: This cluster's ID
+    :param shard_ids: The shards this cluster runs
+    :param shard_count: The total number of shards, across all clusters
+    :param address: The launcher's (host, port)
+    :param secret: What to identify to the launcher with. See ClusterLauncher.
+    :param token: The bot's token
+    :param fake_gateway: If True, never connects to Discord: the bot logs in to a local FakeGateway instead, which
+        gives each of its shards a few made-up guilds. For trying the launcher out locally.
+    :return: None
+    """
+    from .bot import ShardedChipBot
+    from .fake_gateway import FakeGateway
+
+    # Ctrl+C reaches every process in the group - let the launcher shut us down cleanly instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with open("./config.json") as config_raw:
+        config = json.load(config_raw)
+    # Processes can't share a rotating log file, so each cluster gets its own.
+    logging_config = config.setdefault("logging", {})
+    logging_config["file"] = f"{logging_config.get('file', 'chip.log')}.cluster{cluster_id}"
+    bot = ShardedChipBot(config=config, cluster_id=cluster_id, shard_ids=shard_ids, shard_count=shard_count, loop=loop)
+    bot.ipc = IPCClient(bot, cluster_id, *address, secret=secret)
+
+    async def main():
+        gateway = None
+        try:
+            if fake_gateway:
+                gateway = FakeGateway()
+                await gateway.start()
+                gateway.install()
+                logger.info("Cluster %s is using a fake gateway for shards %s.", cluster_id, shard_ids)
+            # Connect once the database is ready, so commands from the launcher never find the bot half set up.
+            await bot.prepare()
+            await bot.ipc.connect()
+            await bot.start(token)
+        finally:
+            await bot.close()
+            if gateway is not None:
+                await gateway.close()
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+class ClusterLauncher:
+    """
+    Starts a process per cluster, each running a range of the bot's shards, and relays commands between them.
+
+    Clusters connect back to the launcher over a local TCP socket, speaking JSON lines (see chip.ipc). A command
+    broadcast by one cluster is sent to every cluster, and the results are sent back to it keyed by cluster ID.
+
+    Any local process can connect to that socket, so the launcher makes up a secret for each run and hands it to the
+    clusters it starts. Connections that don't identify with it are closed.
+    """
+
+    def __init__(self, clusters: int, shard_count: int, token: str, *, fake_gateway: bool = False,
+                 host: str = "127.0.0.1", port: int = 0, timeout: float = 10):
+        """
+        :param clusters: How many processes to run
+        :param shard_count: The total number of shards
+        :param token: The bot's token
+        :param fake_gateway: Whether the clusters connect to a local FakeGateway instead of Discord. See run_cluster.
+        :param host: The address to listen for clusters on
+        :param port: The port to listen for clusters on. 0 picks a free one.
+        :param timeout: How long to wait for every cluster to answer a command, in seconds.
+        """
+        self.ranges = shard_ranges(shard_count, clusters)
+        self.shard_count = shard_count
+        self.token = token
+        self.fake_gateway = fake_gateway
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.secret = secrets.token_hex(16)
+        self.processes = {}  # cluster ID -> Process
+        self._connections = {}  # cluster ID -> StreamWriter
+        self._connected = {}  # cluster ID -> Event
+        self._waiting = {}  # (request ID, cluster ID) -> Future
+        self._next_id = 0
+        self._server = None
+        self._closing = False
+
+    async def start(self) -> None:
+        """Starts listening, and starts every cluster's process."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=LINE_LIMIT)
+        self.port = self._server.sockets[0].getsockname()[1]
+        context = multiprocessing.get_context("spawn")
+        for cluster_id, shard_ids in enumerate(self.ranges):
+            self._connected[cluster_id] = asyncio.Event()
+            process = context.Process(
+                target=run_cluster,
+                args=(cluster_id, shard_ids, self.shard_count, (self.host, self.port), self.secret, self.token,
+                      self.fake_gateway),
+                name=f"chip-cluster-{cluster_id}",
+            )
+            process.start()
+            self.processes[cluster_id] = process
+            logger.info("Started cluster %s (pid %s) for shards %s.", cluster_id, process.pid, shard_ids)
+
+    async def wait_connected(self, timeout: float = None) -> None:
+        """Waits until every cluster has connected."""
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in self._connected.values())), timeout)
+
+    async def run(self) -> None:
+        """Starts the clusters and waits for them all to exit. SIGINT and SIGTERM shut them down."""
+        await self.start()
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, lambda: loop.create_task(self.close()))
+            except NotImplementedError:  # Windows
+                pass
+        await asyncio.gather(*(loop.run_in_executor(None, process.join) for process in self.processes.values()))
+        for cluster_id, process in self.processes.items():
+            if process.exitcode:
+                logger.error("Cluster %s exited with code %s.", cluster_id, process.exitcode)
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def broadcast(self, command: str, args: dict = None) -> dict:
+        """
+        Runs a command on every connected cluster.
+
+        :param command: The command
+        :param args: Its arguments
+        :return: dict - cluster ID (as a str, as it goes over JSON) -> {"data": result} or {"error": reason}
+        """
+        request_id = self._next_id
+        self._next_id += 1
+        loop = asyncio.get_event_loop()
+        futures = {}
+        message = encode({"op": "request", "id": request_id, "command": command, "args": args or {}})
+        for cluster_id, writer in list(self._connections.items()):
+            futures[cluster_id] = self._waiting[(request_id, cluster_id)] = loop.create_future()
+            try:
+                writer.write(message)
+            except ConnectionError as e:
+                futures[cluster_id].set_exception(e)
+        if futures:
+            await asyncio.wait(futures.values(), timeout=self.timeout)
+        results = {}
+        for cluster_id, future in futures.items():
+            self._waiting.pop((request_id, cluster_id), None)
+            if not future.done():
+                future.cancel()
+                results[str(cluster_id)] = {"error": "Timed out."}
+            elif future.exception() is not None:
+                results[str(cluster_id)] = {"error": repr(future.exception())}
+            else:
+                results[str(cluster_id)] = future.result()
+        return results
+
+    async def close(self) -> None:
+        """Shuts every cluster down, terminating any that don't exit in time."""
+        if self._closing:
+            return
+        self._closing = True
+        logger.info("Shutting down %s cluster(s)...", len(self.processes))
+        await self.broadcast("shutdown")
+        loop = asyncio.get_event_loop()
+        for cluster_id, process in self.processes.items():
+            await loop.run_in_executor(None, process.join, self.timeout)
+            if process.is_alive():
+                logger.warning("Cluster %s didn't shut down in time. Terminating it.", cluster_id)
+                process.terminate()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cluster_id = None
+        try:
+            identify = json.loads(await reader.readline())
+            secret = identify.get("secret")
+            if (
+                identify.get("op") != "identify"
+                or not isinstance(secret, str)
+                or not hmac.compare_digest(secret.encode(), self.secret.encode())
+                or identify.get("cluster") not in self._connected
+            ):
+                logger.warning("Rejected a connection from %s that didn't identify as one of our clusters.",
+                               writer.get_extra_info("peername"))
+                return
+            cluster_id = identify["cluster"]
+            self._connections[cluster_id] = writer
+            self._connected[cluster_id].set()
+            logger.debug("Cluster %s connected.", cluster_id)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message["op"] == "response":
+                    future = self._waiting.get((message["id"], cluster_id))
+                    if future is not None and not future.done():
+                        future.set_result({key: message[key] for key in ("data", "error") if key in message})
+                elif message["op"] == "broadcast":
+                    asyncio.get_event_loop().create_task(self._relay(writer, message))
+        except (ConnectionError, ValueError, KeyError) as e:
+            logger.error("Lost the connection to cluster %s.", cluster_id, exc_info=e)
+        finally:
+            if cluster_id is not None and self._connections.get(cluster_id) is writer:
+                del self._connections[cluster_id]
+                for (_, waiting_on), future in self._waiting.items():
+                    if waiting_on == cluster_id and not future.done():
+                        future.set_exception(ConnectionError(f"Cluster {cluster_id} disconnected."))
+            writer.close()
+
+    async def _relay(self, writer: asyncio.StreamWriter, message: dict):
+        if message["command"] == "shutdown":
+            # Shutting down is the launcher's job, so it can make sure every process actually exits.
+            writer.write(encode({"op": "response", "id": message["id"], "data": {}}))
+            await self.close()
+            return
+        results = await self.broadcast(message["command"], message.get("args"))
+        try:
+            writer.write(encode({"op": "response", "id": message["id"], "data": results}))
+            await writer.drain()
+        except ConnectionError as e:
+            logger.warning("Couldn't send %s results back.", message["command"], exc_info=e)
@@ -1,3 +1,5 @@
+import asyncio
+import importlib
 import time
 import aiohttp
 from datetime import datetime
@@ -6,11 +8,25 @@ from functools import partial
 
 import aiosqlite
 import discord
-import jishaku
-import tabulate
 from discord.ext import commands
 
 from ..bot import ChipBot
+from ..cooldowns import shared_cooldown
+
+TAGS_URL = "https://api.github.com/repos/dragdev-studios/chip/tags"
+
+
+def module_version(name: str) -> str:
+    """
+    Gets a module's __version__, importing it only when asked (these are only shown by the credits command).
+
+    :param name: The module's name
+    :return: str - the version, or "not installed".
+    """
+    try:
+        return importlib.import_module(name).__version__
+    except ImportError:
+        return "not installed"
 
 
 class Meta(commands.Cog):
@@ -20,16 +36,16 @@ class Meta(commands.Cog):
 
     async def run_async(self, part):
         """
-        Async runs a blocking function in the event executor (makes it non-blocking)
+        Async runs a blocking function in the bot's I/O pool (makes it non-blocking)
 
         :param part: a functools.partial function.
         :return: The result of the partial
         """
-        return await self.bot.loop.run_in_executor(None, part)
+        return await self.bot.executors.run(part)
 
     @commands.command(name="ping", aliases=['pong'])
     @commands.bot_has_permissions(embed_links=True)
-    @commands.cooldown(5, 5, commands.BucketType.channel)
+    @shared_cooldown(5, 5, commands.BucketType.channel)
     async def ping(self, ctx: commands.Context):
         """Shows you the bot's ping"""
         start = time.time_ns()
@@ -51,26 +67,27 @@ class Meta(commands.Cog):
 
     @commands.command(name="credits", aliases=['about', 'info'])
     @commands.bot_has_permissions(embed_links=True)
-    @commands.cooldown(1, 3, commands.BucketType.user)
+    @shared_cooldown(1, 3, commands.BucketType.user)
     async def credits(self, ctx: commands.Context):
         """Displays loads of metadata about the bot."""
         msg = await ctx.send("Loading...")
         # head = await self.run_async(partial(run_shell, ["git", "rev-parse", "HEAD", "--short"], shell=True))
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://api.github.com/repos/dragdev-studios/chip/tags") as response:
-                data = await response.json()
-                if response.status != 200 or not data:
-                    out_of_date = False
-                    our_version = "0.0.0a"
-                    their_version = "999.999.999-post"
-                    newest_release = {
-                        "name": "haha it broke"
-                    }
-                else:
-                    our_version = tuple(self.bot.__version__.split("."))
-                    newest_release = data[0]
-                    newest_version = tuple(newest_release["name"].split("."))
-                    out_of_date = newest_version > our_version
+        try:
+            data = await self.bot.web.get_json(self.bot.config.get("github", {}).get("tags_url", TAGS_URL))
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            data = None
+        if not data:
+            out_of_date = False
+            our_version = "0.0.0a"
+            their_version = "999.999.999-post"
+            newest_release = {
+                "name": "haha it broke"
+            }
+        else:
+            our_version = tuple(self.bot.__version__.split("."))
+            newest_release = data[0]
+            newest_version = tuple(newest_release["name"].split("."))
+            out_of_date = newest_version > our_version
 
         embed = discord.Embed(
             title="About Chip:",
@@ -88,11 +105,16 @@ class Meta(commands.Cog):
             name="Bot Version:",
             value=f"{self.bot.__version__}\nRelease: {our_version}\n{newest_release_text}"
         )
+        stats = self.bot.stats.snapshot()
+        embed.add_field(
+            name="Serving:",
+            value=f"{stats.guilds:,} servers\n{stats.channels:,} channels\n{stats.members:,} members"
+        )
         embed.add_field(
             name="Dependency Versions:",
             value=f"discord.py: {discord.__version__}\n"
-                  f"Jishaku: {jishaku.__version__}\n"
-                  f"Tabulate: {tabulate.__version__}\n"
+                  f"Jishaku: {module_version('jishaku')}\n"
+                  f"Tabulate: {module_version('tabulate')}\n"
                   f"aiosqlite: {aiosqlite.__version__}",
             inline=False
         )
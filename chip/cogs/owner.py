@@ -1,8 +1,15 @@
 import asyncio
+import itertools
 import logging
+import sys
+import time
 import traceback
+from datetime import datetime
 
 from ..bot import ChipBot
+from ..ipc import IPCError
+from ..reports import render_tables
+from ..sql import Case, Guild
 from discord.ext import commands
 
 logger = logging.getLogger(__name__)
@@ -23,65 +30,287 @@ class Owner(commands.Cog):
     async def reload(self, ctx: commands.Context, *cogs: str):
         """Reloads all the provided extensions.
 
-        *cogs: A space-delimited list of cogs to reload. Pass only "auto" or "~" ro reload all loaded cogs."""
+        *cogs: A space-delimited list of cogs to reload. Pass only "auto" or "~" ro reload all loaded cogs, or only
+        "changed" to reload just the cogs whose source files changed (and the cogs that depend on them)."""
         cogs = cogs or "~"
+        everything = isinstance(cogs, str) or (len(cogs) == 1 and cogs[0] in ["all", "auto", "~"])
+        changed = len(cogs) == 1 and cogs[0] == "changed"
+        if self.bot.ipc is not None:
+            return await self._reload_clusters(ctx, None if everything or changed else list(cogs), changed)
 
-        def format_message(r):
-            m = ""
-            for c in r:
-                if isinstance(c, tuple):  # failed to reload
-                    m += f"\N{cross mark} `{c[0]}`\n"
-                else:
-                    m += f"\N{white heavy check mark} `{c}`\n"
-            return m
-
-        if isinstance(cogs, str) or len(cogs) == 1:
-            if cogs[0] in ["all", "auto", "~"]:
-                status = []
-                logger.debug(f"Reloading all cogs at the request of {ctx.author}...")
-                for ext in self.bot.extensions:
-                    try:
-                        self.bot.reload_extension(ext)
-                    except commands.ExtensionError as e:
-                        logger.error(f"Failed to re-load extension {ext}.", exc_info=e)
-                        status.append((ext, e))
-                    else:
-                        status.append(ext)
-                return await ctx.send(format_message(status))
-            else:
-                try:
-                    self.bot.reload_extension(cogs[0])
-                except commands.ExtensionError:
-                    text = traceback.format_exc()
-                    paginator = commands.Paginator("```py")
-                    for line in text.splitlines():
-                        paginator.add_line(line[:1980].replace("`", "`\u200b"))  # zwsp will avoid markdown breaking.
-                    await ctx.send(f"\N{cross mark} Failed to load `{cogs[0]}`:")
-                    for page in paginator.pages:
-                        await ctx.send(page)
-                    return
-                else:
-                    await ctx.message.add_reaction("\N{white heavy check mark}")
+        if changed:
+            results = await self.bot.reload_extensions(changed=True)
+            if not results:
+                return await ctx.send("Nothing has changed.")
+            return await self._send_reload_results(ctx, results)
+        if everything:
+            logger.debug("Reloading all cogs at the request of %s...", ctx.author)
+            return await self._send_reload_results(ctx, await self.bot.reload_extensions())
+        if len(cogs) == 1:
+            result, = await self.bot.reloader.reload([cogs[0]])
+            if result.error is not None:
+                error = result.error
+                text = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+                pages = await self.bot.executors.run(self._traceback_pages, text, pool="render")
+                await ctx.send(f"\N{cross mark} Failed to load `{cogs[0]}` ({result.seconds * 1000:.1f}ms):")
+                for page in pages:
+                    await ctx.send(page)
+                return
+            return await self._send_reload_results(ctx, {result.extension: result.to_dict()})
         else:
-            status = []
-            for ext in cogs:
-                try:
-                    self.bot.reload_extension(ext)
-                except commands.ExtensionError as e:
-                    logger.error(f"Failed to re-load extension {ext}.", exc_info=e)
-                    status.append((ext, e))
-                else:
-                    status.append(ext)
-            return await ctx.send(format_message(status))
+            return await self._send_reload_results(ctx, await self.bot.reload_extensions(list(cogs)))
+
+    @staticmethod
+    def _traceback_pages(text: str) -> list:
+        paginator = commands.Paginator("```py")
+        for line in text.splitlines():
+            paginator.add_line(line[:1980].replace("`", "`\u200b"))  # zwsp will avoid markdown breaking.
+        return paginator.pages
+
+    @staticmethod
+    def _reload_lines(results: dict) -> list:
+        lines = []
+        for extension, result in results.items():
+            mark = "\N{cross mark}" if result["error"] else "\N{white heavy check mark}"
+            note = " (dependent)" if result["reason"] == "dependent" else ""
+            lines.append(f"{mark} `{extension}` {result['seconds'] * 1000:.1f}ms{note}")
+        lines.append(f"Total: {sum(result['seconds'] for result in results.values()) * 1000:.1f}ms")
+        return lines
+
+    async def _send_reload_results(self, ctx: commands.Context, results: dict):
+        paginator = commands.Paginator(prefix="", suffix="")
+        for line in self._reload_lines(results):
+            paginator.add_line(line)
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    async def _reload_clusters(self, ctx: commands.Context, extensions: list = None, changed: bool = False):
+        try:
+            results = await self.bot.ipc.broadcast("reload", extensions=extensions, changed=changed)
+        except IPCError as e:
+            return await ctx.send(f"\N{cross mark} {e}")
+        paginator = commands.Paginator(prefix="", suffix="")
+        for cluster_id, result in sorted(results.items(), key=lambda item: int(item[0])):
+            if "error" in result:
+                paginator.add_line(f"**Cluster {cluster_id}**: \N{cross mark} {result['error']}")
+                continue
+            paginator.add_line(f"**Cluster {cluster_id}**:")
+            for line in self._reload_lines(result["data"]) if result["data"] else ["Nothing has changed."]:
+                paginator.add_line(line)
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @staticmethod
+    def _cluster_table(results: dict) -> tuple:
+        columns = ("guilds", "users", "latency_ms", "commands", "events", "loop_lag_p99_ms")
+        rows, totals = [], dict.fromkeys(("guilds", "users", "commands", "events"), 0)
+        for cluster_id, result in sorted(results.items(), key=lambda item: int(item[0])):
+            if "error" in result:
+                rows.append((cluster_id, "-", result["error"][:40]))
+                continue
+            stats = result["data"]
+            shards = stats["shards"]
+            rows.append((cluster_id, f"{shards[0]}-{shards[-1]}" if shards else "-", *(stats[c] for c in columns)))
+            for key in totals:
+                totals[key] += stats[key]
+        rows.append(("total", "", totals["guilds"], totals["users"], "", totals["commands"], totals["events"], ""))
+        return rows, ("cluster", "shards", "guilds", "users", "latency ms", "commands", "events", "lag p99 ms"), {}
+
+    @staticmethod
+    def _latency_table(histograms: dict, label: str, limit: int = 15) -> tuple:
+        # Slowest (by total time spent) first, since that's where optimising pays off.
+        ranked = sorted(histograms.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+        rows = []
+        for name, histogram in ranked:
+            p50, p95, p99 = histogram.percentiles(50, 95, 99)
+            rows.append((name[:60], histogram.count, *(round(value * 1000, 2) for value in (p50, p95, p99))))
+        return rows, (label, "count", "p50 ms", "p95 ms", "p99 ms"), {}
+
+    @commands.command(name="stats")
+    async def stats(self, ctx: commands.Context, section: str = "all"):
+        """Shows where the bot is spending its time.
+
+        section: One of commands, queries, events, cooldowns, modlog, maintenance, executors, caches, clusters (when
+        running as several) or all."""
+        metrics = self.bot.metrics
+        # Each section is one or more (rows, headers, options) tables. Rows are gathered here, on the loop, and the
+        # tables are rendered in the CPU pool.
+        sections = {
+            "commands": lambda: [self._latency_table(metrics.commands, "command")],
+            "queries": lambda: [self._latency_table(metrics.queries, "query")],
+            "events": lambda: [(metrics.events.most_common(15), ("event", "count"), {})],
+            "cooldowns": lambda: [
+                ([self.bot.cooldowns.stats], "keys", {}),
+                (self.bot.cooldowns.limited.most_common(10), ("command", "times limited"), {}),
+            ],
+            "modlog": lambda: [([self.bot.modlog.stats], "keys", {})],
+            "maintenance": lambda: [(
+                [
+                    (run.task, datetime.utcfromtimestamp(run.started_at).strftime("%Y-%m-%d %H:%M:%S"),
+                     f"{run.seconds * 1000:.1f}", repr(run.error) if run.error else run.result)
+                    for run in (*self.bot.maintenance.history, self.bot.maintenance.last_sweep) if run is not None
+                ],
+                ("task", "started (UTC)", "ms", "result"),
+                {},
+            )],
+            "executors": lambda: [(self.bot.executors.stats, "keys", {"floatfmt": ".1f"})],
+            "caches": lambda: [(
+                [
+                    (name, cache["hits"], cache["misses"], f"{cache['hit_rate']:.1%}", cache["size"])
+                    for name, cache in (
+                        ("prefixes", self.bot.prefix_cache.stats),
+                        ("guilds", Guild._identity.stats),
+                        ("cases", Case._identity.stats),
+                        ("web", self.bot.web.stats),
+                    )
+                ],
+                ("cache", "hits", "misses", "hit rate", "size"),
+                {},
+            )],
+        }
+        if self.bot.ipc is not None and section in ("all", "clusters"):
+            try:
+                cluster_results = await self.bot.ipc.broadcast("stats")
+            except IPCError as e:
+                return await ctx.send(f"\N{cross mark} {e}")
+            sections["clusters"] = lambda: [self._cluster_table(cluster_results)]
+        if section != "all" and section not in sections:
+            return await ctx.send("Unknown section. Pick one of: " + ", ".join(("all", *sections)))
+
+        selected = [(name, tables()) for name, tables in sections.items() if section in ("all", name)]
+        rendered = iter(await self.bot.executors.run_cpu(
+            render_tables, [table for _, tables in selected for table in tables]
+        ))
+        paginator = commands.Paginator("```")
+        for name, tables in selected:
+            paginator.add_line(name.title() + ":")
+            for table in itertools.islice(rendered, len(tables)):
+                for line in table.splitlines():
+                    paginator.add_line(line[:1980])
+            paginator.add_line()
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @commands.command(name="lag")
+    async def lag(self, ctx: commands.Context, stacks: bool = False):
+        """Shows event loop lag, and the worst things that have blocked the loop.
+
+        stacks: Whether to include where each stall was caught (needs monitor.trace enabled)."""
+        monitor = self.bot.monitor
+        p50, p95, p99 = monitor.lag.percentiles(50, 95, 99)
+        paginator = commands.Paginator("```")
+        paginator.add_line(
+            f"Loop lag: p50 {p50 * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms, "
+            f"max {monitor.lag.max * 1000:.1f}ms (tracing {'on' if monitor.trace else 'off'})"
+        )
+        paginator.add_line()
+        rows = [(stall.name[:60], round(stall.duration * 1000, 1), f"{time.time() - stall.when:.0f}s ago")
+                for stall in monitor.worst]
+        table, = await self.bot.executors.run_cpu(render_tables, [(rows, ("culprit", "ms", "when"), {})])
+        for line in table.splitlines():
+            paginator.add_line(line)
+        if stacks:
+            for stall in monitor.worst:
+                if stall.stack:
+                    paginator.add_line()
+                    paginator.add_line(f"{stall.name} ({stall.duration * 1000:.1f}ms):")
+                    for line in stall.stack.splitlines():
+                        paginator.add_line(line[:1980].replace("`", "`\u200b"))
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @staticmethod
+    def _shallow_size(obj) -> int:
+        # The object, plus its direct attributes that are plain values. Shared objects (guilds, states) aren't counted.
+        size = sys.getsizeof(obj)
+        names = []
+        for cls in type(obj).__mro__:
+            slots = getattr(cls, "__slots__", ())
+            names.extend((slots,) if isinstance(slots, str) else slots)
+        values = [getattr(obj, name, None) for name in names]
+        if hasattr(obj, "__dict__"):
+            size += sys.getsizeof(obj.__dict__)
+            values.extend(vars(obj).values())
+        for value in values:
+            if isinstance(value, (str, bytes, int, float, tuple, list, dict)):
+                size += sys.getsizeof(value)
+        return size
+
+    def _approximate_size(self, objects, count: int, sample: int = 200) -> int:
+        # Measures the first few objects and scales up, since walking every member of every guild would block the loop.
+        measured = list(itertools.islice(objects, sample))
+        if not measured:
+            return 0
+        return sum(map(self._shallow_size, measured)) * count // len(measured)
+
+    @staticmethod
+    def _resident_memory():
+        # Only available on Linux. None elsewhere.
+        try:
+            import resource
+            with open("/proc/self/statm") as statm:
+                pages = int(statm.read().split()[1])
+        except (OSError, ImportError):
+            return None
+        return pages * resource.getpagesize()
+
+    @commands.command(name="memory", aliases=["mem"])
+    async def memory(self, ctx: commands.Context):
+        """Shows how big each of the bot's caches is. Sizes are estimates from a sample of each cache."""
+        bot = self.bot
+        state = bot._connection
+        guilds = bot.guilds
+        # Counted and sampled straight from the caches: the public properties copy them into new lists.
+        caches = (
+            ("users", len(state._users), state._users.values()),
+            ("members", sum(len(guild._members) for guild in guilds),
+             itertools.chain.from_iterable(guild._members.values() for guild in guilds)),
+            ("messages", len(bot.cached_messages), bot.cached_messages),
+            ("channels", sum(len(guild._channels) for guild in guilds) + len(state._private_channels),
+             itertools.chain(bot.get_all_channels(), state._private_channels.values())),
+            ("roles", sum(len(guild._roles) for guild in guilds),
+             itertools.chain.from_iterable(guild._roles.values() for guild in guilds)),
+            ("emojis", len(state._emojis), state._emojis.values()),
+        )
+        rows = [
+            (name, count, f"{self._approximate_size(iter(objects), count) / 1024:,.0f}")
+            for name, count, objects in caches
+        ]
+        rows.append(("moderation messages", len(bot.messages), f"{bot.messages.bytes / 1024:,.0f}"))
+        rows.append(("cooldown buckets", len(bot.cooldowns), f"{bot.cooldowns.bytes / 1024:,.0f}"))
+        rows.append(("prefix cache", len(bot.prefix_cache), "-"))
+        rows.append(("guild models", len(Guild._identity), "-"))
+        intents = bot.intents
+        paginator = commands.Paginator("```")
+        rss = self._resident_memory()
+        if rss is not None:
+            paginator.add_line(f"Resident memory: {rss / 1024 / 1024:,.1f} MiB")
+        paginator.add_line(
+            f"Guilds: {len(bot.guilds)} ({sum(guild.chunked for guild in bot.guilds)} chunked, chunking: "
+            f"{bot.chunking}), members intent: {intents.members}, presences intent: {intents.presences}"
+        )
+        paginator.add_line()
+        table, = await bot.executors.run_cpu(render_tables, [(rows, ("cache", "entries", "~KiB"), {})])
+        for line in table.splitlines():
+            paginator.add_line(line)
+        for page in paginator.pages:
+            await ctx.send(page)
 
     @commands.command(name="shutdown", aliases=['logout'])
     async def die(self, ctx: commands.Context, *, delay: float = 0.0):
         """Just closes the bot and logs it out. Optional delay included!"""
-        logger.info(f"Told to close in {delay} seconds by {ctx.author}.")
+        logger.info("Told to close in %s seconds by %s.", delay, ctx.author)
         if delay:
             if delay >= 10.0:
                 await ctx.trigger_typing()
             await asyncio.sleep(delay)
+        if self.bot.ipc is not None:
+            await ctx.send("Shutting down every cluster...")
+            try:
+                # The launcher takes it from here, and shuts this cluster down too.
+                return await self.bot.ipc.broadcast("shutdown")
+            except IPCError as e:
+                logger.warning("Couldn't reach the launcher. Shutting down just this cluster.", exc_info=e)
         await self.bot.close()
 
 
@@ -0,0 +1,205 @@
+# Shared command cooldowns
+import sys
+import time
+from collections import Counter
+
+from discord.ext import commands
+
+COMMAND_BITS = 16  # Room for 65536 distinct commands in a key.
+_ENTRY_SIZE = sys.getsizeof(2 ** 100) + sys.getsizeof(0.0) + 24  # An int key, a float, and the dict's slot for them.
+
+
+class SharedCooldown:
+    """
+    A command's cooldown: `rate` uses every `per` seconds, per bucket.
+    """
+
+    __slots__ = ("rate", "per", "type", "interval", "tolerance", "_cooldown")
+
+    def __init__(self, rate: int, per: float, type: commands.BucketType = commands.BucketType.user):
+        """
+        :param rate: How many uses are allowed...
+        :param per: ...every this many seconds.
+        :param type: What a bucket is - a user, a channel, a guild...
+        """
+        if rate < 1 or per <= 0:
+            raise ValueError("A cooldown needs a rate of at least 1, and a positive period.")
+        self.rate = rate
+        self.per = float(per)
+        self.type = type
+        self.interval = self.per / rate  # How much of the period each use takes up.
+        self.tolerance = self.per - self.interval  # How far ahead of now a bucket can be booked and still be used.
+        self._cooldown = None
+
+    @property
+    def cooldown(self) -> commands.Cooldown:
+        """The equivalent discord.py Cooldown, for CommandOnCooldown."""
+        if self._cooldown is None:
+            self._cooldown = commands.Cooldown(self.rate, self.per, self.type)
+        return self._cooldown
+
+
+def shared_cooldown(rate: int, per: float, type: commands.BucketType = commands.BucketType.user):
+    """
+    Puts a command on a cooldown kept in the bot's shared CooldownStore, instead of discord.py's per-command mappings.
+    Works above or below @commands.command, and raises commands.CommandOnCooldown.
+
+    It's checked in ChipBot's before_invoke hook, which discord.py runs after the command's checks pass and its
+    arguments are converted, but also after the cog's cog_before_invoke and the command's own @before_invoke hooks.
+    Unlike with discord.py's cooldowns, those hooks still run for a call that then turns out to be on cooldown, so
+    they shouldn't do anything that assumes the command will run.
+
+    :param rate: How many uses are allowed...
+    :param per: ...every this many seconds.
+    :param type: What a bucket is - a user, a channel, a guild...
+    """
+    spec = SharedCooldown(rate, per, type)
+
+    def decorator(func):
+        callback = func.callback if isinstance(func, commands.Command) else func
+        callback.__shared_cooldown__ = spec
+        return func
+
+    return decorator
+
+
+class CooldownStore:
+    """
+    Every command's cooldown buckets, in one dict of int -> float.
+
+    Cooldowns are enforced with GCRA (the generic cell rate algorithm): the only state a bucket needs is the time at
+    which it will next be completely empty. A bucket whose time has passed is no different from one that doesn't exist,
+    so it's removed by sweep(), which the maintenance task calls every tick.
+
+    Keys are plain ints combining the bucket's ID with a small per-command number, which costs far less than a tuple
+    (and its own dict per command, as discord.py does).
+
+    Guilds can override a command's cooldown, or turn it off, with set_override().
+    """
+
+    def __init__(self, *, overrides: dict = None):
+        """
+        :param overrides: Optional[dict] - guild ID -> {command name: [rate, per] or None}, as in the config.
+        """
+        self.checks = 0
+        self.limited = Counter()  # command name -> times it was on cooldown
+        self.swept = 0
+        self._buckets = {}  # key -> when the bucket will be empty, on the monotonic clock
+        self._commands = {}  # command name -> its number in keys
+        self._overrides = {}  # (guild ID, command name) -> Optional[(rate, per)]
+        self._specs = {}  # (rate, per, type) -> SharedCooldown, shared by every override with those settings
+        for guild_id, settings in (overrides or {}).items():
+            for name, setting in settings.items():
+                self.set_override(int(guild_id), name, *(setting or (None, None)))
+
+    def __len__(self):
+        return len(self._buckets)
+
+    @property
+    def bytes(self) -> int:
+        """An estimate of the memory the buckets use."""
+        return sys.getsizeof(self._buckets) + len(self._buckets) * _ENTRY_SIZE
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self._buckets),
+            "bytes": self.bytes,
+            "checks": self.checks,
+            "limited": sum(self.limited.values()),
+            "swept": self.swept,
+            "overrides": len(self._overrides),
+        }
+
+    def set_override(self, guild_id: int, command: str, rate: int = None, per: float = None) -> None:
+        """
+        Overrides a command's cooldown in a guild. Leave rate and per out to turn the cooldown off there.
+
+        :param guild_id: The guild
+        :param command: The command's qualified name
+        :param rate: Optional[int] - How many uses are allowed...
+        :param per: Optional[float] - ...every this many seconds.
+        :return: None
+        """
+        if rate is not None:
+            SharedCooldown(rate, per)  # Validates them.
+        self._overrides[(guild_id, command)] = None if rate is None else (rate, float(per))
+
+    def remove_override(self, guild_id: int, command: str) -> None:
+        """Goes back to a command's own cooldown in a guild."""
+        self._overrides.pop((guild_id, command), None)
+
+    def _key(self, command: str, bucket) -> int:
+        number = self._commands.get(command)
+        if number is None:
+            number = self._commands[command] = len(self._commands)
+            if number >> COMMAND_BITS:
+                raise RuntimeError("Too many commands with shared cooldowns.")
+        if isinstance(bucket, tuple):  # BucketType.member: (guild ID or None, user ID)
+            bucket = (bucket[1] << 64) | (bucket[0] or 0)
+        elif bucket is None:  # BucketType.default
+            bucket = 0
+        return (bucket << COMMAND_BITS) | number
+
+    def hit(self, command: str, bucket, spec: SharedCooldown) -> float:
+        """
+        Uses a bucket once, if it isn't on cooldown.
+
+        :param command: The command's qualified name
+        :param bucket: The bucket's ID, from spec.type.get_key()
+        :param spec: The cooldown
+        :return: float - 0 if the use was allowed, otherwise how many seconds until it would be.
+        """
+        self.checks += 1
+        key = self._key(command, bucket)
+        now = time.monotonic()
+        empty_at = self._buckets.get(key, now)
+        if empty_at < now:
+            empty_at = now
+        if empty_at - now > spec.tolerance:
+            self.limited[command] += 1
+            return empty_at - spec.tolerance - now
+        self._buckets[key] = empty_at + spec.interval
+        return 0.0
+
+    def spec_for(self, ctx: commands.Context):
+        """
+        The cooldown that applies to an invocation, taking the guild's overrides into account.
+
+        :param ctx: The invocation
+        :return: Optional[SharedCooldown]
+        """
+        spec = getattr(ctx.command.callback, "__shared_cooldown__", None)
+        if spec is not None and ctx.guild is not None and self._overrides:
+            key = (ctx.guild.id, ctx.command.qualified_name)
+            if key in self._overrides:
+                override = self._overrides[key]
+                if override is None:
+                    return None
+                found = self._specs.get((*override, spec.type))
+                if found is None:
+                    found = self._specs[(*override, spec.type)] = SharedCooldown(*override, spec.type)
+                return found
+        return spec
+
+    async def before_invoke(self, ctx: commands.Context):
+        """Run by ChipBot before every command. Raises commands.CommandOnCooldown if the command is on cooldown."""
+        spec = self.spec_for(ctx)
+        if spec is None:
+            return
+        retry_after = self.hit(ctx.command.qualified_name, spec.type.get_key(ctx.message), spec)
+        if retry_after:
+            raise commands.CommandOnCooldown(spec.cooldown, retry_after)
+
+    def sweep(self) -> int:
+        """
+        Removes every bucket that has emptied.
+
+        :return: int - how many were removed
+        """
+        now = time.monotonic()
+        expired = [key for key, empty_at in self._buckets.items() if empty_at <= now]
+        for key in expired:
+            del self._buckets[key]
+        self.swept += len(expired)
+        return len(expired)
@@ -0,0 +1,274 @@
+# Database connection handling
+import asyncio
+import logging
+import pathlib
+import time
+from contextlib import asynccontextmanager
+from itertools import cycle
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRAGMAS = {
+    # Lets maintenance hand free pages back. Only takes effect on new databases, so it has to come first.
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",  # readers don't block the writer (and vice versa)
+    "synchronous": "NORMAL",  # safe with WAL, and saves an fsync per commit
+    "cache_size": -16000,  # negative is KiB, so ~16MB of page cache per connection
+    "mmap_size": 268435456,  # 256MB
+    "temp_store": "MEMORY",
+}
+READER_PRAGMAS = ("cache_size", "mmap_size", "temp_store")  # journal_mode and synchronous are writer-only.
+
+
+async def apply_pragmas(connection: aiosqlite.Connection, pragmas: dict) -> None:
+    """
+    Sets a number of PRAGMAs on a connection.
+
+    :param connection: The connection to tune
+    :param pragmas: name: value pairs. Values must be plain integers or words, since PRAGMAs can't be parametrised.
+    :return: None
+    """
+    for name, value in pragmas.items():
+        if not name.isidentifier() or not (isinstance(value, int) or str(value).isalnum()):
+            raise ValueError("Invalid PRAGMA {}={!r}.".format(name, value))
+        await connection.execute("PRAGMA {}={};".format(name, value))
+
+
+class _TimedResult:
+    # Wraps aiosqlite's execute() result to time a read, including fetching when used as a context manager.
+    __slots__ = ("_result", "_query", "_metrics", "_start")
+
+    def __init__(self, result, query, metrics):
+        self._result = result
+        self._query = query
+        self._metrics = metrics
+        self._start = time.perf_counter()
+
+    def __await__(self):
+        cursor = yield from self._result.__await__()
+        self._metrics.time_query(self._query, time.perf_counter() - self._start)
+        return cursor
+
+    async def __aenter__(self):
+        return await self._result.__aenter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self._result.__aexit__(exc_type, exc, tb)
+        finally:
+            self._metrics.time_query(self._query, time.perf_counter() - self._start)
+
+
+class Database:
+    """
+    Wraps the bot's aiosqlite connections, grouping writes from every model into as few commits as possible.
+
+    Writes are executed straight away on the single writer connection, but the commit - and so the fsync - is deferred
+    until either flush_interval seconds have passed or max_batch statements are waiting.
+
+    Reads are spread over a pool of read-only connections. While there are uncommitted writes, reads go to the writer
+    instead, so callers always see their own writes.
+    """
+
+    def __init__(
+        self,
+        connection: aiosqlite.Connection,
+        *,
+        readers=(),
+        flush_interval: float = 0.05,
+        max_batch: int = 100,
+    ):
+        """
+        :param connection: The aiosqlite connection to write with.
+        :param readers: Optional list of (read-only) aiosqlite connections to read with.
+        :param flush_interval: How many seconds a write may wait before it is committed.
+        :param max_batch: How many uncommitted statements may pile up before a commit is forced.
+        """
+        self.connection = connection
+        self.readers = list(readers)
+        self._reader_cycle = cycle(self.readers) if self.readers else None
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.commits = 0
+        self.statements = 0
+        self.metrics = None  # Optional[chip.metrics.Metrics] - set this to time every query.
+        self._lock = asyncio.Lock()
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    @classmethod
+    async def connect(cls, path: str, *, readers: int = 4, pragmas: dict = None, **kwargs) -> "Database":
+        """
+        Opens the writer and reader connections and wraps them.
+
+        :param path: The path to the sqlite database
+        :param readers: How many read-only connections to open. In-memory databases always get 0.
+        :param pragmas: PRAGMAs to override DEFAULT_PRAGMAS with.
+        :param kwargs: Passed to Database()
+        :return: Database
+        """
+        pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        writer = await aiosqlite.connect(path)
+        await apply_pragmas(writer, pragmas)
+        await writer.commit()
+
+        reader_connections = []
+        if path != ":memory:" and not path.startswith("file:"):
+            uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+            reader_pragmas = {name: value for name, value in pragmas.items() if name in READER_PRAGMAS}
+            for _ in range(readers):
+                reader = await aiosqlite.connect(uri, uri=True)
+                await apply_pragmas(reader, reader_pragmas)
+                reader_connections.append(reader)
+        logger.debug("Opened %s with %d reader(s).", path, len(reader_connections))
+        return cls(writer, readers=reader_connections, **kwargs)
+
+    @property
+    def pending(self) -> int:
+        """How many statements are waiting to be committed."""
+        return len(self._pending)
+
+    def reader(self) -> aiosqlite.Connection:
+        """
+        Picks the connection the next read should use.
+
+        :return: aiosqlite.Connection - a reader, or the writer if there are uncommitted writes (or no readers).
+        """
+        if self._pending or self._reader_cycle is None:
+            return self.connection
+        return next(self._reader_cycle)
+
+    def execute(self, query: str, params=()):
+        """
+        Runs a read query.
+
+        The result can be awaited for a cursor, or used as an async context manager, like aiosqlite's own execute.
+
+        :param query: The SQL to run
+        :param params: The parameters to bind
+        :return: The aiosqlite cursor context
+        """
+        result = self.reader().execute(query, params)
+        if self.metrics is not None:
+            return _TimedResult(result, query, self.metrics)
+        return result
+
+    async def write(self, query: str, params=(), *, many: bool = False) -> asyncio.Future:
+        """
+        Runs a write query, queueing it to be committed with the next batch.
+
+        :param query: The SQL to run
+        :param params: The parameters to bind. If many is True, an iterable of parameter sequences.
+        :param many: Whether to use executemany.
+        :return: asyncio.Future - resolves once the statement has been committed. Await it if you need durability.
+        """
+        async with self.writing() as (connection, committed):
+            start = time.perf_counter()
+            if many:
+                await connection.executemany(query, params)
+            else:
+                await connection.execute(query, params)
+            if self.metrics is not None:
+                self.metrics.time_query(query, time.perf_counter() - start)
+        return committed
+
+    @asynccontextmanager
+    async def writing(self):
+        """
+        Gives exclusive use of the writer connection, for writes that need several statements to run back to back
+        (e.g. read-modify-write). The statements are committed with the next batch, like write().
+
+        Usage: ``async with database.writing() as (connection, committed): ...``
+
+        :return: A tuple of the writer connection and a future that resolves once the statements are committed.
+        """
+        async with self._lock:
+            future = asyncio.get_event_loop().create_future()
+            yield self.connection, future
+            self._pending.append(future)
+            self.statements += 1
+
+        if len(self._pending) >= self.max_batch:
+            self._kick()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.flush_interval, self._kick)
+
+    def _kick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self) -> None:
+        """
+        Commits every pending write now.
+
+        :return: None
+        """
+        async with self._lock:
+            await self._commit_pending()
+
+    async def _commit_pending(self) -> None:
+        # Callers hold self._lock.
+        pending = self._pending
+        if not pending:
+            return
+        start = time.perf_counter()
+        try:
+            await self.connection.commit()
+        except Exception as e:
+            self._pending = []
+            logger.error("Failed to commit %d statements.", len(pending), exc_info=e)
+            await self.connection.rollback()
+            for future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if self.metrics is not None:
+            self.metrics.time_query("COMMIT", time.perf_counter() - start)
+        # Only cleared once committed, so reads keep going to the writer until the readers can see the writes.
+        self._pending = []
+        self.commits += 1
+        for future in pending:
+            if not future.done():
+                future.set_result(None)
+
+    async def run_exclusive(self, query: str) -> list:
+        """
+        Commits pending writes, then runs a statement on the writer with nothing else writing, and commits it too. This
+        is for maintenance (ANALYZE, checkpoints and other PRAGMAs) that shouldn't share a transaction with anything.
+
+        :param query: The SQL to run
+        :return: list - the rows it returned, if any.
+        """
+        async with self._lock:
+            # Under the lock, so a write can't slip in between and be committed without its future resolving.
+            await self._commit_pending()
+            start = time.perf_counter()
+            async with self.connection.execute(query) as cursor:
+                rows = await cursor.fetchall()
+            await self.connection.commit()
+            if self.metrics is not None:
+                self.metrics.time_query(query, time.perf_counter() - start)
+        return rows
+
+    async def close(self) -> None:
+        """
+        Flushes any pending writes, then closes every connection.
+
+        :return: None
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+        for reader in self.readers:
+            await reader.close()
+        await self.connection.close()
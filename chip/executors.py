@@ -0,0 +1,215 @@
+# Executors for blocking and CPU-bound work
+import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOLS = {
+    "io": {"workers": 8, "queue": 64},  # Blocking I/O: files, subprocesses, sync libraries.
+    "render": {"workers": 2, "queue": 16},  # Small CPU work that shouldn't hold up the loop, e.g. tables.
+}
+
+
+class BoundedPool:
+    """
+    A named pool of workers that admits at most `workers + queue` jobs at once. Anyone submitting past that waits for a
+    slot, so a flood of work queues up as suspended coroutines (which can be cancelled) instead of in the pool.
+    """
+
+    def __init__(self, name: str, executor, workers: int, queue: int, *, samples: int = 1024):
+        """
+        :param name: The pool's name
+        :param executor: The concurrent.futures executor to run jobs on.
+        :param workers: How many workers the executor has.
+        :param queue: How many jobs can wait for a worker before submitters have to wait too.
+        :param samples: How many recent samples the wait and run time histograms keep.
+        """
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.limit = workers + queue
+        self.submitted = self.completed = self.failed = 0
+        self.waiting = 0  # Submitters waiting for a slot (backpressure).
+        self.wait_time = Histogram(samples)  # From being called to starting to run.
+        self.run_time = Histogram(samples)
+        self._admitted = 0
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._slots = None  # Made on first use, so it binds to the running loop.
+
+    @property
+    def busy(self) -> int:
+        """How many jobs are running."""
+        return self._busy
+
+    @property
+    def queued(self) -> int:
+        """How many jobs are admitted, but waiting for a worker."""
+        return max(0, self._admitted - self._busy)
+
+    @property
+    def utilisation(self) -> float:
+        """The fraction of workers that are busy."""
+        return self._busy / self.workers
+
+    @property
+    def stats(self) -> dict:
+        wait_p99, = self.wait_time.percentiles(99)
+        run_p50, run_p99 = self.run_time.percentiles(50, 99)
+        return {
+            "pool": self.name,
+            "workers": self.workers,
+            "busy": self._busy,
+            "queued": self.queued,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_p99_ms": wait_p99 * 1000,
+            "run_p50_ms": run_p50 * 1000,
+            "run_p99_ms": run_p99 * 1000,
+        }
+
+    def _track(self, func, submitted: float):
+        # Runs in the worker thread. Process pools run _timed instead, as this can't be pickled.
+        started = time.perf_counter()
+        with self._lock:
+            self._busy += 1
+        try:
+            return func(), started - submitted
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) in the pool, waiting for a slot if it's full.
+
+        :return: Whatever func returns.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        called = time.perf_counter()
+        if self._slots.locked():
+            self.waiting += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self._admitted += 1
+        self.submitted += 1
+        loop = asyncio.get_event_loop()
+        job = functools.partial(func, *args, **kwargs)
+        try:
+            submitted = time.perf_counter()
+            if isinstance(self.executor, ThreadPoolExecutor):
+                result, queued = await loop.run_in_executor(self.executor, self._track, job, submitted)
+            else:
+                self._busy += 1  # Approximate: counted from submission, as the worker is in another process.
+                try:
+                    result, queued = await loop.run_in_executor(self.executor, _timed, job, time.time())
+                finally:
+                    self._busy -= 1
+            self.wait_time.observe(submitted - called + queued)
+            self.run_time.observe(time.perf_counter() - submitted - queued)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._admitted -= 1
+            self._slots.release()
+
+    def shutdown(self) -> None:
+        """Shuts the pool down, without waiting for running jobs."""
+        self.executor.shutdown(wait=False)
+
+
+def _timed(job, submitted: float):
+    # The process pool's version of BoundedPool._track. Wall clock time, as perf_counter isn't shared across processes.
+    return job(), time.time() - submitted
+
+
+class ExecutorService:
+    """
+    The bot's executors: named, bounded thread pools for blocking work, and a process pool for CPU-heavy work.
+
+    Use run() for anything that blocks (files, subprocesses, synchronous libraries) and run_cpu() for work that's heavy
+    enough to be worth pickling its arguments and result across processes. Don't use the loop's default executor - its
+    queue is unbounded and invisible.
+    """
+
+    def __init__(self, pools: dict = None, *, processes: int = 2, process_queue: int = 8, samples: int = 1024):
+        """
+        :param pools: Optional[dict] - pool name -> {"workers": int, "queue": int}. Defaults to DEFAULT_POOLS.
+        :param processes: How many processes the CPU pool has. It's only started when first used.
+        :param process_queue: How many CPU jobs can wait for a process before submitters have to wait too.
+        :param samples: How many recent samples each pool's histograms keep.
+        """
+        self.samples = samples
+        self.pools = {}
+        for name, settings in (pools or DEFAULT_POOLS).items():
+            workers = settings.get("workers", 4)
+            executor = ThreadPoolExecutor(workers, thread_name_prefix=f"chip-{name}")
+            self.pools[name] = BoundedPool(name, executor, workers, settings.get("queue", 16), samples=samples)
+        self.processes = processes
+        self.process_queue = process_queue
+        self._cpu = None
+
+    @property
+    def cpu(self) -> BoundedPool:
+        """The process pool, started on first use."""
+        if self._cpu is None:
+            # Spawned rather than forked: forking a process with a running loop and other threads isn't safe.
+            executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            self._cpu = BoundedPool("cpu", executor, self.processes, self.process_queue, samples=self.samples)
+            logger.debug("Started the CPU pool, with %d processes.", self.processes)
+        return self._cpu
+
+    async def run(self, func, *args, pool: str = "io", **kwargs):
+        """
+        Runs a blocking function in a thread pool.
+
+        :param func: The function
+        :param args: Its positional arguments
+        :param pool: Which pool to run it in
+        :param kwargs: Its keyword arguments
+        :return: Whatever func returns.
+        :raises KeyError: If there's no such pool.
+        """
+        return await self.pools[pool].run(func, *args, **kwargs)
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """
+        Runs a CPU-bound function in the process pool. func, its arguments and its result must be picklable, so func
+        has to be a module-level function.
+
+        :param func: The function
+        :param args: Its positional arguments
+        :param kwargs: Its keyword arguments
+        :return: Whatever func returns.
+        """
+        return await self.cpu.run(func, *args, **kwargs)
+
+    @property
+    def stats(self) -> list:
+        """Each pool's stats. The process pool is only included once it's started."""
+        pools = list(self.pools.values()) + ([self._cpu] if self._cpu is not None else [])
+        return [pool.stats for pool in pools]
+
+    def shutdown(self) -> None:
+        """Shuts every pool down."""
+        for pool in self.pools.values():
+            pool.shutdown()
+        if self._cpu is not None:
+            self._cpu.shutdown()
+            self._cpu = None
@@ -0,0 +1,167 @@
+# A fake Discord gateway, for running clusters locally
+import datetime
+import itertools
+import json
+import logging
+import uuid
+
+from aiohttp import WSMsgType, web
+from discord.http import Route
+
+logger = logging.getLogger(__name__)
+
+# Gateway opcodes
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RESUME = 6
+REQUEST_GUILD_MEMBERS = 8
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+BOT_ID = 1 << 60
+
+
+def guild_ids(shard_id: int, shard_count: int, count: int) -> list:
+    """
+    IDs of fake guilds that belong to a shard, following Discord's (guild_id >> 22) % shard_count rule.
+
+    :param shard_id: The shard
+    :param shard_count: The total number of shards
+    :param count: How many guilds to make up
+    :return: list
+    """
+    return [((n + 1) * shard_count + shard_id) << 22 for n in range(count)]
+
+
+def _json(data: dict, status: int = 200) -> web.Response:
+    # discord.py only decodes bodies whose Content-Type is exactly application/json, without a charset.
+    return web.Response(body=json.dumps(data).encode(), status=status, headers={"Content-Type": "application/json"})
+
+
+class FakeGateway:
+    """
+    Just enough of Discord's HTTP API and gateway for the bot to log in and connect its shards, on a local port.
+
+    Every shard that identifies gets a READY listing its guilds as unavailable, then a GUILD_CREATE for each of them, so
+    shard assignment, READY handling and guild caching all run as they would against Discord. Heartbeats are
+    acknowledged, member requests get an empty chunk, and every other HTTP route is a 404.
+
+    install() points discord.py at it, for the whole process.
+    """
+
+    def __init__(self, *, guilds_per_shard: int = 2, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param guilds_per_shard: How many guilds each shard has.
+        :param host: The address to listen on
+        :param port: The port to listen on. 0 picks a free one.
+        """
+        self.guilds_per_shard = guilds_per_shard
+        self.host = host
+        self.port = port
+        self.identified = []  # shard IDs, in the order they identified
+        self.user = {"id": str(BOT_ID), "username": "chip", "discriminator": "0000", "avatar": None, "bot": True}
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        """Starts listening."""
+        app = web.Application()
+        app.router.add_get("/api/v7/users/@me", self._me)
+        app.router.add_get("/api/v7/gateway", self._gateway_url)
+        app.router.add_get("/api/v7/gateway/bot", self._gateway_url)
+        app.router.add_get("/gateway", self._gateway)
+        app.router.add_route("*", "/{path:.*}", self._not_found)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+        logger.info("Fake gateway listening on %s.", self.url)
+
+    def install(self) -> None:
+        """Sends every request discord.py makes in this process to the fake gateway."""
+        Route.BASE = f"{self.url}/api/v7"
+
+    async def close(self) -> None:
+        """Stops listening."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _me(self, request):
+        return _json(self.user)
+
+    async def _gateway_url(self, request):
+        return _json({
+            "url": f"ws://{self.host}:{self.port}/gateway",
+            "shards": 1,
+            "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1},
+        })
+
+    async def _not_found(self, request):
+        return _json({"message": "Unknown route (fake gateway)", "code": 0}, status=404)
+
+    def _guild(self, guild_id: int) -> dict:
+        joined_at = datetime.datetime.utcnow().isoformat()
+        return {
+            "id": str(guild_id),
+            "name": f"Fake guild {guild_id}",
+            "owner_id": self.user["id"],
+            "unavailable": False,
+            "large": False,
+            "member_count": 1,
+            "features": [],
+            "emojis": [],
+            "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "104324673", "position": 0,
+                       "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+            "channels": [{"id": str(guild_id + 1), "type": 0, "name": "general", "position": 0,
+                          "permission_overwrites": []}],
+            "members": [{"user": self.user, "roles": [], "joined_at": joined_at, "deaf": False, "mute": False}],
+            "voice_states": [],
+            "presences": [],
+        }
+
+    async def _gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sequence = itertools.count(1)
+
+        async def dispatch(event: str, data: dict):
+            await ws.send_str(json.dumps({"op": DISPATCH, "t": event, "s": next(sequence), "d": data}))
+
+        await ws.send_str(json.dumps({"op": HELLO, "d": {"heartbeat_interval": 41250}}))
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(message.data)
+            op, data = payload.get("op"), payload.get("d")
+            if op == HEARTBEAT:
+                await ws.send_str(json.dumps({"op": HEARTBEAT_ACK}))
+            elif op == IDENTIFY:
+                shard_id, shard_count = data.get("shard", (0, 1))
+                self.identified.append(shard_id)
+                guilds = guild_ids(shard_id, shard_count, self.guilds_per_shard)
+                logger.debug("Shard %s/%s identified. Sending %s guild(s).", shard_id, shard_count, len(guilds))
+                await dispatch("READY", {
+                    "v": 6,
+                    "user": self.user,
+                    "guilds": [{"id": str(guild_id), "unavailable": True} for guild_id in guilds],
+                    "session_id": uuid.uuid4().hex,
+                    "shard": [shard_id, shard_count],
+                    "private_channels": [],
+                    "relationships": [],
+                    "_trace": ["fake-gateway"],
+                })
+                for guild_id in guilds:
+                    await dispatch("GUILD_CREATE", self._guild(guild_id))
+            elif op == RESUME:
+                await dispatch("RESUMED", {"_trace": ["fake-gateway"]})
+            elif op == REQUEST_GUILD_MEMBERS:
+                await dispatch("GUILD_MEMBERS_CHUNK", {
+                    "guild_id": data["guild_id"], "members": [], "chunk_index": 0, "chunk_count": 1,
+                    "nonce": data.get("nonce"),
+                })
+        return ws
@@ -0,0 +1,164 @@
+# Inter-cluster communication
+import asyncio
+import itertools
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+LINE_LIMIT = 2 ** 20  # The longest message (one JSON document per line) either side will read.
+
+
+class IPCError(Exception):
+    """Raised when a message can't be delivered, or a cluster can't be reached."""
+
+
+def encode(message: dict) -> bytes:
+    """
+    Encodes a message as one line of JSON.
+
+    :param message: The message
+    :return: bytes
+    """
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+class IPCClient:
+    """
+    A cluster's connection to the launcher.
+
+    The launcher sends requests ({"op": "request", "id", "command", "args"}), which are run by the handler registered
+    for the command and answered with {"op": "response", "id", "data"} (or "error"). A cluster can also ask the launcher
+    to run a command on every cluster, itself included, with broadcast().
+    """
+
+    def __init__(self, bot, cluster_id: int, host: str, port: int, *, secret: str, timeout: float = 10):
+        """
+        :param bot: The cluster's ChipBot
+        :param cluster_id: This cluster's ID
+        :param host: The launcher's host
+        :param port: The launcher's port
+        :param secret: The launcher's secret, which the launcher gave this cluster when starting it.
+        :param timeout: How long to wait for a broadcast's results, in seconds.
+        """
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.timeout = timeout
+        self.handlers = {"stats": self._stats, "reload": self._reload, "shutdown": self._shutdown}
+        self._ids = itertools.count()
+        self._waiting = {}  # request ID -> Future
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._closed = asyncio.Event()
+
+    def add_handler(self, command: str, handler) -> None:
+        """
+        Registers (or replaces) the coroutine function that answers a command. It's called with the request's args
+        as keyword arguments, and must return something JSON-serialisable.
+
+        :param command: The command's name
+        :param handler: The coroutine function
+        :return: None
+        """
+        self.handlers[command] = handler
+
+    async def connect(self) -> None:
+        """Connects to the launcher and identifies as this cluster."""
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=LINE_LIMIT)
+        self._writer.write(encode({"op": "identify", "cluster": self.cluster_id, "secret": self.secret}))
+        await self._writer.drain()
+        self._task = asyncio.get_event_loop().create_task(self._read())
+        logger.debug("Cluster %s connected to the launcher at %s:%s.", self.cluster_id, self.host, self.port)
+
+    async def wait_closed(self) -> None:
+        """Waits until the connection to the launcher is closed (or lost)."""
+        await self._closed.wait()
+
+    async def broadcast(self, command: str, **args) -> dict:
+        """
+        Runs a command on every cluster, and collects the results.
+
+        :param command: The command to run
+        :param args: The command's arguments
+        :return: dict - cluster ID (as a str) -> {"data": result} or {"error": reason}
+        :raises IPCError: If the launcher can't be reached, or doesn't answer in time.
+        """
+        if self._writer is None or self._closed.is_set():
+            raise IPCError("Not connected to the launcher.")
+        request_id = next(self._ids)
+        future = self._waiting[request_id] = asyncio.get_event_loop().create_future()
+        try:
+            self._writer.write(encode({"op": "broadcast", "id": request_id, "command": command, "args": args}))
+            await self._writer.drain()
+            # The launcher gives up on slow clusters after `timeout`, so allow a little longer than that here.
+            return await asyncio.wait_for(future, self.timeout + 5)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            raise IPCError(f"Failed to broadcast {command}: {e!r}") from e
+        finally:
+            self._waiting.pop(request_id, None)
+
+    async def close(self) -> None:
+        """Closes the connection to the launcher."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._closed.set()
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message["op"] == "request":
+                    asyncio.get_event_loop().create_task(self._answer(message))
+                elif message["op"] == "response":
+                    future = self._waiting.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message["data"])
+        except (ConnectionError, ValueError) as e:
+            logger.error("Lost the connection to the launcher.", exc_info=e)
+        finally:
+            self._closed.set()
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("The launcher closed the connection."))
+
+    async def _answer(self, message: dict):
+        command = message["command"]
+        handler = self.handlers.get(command)
+        if handler is None:
+            response = {"op": "response", "id": message["id"], "error": f"Unknown command {command!r}."}
+        else:
+            try:
+                response = {"op": "response", "id": message["id"], "data": await handler(**message.get("args", {}))}
+            except Exception as e:
+                logger.error("Failed to handle IPC command %s.", command, exc_info=e)
+                response = {"op": "response", "id": message["id"], "error": repr(e)}
+        if self._writer is None:
+            return
+        try:
+            self._writer.write(encode(response))
+            await self._writer.drain()
+        except ConnectionError as e:
+            logger.warning("Couldn't answer IPC command %s.", command, exc_info=e)
+        if command == "shutdown":
+            # Only once the launcher knows we got the message - otherwise it'd wait for us until it times out.
+            await self.bot.close()
+
+    async def _stats(self):
+        return self.bot.cluster_stats()
+
+    async def _reload(self, extensions: list = None, changed: bool = False):
+        return await self.bot.reload_extensions(extensions, changed=changed)
+
+    async def _shutdown(self):
+        return True
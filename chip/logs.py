@@ -0,0 +1,77 @@
+# Logging setup
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+FORMAT = "%(asctime)s:%(levelname)s:%(name)s: %(message)s"
+
+_installed = None  # (QueueHandler, QueueListener) from the last setup_logging call
+
+
+class SizedTimedRotatingFileHandler(RotatingFileHandler):
+    """
+    A RotatingFileHandler that also rotates once the current file is older than a given interval.
+
+    Backups are numbered like RotatingFileHandler's (chip.log.1, chip.log.2, ...), whichever limit triggers them.
+    """
+
+    def __init__(self, filename: str, *, max_bytes: int = 0, interval: float = 0, backup_count: int = 5,
+                 encoding: str = "utf-8"):
+        """
+        :param filename: The file to log to
+        :param max_bytes: Rotate once the file reaches this size. 0 disables size-based rotation.
+        :param interval: Rotate once the file is this many seconds old. 0 disables time-based rotation.
+        :param backup_count: How many old files to keep. Must be at least 1.
+        :param encoding: The file's encoding
+        """
+        if backup_count < 1:
+            raise ValueError("backup_count must be at least 1.")
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True)
+        self.interval = interval
+        started = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self.rollover_at = started + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return 1
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+def setup_logging(config: dict) -> QueueListener:
+    """
+    Sends everything logged under the "chip" logger through a queue to a rotating file, written from a background
+    thread, so logging never does disk I/O on the event loop.
+
+    Calling this again replaces the previous setup.
+
+    :param config: The "logging" section of the config.
+    :return: QueueListener - the (started) listener. Stop it on shutdown to flush the queue.
+    """
+    global _installed
+    root = logging.getLogger("chip")
+    if _installed is not None:
+        root.removeHandler(_installed[0])
+        _installed[1].stop()
+
+    handler = SizedTimedRotatingFileHandler(
+        config.get("file", "chip.log"),
+        max_bytes=config.get("max_bytes", 10 * 1024 * 1024),
+        interval=config.get("rotate_every", 24 * 60 * 60),
+        backup_count=config.get("backup_count", 5),
+    )
+    handler.setFormatter(logging.Formatter(FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    queue_handler = QueueHandler(log_queue)
+
+    root.setLevel(config.get("level", "INFO"))
+    root.addHandler(queue_handler)
+    listener.start()
+    _installed = (queue_handler, listener)
+    return listener
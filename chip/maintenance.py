@@ -0,0 +1,189 @@
+# Scheduled upkeep
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# task -> (statement, config key for its cadence, default cadence in seconds). A cadence of 0 disables the task.
+TASKS = {
+    "optimize": ("PRAGMA optimize;", "optimize_every", 3600),
+    "analyze": ("ANALYZE;", "analyze_every", 604800),
+    "vacuum": ("PRAGMA incremental_vacuum({pages});", "vacuum_every", 3600),
+    "checkpoint": ("PRAGMA wal_checkpoint({checkpoint_mode});", "checkpoint_every", 300),
+}
+
+
+class MaintenanceRun:
+    """
+    One run of a maintenance task.
+    """
+
+    __slots__ = ("task", "started_at", "seconds", "result", "error")
+
+    def __init__(self, task: str, started_at: float, seconds: float, result=None, error: Exception = None):
+        self.task = task
+        self.started_at = started_at  # UNIX timestamp
+        self.seconds = seconds
+        self.result = result
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {name: repr(self.error) if name == "error" and self.error else getattr(self, name)
+                for name in self.__slots__}
+
+
+class MaintenanceService:
+    """
+    Keeps the database (and the bot's in-memory caches) in shape, from a background task on the bot's loop.
+
+    Every tick, expired entries are swept from the caches. Database tasks - PRAGMA optimize, ANALYZE, incremental
+    vacuum and WAL checkpoints - each have their own cadence, and only run once they're due *and* traffic is low: fewer
+    than quiet_events gateway events per second since the last tick. A task that's been due for `overdue` times its
+    cadence runs anyway, so a busy bot still gets its upkeep. Tasks run one at a time, between other writes.
+
+    Every run is timed. The most recent database runs are kept in history, and the latest sweep in last_sweep.
+    """
+
+    def __init__(self, bot, *, tick: float = 60, quiet_events: float = 20, overdue: float = 3, pages: int = 1000,
+                 checkpoint_mode: str = "PASSIVE", analysis_limit: int = 1000, cadences: dict = None,
+                 keep: int = 50):
+        """
+        :param bot: The bot
+        :param tick: How often to sweep caches and check for due tasks, in seconds.
+        :param quiet_events: The most gateway events per second that still counts as low traffic.
+        :param overdue: How many times its cadence a task can wait for low traffic before it runs anyway.
+        :param pages: How many free pages each incremental vacuum hands back.
+        :param checkpoint_mode: PASSIVE, FULL, RESTART or TRUNCATE.
+        :param analysis_limit: Rows sampled per index by optimize and analyze. 0 means no limit.
+        :param cadences: Optional[dict] - task -> seconds between runs, overriding TASKS' defaults. 0 disables a task.
+        :param keep: How many runs to keep in history.
+        """
+        if checkpoint_mode.upper() not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            raise ValueError(f"Unknown checkpoint mode {checkpoint_mode!r}.")
+        self.bot = bot
+        self.tick = tick
+        self.quiet_events = quiet_events
+        self.overdue = overdue
+        self.pages = int(pages)
+        self.checkpoint_mode = checkpoint_mode.upper()
+        self.analysis_limit = int(analysis_limit)
+        self.cadences = {task: default for task, (_, _, default) in TASKS.items()}
+        self.cadences.update(cadences or {})
+        self.history = deque(maxlen=keep)
+        self.last_sweep = None
+        # Models' identity maps aren't swept: they have no TTL (every write keeps them current), only a size limit.
+        self.sweepers = {"prefixes": bot.prefix_cache.sweep}
+        self._last = {task: time.monotonic() for task in TASKS}  # Nothing is due straight after startup.
+        self._events = 0
+        self._events_at = time.monotonic()
+        self._task = None
+        self._vacuum_enabled = None
+
+    def add_sweeper(self, name: str, sweeper) -> None:
+        """
+        Registers something to be swept every tick.
+
+        :param name: What it is, for the history
+        :param sweeper: A callable removing expired entries and returning how many it removed.
+        :return: None
+        """
+        self.sweepers[name] = sweeper
+
+    def start(self) -> None:
+        """Starts the maintenance task."""
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._run())
+
+    def stop(self) -> None:
+        """Stops the maintenance task."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def due(self) -> list:
+        """
+        :return: list - the tasks whose cadence has passed, whether or not traffic is low.
+        """
+        now = time.monotonic()
+        return [task for task, cadence in self.cadences.items() if cadence and now - self._last[task] >= cadence]
+
+    def event_rate(self) -> float:
+        """Gateway events per second since this was last called."""
+        events = sum(self.bot.metrics.events.values())
+        now = time.monotonic()
+        rate = (events - self._events) / max(now - self._events_at, 1e-6)
+        self._events, self._events_at = events, now
+        return rate
+
+    def sweep(self) -> MaintenanceRun:
+        """
+        Sweeps expired entries from every registered cache.
+
+        :return: MaintenanceRun - result is cache -> entries removed.
+        """
+        started_at, start = time.time(), time.perf_counter()
+        removed = {}
+        for name, sweeper in self.sweepers.items():
+            try:
+                removed[name] = sweeper()
+            except Exception as e:
+                logger.error("Failed to sweep %s.", name, exc_info=e)
+        self.last_sweep = MaintenanceRun("sweep", started_at, time.perf_counter() - start, removed)
+        return self.last_sweep
+
+    async def run_task(self, task: str) -> MaintenanceRun:
+        """
+        Runs one database task now, whether it's due or not.
+
+        :param task: optimize, analyze, vacuum or checkpoint
+        :return: MaintenanceRun
+        """
+        statement = TASKS[task][0].format(pages=self.pages, checkpoint_mode=self.checkpoint_mode)
+        database = self.bot.database
+        started_at, start = time.time(), time.perf_counter()
+        self._last[task] = time.monotonic()
+        try:
+            if task == "vacuum" and not await self._can_vacuum():
+                return self._record(MaintenanceRun(task, started_at, 0.0, "skipped: auto_vacuum isn't INCREMENTAL"))
+            if task in ("optimize", "analyze") and self.analysis_limit:
+                await database.run_exclusive(f"PRAGMA analysis_limit={self.analysis_limit};")
+            result = await database.run_exclusive(statement)
+        except Exception as e:
+            logger.error("Maintenance task %s failed.", task, exc_info=e)
+            return self._record(MaintenanceRun(task, started_at, time.perf_counter() - start, error=e))
+        rows = [tuple(row) for row in result]
+        run = self._record(MaintenanceRun(task, started_at, time.perf_counter() - start, rows))
+        logger.info("Ran %s in %.1fms.", task, run.seconds * 1000)
+        return run
+
+    async def _can_vacuum(self) -> bool:
+        if self._vacuum_enabled is None:
+            mode = (await self.bot.database.run_exclusive("PRAGMA auto_vacuum;"))[0][0]
+            self._vacuum_enabled = mode == 2
+            if not self._vacuum_enabled:
+                logger.info(
+                    "Incremental vacuum is off: the database was created without auto_vacuum=INCREMENTAL. Run "
+                    "\"PRAGMA auto_vacuum=INCREMENTAL; VACUUM;\" on it (with the bot stopped) to turn it on."
+                )
+        return self._vacuum_enabled
+
+    def _record(self, run: MaintenanceRun) -> MaintenanceRun:
+        self.history.append(run)
+        return run
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self.sweep()
+                if self.bot.database is None:
+                    continue
+                quiet = self.event_rate() < self.quiet_events
+                now = time.monotonic()
+                for task in self.due():
+                    if quiet or now - self._last[task] >= self.cadences[task] * self.overdue:
+                        await self.run_task(task)
+            except Exception as e:
+                logger.error("Maintenance tick failed.", exc_info=e)
@@ -0,0 +1,270 @@
+# Moderation message cache
+import logging
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+DISCORD_EPOCH = 1420070400000  # ms
+
+
+class CachedMessage:
+    """
+    The parts of a message moderation needs, and nothing else - no embeds, member objects or references to the
+    channel or guild.
+    """
+
+    __slots__ = ("id", "guild_id", "channel_id", "author_id", "content", "attachments", "edited_at", "size")
+
+    def __init__(self, id: int, guild_id: int, channel_id: int, author_id: int, content: str,
+                 attachments: tuple = (), edited_at: float = None):
+        self.id = id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.content = content
+        self.attachments = attachments  # attachment URLs
+        self.edited_at = edited_at
+        self.size = _RECORD_SIZE + sys.getsizeof(content) + sum(map(sys.getsizeof, attachments))
+
+    @property
+    def created_at(self) -> float:
+        """When the message was sent, as a UNIX timestamp. Worked out from its ID, so it isn't stored."""
+        return ((self.id >> 22) + DISCORD_EPOCH) / 1000
+
+    @classmethod
+    def from_message(cls, message) -> "CachedMessage":
+        """
+        Copies what's needed out of a discord.Message.
+
+        :param message: discord.Message
+        :return: CachedMessage
+        """
+        return cls(
+            message.id,
+            message.guild.id,
+            message.channel.id,
+            message.author.id,
+            message.content,
+            tuple(attachment.url for attachment in message.attachments),
+            _timestamp(message.edited_at),
+        )
+
+    def __repr__(self):
+        return f"<CachedMessage id={self.id} guild_id={self.guild_id} author_id={self.author_id}>"
+
+
+def _timestamp(when: datetime):
+    # discord.py's datetimes are naive, but in UTC.
+    return when.replace(tzinfo=timezone.utc).timestamp() if when is not None else None
+
+
+# The record itself, its ints, and its entry in the per-guild dict. An estimate, but a consistent one.
+_RECORD_SIZE = sys.getsizeof(object()) + 8 * len(CachedMessage.__slots__) + 4 * sys.getsizeof(2 ** 62) + 100
+
+
+class MessageCache:
+    """
+    A cache of recent guild messages for moderation (deleted and edited message logs), bounded by memory rather than
+    by message count.
+
+    Each guild's messages are kept oldest first. When the cache goes over budget, messages are evicted from whichever
+    guild is using the most memory, so a busy guild only ever pushes out its own history, not everyone else's.
+    Eviction runs down to slightly under the budget, so it happens in batches instead of on every message.
+
+    Once listen() is called, the cache keeps itself up to date from gateway events, and dispatches
+    cached_message_edit(before, after) and cached_message_delete(message) events with the records, for moderation logs.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, *, slack: float = 0.05, ignore_bots: bool = True):
+        """
+        :param max_bytes: The (estimated) memory budget, in bytes.
+        :param slack: How far under the budget to evict to, as a fraction of it.
+        :param ignore_bots: Whether to skip messages sent by bots.
+        """
+        self.max_bytes = max_bytes
+        self.slack = slack
+        self.ignore_bots = ignore_bots
+        self.bot = None
+        self.bytes = 0
+        self.evicted = 0
+        self._count = 0
+        self._guilds = {}  # guild ID -> OrderedDict of message ID -> CachedMessage
+        self._sizes = {}  # guild ID -> bytes
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def stats(self) -> dict:
+        """How full the cache is, and how much it has evicted."""
+        return {
+            "messages": self._count,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "guilds": len(self._guilds),
+            "evicted": self.evicted,
+        }
+
+    def usage(self, guild_id: int) -> tuple:
+        """
+        How much of the cache a guild is using.
+
+        :param guild_id: The guild
+        :return: tuple - (messages, bytes)
+        """
+        return len(self._guilds.get(guild_id, ())), self._sizes.get(guild_id, 0)
+
+    def add(self, message) -> CachedMessage:
+        """
+        Caches a guild message.
+
+        :param message: discord.Message (or a CachedMessage)
+        :return: CachedMessage - the record that was stored.
+        """
+        record = message if isinstance(message, CachedMessage) else CachedMessage.from_message(message)
+        guild = self._guilds.get(record.guild_id)
+        if guild is None:
+            guild = self._guilds[record.guild_id] = OrderedDict()
+            self._sizes[record.guild_id] = 0
+        old = guild.pop(record.id, None)
+        if old is not None:
+            self._account(record.guild_id, -old.size, -1)
+        guild[record.id] = record
+        self._account(record.guild_id, record.size, 1)
+        if self.bytes > self.max_bytes:
+            self._evict()
+        return record
+
+    def get(self, guild_id: int, message_id: int):
+        """
+        :return: Optional[CachedMessage]
+        """
+        guild = self._guilds.get(guild_id)
+        return guild.get(message_id) if guild is not None else None
+
+    def pop(self, guild_id: int, message_id: int):
+        """
+        Removes a message, e.g. because it was deleted.
+
+        :return: Optional[CachedMessage] - the message, if it was cached.
+        """
+        guild = self._guilds.get(guild_id)
+        record = guild.pop(message_id, None) if guild is not None else None
+        if record is not None:
+            self._account(guild_id, -record.size, -1)
+            if not guild:
+                del self._guilds[guild_id]
+                del self._sizes[guild_id]
+        return record
+
+    def edit(self, guild_id: int, message_id: int, content: str, edited_at: float):
+        """
+        Records an edit to a cached message. The stored record is replaced, not changed, so the old one can still be
+        used to show what the message said before.
+
+        :param guild_id: The message's guild
+        :param message_id: The message's ID
+        :param content: Its new content
+        :param edited_at: When it was edited, as a UNIX timestamp
+        :return: Optional[tuple] - (before, after), if the message was cached.
+        """
+        before = self.get(guild_id, message_id)
+        if before is None:
+            return None
+        after = CachedMessage(before.id, guild_id, before.channel_id, before.author_id, content, before.attachments,
+                              edited_at)
+        self._guilds[guild_id][message_id] = after  # Keeps its place in the eviction order.
+        self._account(guild_id, after.size - before.size, 0)
+        if self.bytes > self.max_bytes:
+            self._evict()
+        return before, after
+
+    def drop_guild(self, guild_id: int) -> None:
+        """Forgets every message from a guild, e.g. after leaving it."""
+        guild = self._guilds.pop(guild_id, None)
+        if guild is not None:
+            self.bytes -= self._sizes.pop(guild_id)
+            self._count -= len(guild)
+
+    def clear(self) -> None:
+        """Forgets everything."""
+        self._guilds.clear()
+        self._sizes.clear()
+        self.bytes = self._count = 0
+
+    def _account(self, guild_id: int, size: int, count: int):
+        self._sizes[guild_id] += size
+        self.bytes += size
+        self._count += count
+
+    def _evict(self):
+        # Trims the biggest guilds down to a shared water level, oldest messages first: the highest level at which
+        # cutting every guild above it frees enough bytes. One sort per eviction, then one pass over what's evicted.
+        excess = self.bytes - self.max_bytes * (1 - self.slack)
+        sizes = sorted(self._sizes.values(), reverse=True)
+        level = 0
+        above = 0  # bytes held by the guilds above the next one's size
+        for count, size in enumerate(sizes, 1):
+            above += size
+            following = sizes[count] if count < len(sizes) else 0
+            if above - count * following >= excess:
+                level = (above - excess) / count
+                break
+        evicted = self.evicted
+        for guild_id in [guild_id for guild_id, size in self._sizes.items() if size > level]:
+            guild = self._guilds[guild_id]
+            while guild and self._sizes[guild_id] > level:
+                _, record = guild.popitem(last=False)
+                self._account(guild_id, -record.size, -1)
+                self.evicted += 1
+            if not guild:
+                del self._guilds[guild_id]
+                del self._sizes[guild_id]
+        logger.debug("Evicted %d cached messages, down to %d bytes.", self.evicted - evicted, self.bytes)
+
+    def listen(self, bot) -> None:
+        """
+        Keeps the cache up to date from the bot's events.
+
+        :param bot: The bot
+        :return: None
+        """
+        self.bot = bot
+        for event in ("message", "raw_message_edit", "raw_message_delete", "raw_bulk_message_delete", "guild_remove"):
+            bot.add_listener(getattr(self, "on_" + event))
+
+    async def on_message(self, message):
+        if message.guild is not None and not (self.ignore_bots and message.author.bot):
+            self.add(message)
+
+    async def on_raw_message_edit(self, payload):
+        content = payload.data.get("content")
+        if payload.guild_id is None or content is None:  # e.g. only the embeds changed
+            return
+        edited_at = payload.data.get("edited_timestamp")
+        edited_at = _timestamp(discord.utils.parse_time(edited_at)) if edited_at else time.time()
+        found = self.edit(payload.guild_id, payload.message_id, content, edited_at)
+        if found is not None and found[0].content != content:
+            self.bot.dispatch("cached_message_edit", *found)
+
+    async def on_raw_message_delete(self, payload):
+        if payload.guild_id is not None:
+            record = self.pop(payload.guild_id, payload.message_id)
+            if record is not None:
+                self.bot.dispatch("cached_message_delete", record)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        if payload.guild_id is None:
+            return
+        for message_id in payload.message_ids:
+            record = self.pop(payload.guild_id, message_id)
+            if record is not None:
+                self.bot.dispatch("cached_message_delete", record)
+
+    async def on_guild_remove(self, guild):
+        self.drop_guild(guild.id)
@@ -0,0 +1,139 @@
+# Instrumentation
+import os
+import re
+from collections import Counter, deque
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class Histogram:
+    """
+    Latency samples for one thing being timed.
+
+    The count, sum and maximum are exact. Percentiles are taken from the most recent samples only, so memory stays
+    fixed and they reflect current behaviour rather than the whole uptime.
+    """
+
+    __slots__ = ("count", "total", "max", "_samples")
+
+    def __init__(self, size: int = 1024):
+        """
+        :param size: How many recent samples to keep for percentiles.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=size)
+
+    def observe(self, value: float) -> None:
+        """Records one sample, in seconds."""
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self._samples.append(value)
+
+    def percentiles(self, *quantiles: float) -> tuple:
+        """
+        Computes percentiles over the recent samples.
+
+        :param quantiles: The percentiles to compute, e.g. 50, 95, 99
+        :return: tuple - one value (in seconds) per quantile. All 0 if nothing has been recorded.
+        """
+        if not self._samples:
+            return tuple(0.0 for _ in quantiles)
+        ordered = sorted(self._samples)
+        last = len(ordered) - 1
+        return tuple(ordered[min(last, int(len(ordered) * q / 100))] for q in quantiles)
+
+
+class Metrics:
+    """
+    Collects command latencies, query latencies and gateway event counts for the whole bot.
+    """
+
+    def __init__(self, *, samples: int = 1024):
+        """
+        :param samples: How many recent samples each histogram keeps for percentiles.
+        """
+        self.samples = samples
+        self.commands = {}
+        self.queries = {}
+        self.events = Counter()
+        self.gauges = {}  # metric name -> callable returning its current value
+        self._query_names = {}
+
+    def _histogram(self, table: dict, name: str) -> Histogram:
+        histogram = table.get(name)
+        if histogram is None:
+            histogram = table[name] = Histogram(self.samples)
+        return histogram
+
+    def time_command(self, name: str, seconds: float) -> None:
+        """Records how long an invocation of a command took."""
+        self._histogram(self.commands, name).observe(seconds)
+
+    def time_query(self, query: str, seconds: float) -> None:
+        """Records how long a query took. Queries are grouped by their (whitespace-normalised) SQL."""
+        name = self._query_names.get(query)
+        if name is None:
+            # Statements are parametrised and cached, so there's a small, fixed set of these.
+            name = self._query_names[query] = _WHITESPACE.sub(" ", query).strip()
+        self._histogram(self.queries, name).observe(seconds)
+
+    def count_event(self, name: str) -> None:
+        """Counts one dispatched event."""
+        self.events[name] += 1
+
+    def add_gauge(self, name: str, getter) -> None:
+        """
+        Registers a gauge, whose value is read when rendering. Reading it should be cheap.
+
+        :param name: The metric's name, e.g. chip_guilds
+        :param getter: A callable returning the current value
+        :return: None
+        """
+        self.gauges[name] = getter
+
+    def render_prometheus(self) -> str:
+        """
+        Renders everything in the Prometheus text exposition format.
+
+        :return: str
+        """
+        lines = []
+        for metric, label, table in (
+            ("chip_command_seconds", "command", self.commands),
+            ("chip_query_seconds", "query", self.queries),
+        ):
+            lines.append(f"# TYPE {metric} summary")
+            for name, histogram in table.items():
+                name = name.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+                for q, value in zip((0.5, 0.95, 0.99), histogram.percentiles(50, 95, 99)):
+                    lines.append(f'{metric}{{{label}="{name}",quantile="{q}"}} {value:.6f}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.total:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+        lines.append("# TYPE chip_events_total counter")
+        for name, count in self.events.items():
+            lines.append(f'chip_events_total{{event="{name}"}} {count}')
+        for name, getter in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {getter()}")
+        return "\n".join(lines) + "\n"
+
+
+def write_atomically(path: str, text: str) -> None:
+    """
+    Writes text to a file atomically, so a scraper never reads half a file.
+
+    This does blocking I/O - run it in an executor. Render the text on the loop first (see
+    Metrics.render_prometheus): the loop keeps updating the metrics while this runs.
+
+    :param path: The file to write
+    :param text: What to write
+    :return: None
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(temporary, path)
@@ -0,0 +1,287 @@
+# Mod-log delivery
+import asyncio
+import logging
+import time
+from collections import deque
+
+import aiohttp
+import discord
+from discord.http import Route
+
+from .sql import Guild
+
+logger = logging.getLogger(__name__)
+
+MAX_EMBEDS = 10  # per message
+MAX_EMBED_CHARACTERS = 6000  # across every embed in a message
+MAX_CONTENT = 2000
+LIBRARY_RETRIES = {429, 500, 502}  # Statuses discord.py's HTTPClient.request already retries before raising.
+
+
+class TokenBucket:
+    """
+    Allows `capacity` actions at once, refilling at `rate` per second.
+    """
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Waits until an action is allowed, and takes it."""
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+    def drain(self) -> None:
+        """Empties the bucket, e.g. after being rate limited anyway."""
+        self._refill()
+        self.tokens = 0
+
+
+class _ChannelQueue:
+    __slots__ = ("channel_id", "entries", "bucket", "task")
+
+    def __init__(self, channel_id: int, bucket: TokenBucket):
+        self.channel_id = channel_id
+        self.entries = deque()  # (content, embed) - one of them is None
+        self.bucket = bucket
+        self.task = None
+
+
+class ModLogDispatcher:
+    """
+    Delivers mod-log entries, queued per channel.
+
+    An entry doesn't go out on its own: a channel's queue waits `window` seconds after its first entry, and then sends
+    everything that piled up in as few messages as possible - up to 10 embeds, or 2000 characters of lines, each. While
+    a channel is rate limited, entries keep piling up and are merged into the next message, so a raid's worth of bans
+    becomes a handful of requests instead of hundreds.
+
+    Each channel has a token bucket matching Discord's per-channel message limit, so sends wait their turn instead of
+    running into 429s. discord.py already retries 429s and some server errors itself; a send that fails with anything
+    it gives up on straight away - other server errors, dropped connections, timeouts - is retried with exponential
+    backoff. A channel the bot can't post in has its queue dropped. Queues are bounded; when one is full, its oldest
+    entries are dropped.
+
+    Messages are sent with `sender(channel_id, content, embeds)`, a coroutine function. It defaults to POSTing through
+    the bot's HTTP client, and can be replaced with a stub (which should handle rate limits like the HTTP client).
+    """
+
+    def __init__(self, bot, *, window: float = 1.0, max_queue: int = 1000, burst: int = 5, per: float = 5.0,
+                 retries: int = 5, backoff: float = 1.0, sender=None):
+        """
+        :param bot: The bot
+        :param window: How long to collect entries before sending, in seconds.
+        :param max_queue: How many entries a channel's queue can hold.
+        :param burst: How many messages a channel can be sent at once...
+        :param per: ...and how many seconds it takes to be able to send that many again.
+        :param retries: How many times to retry a send that failed in a way discord.py doesn't retry itself.
+        :param backoff: How long to wait before the first retry, in seconds. Doubles with each retry.
+        :param sender: Optional[Callable] - A coroutine function taking (channel_id, content, embeds).
+        """
+        self.bot = bot
+        self.window = window
+        self.max_queue = max_queue
+        self.burst = burst
+        self.per = per
+        self.retries = retries
+        self.backoff = backoff
+        self.sender = sender or self._post
+        self.queued = self.sent = self.merged = self.dropped = self.retried = 0
+        self._queues = {}  # channel ID -> _ChannelQueue
+        self._closed = False
+
+    @property
+    def depth(self) -> int:
+        """How many entries are waiting to be sent, across every channel."""
+        return sum(len(queue.entries) for queue in self._queues.values())
+
+    @property
+    def stats(self) -> dict:
+        """Delivery counters. merged is how many entries went out in a message with an earlier entry."""
+        return {
+            "depth": self.depth,
+            "channels": len(self._queues),
+            "queued": self.queued,
+            "sent": self.sent,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "retried": self.retried,
+        }
+
+    def depths(self) -> dict:
+        """
+        :return: dict - channel ID -> how many entries are waiting, for channels with a queue.
+        """
+        return {channel_id: len(queue.entries) for channel_id, queue in self._queues.items()}
+
+    def post(self, channel_id: int, content: str = None, *, embed: discord.Embed = None) -> bool:
+        """
+        Queues an entry for a channel. Give either content (one or more lines) or an embed.
+
+        :param channel_id: The mod-log channel's ID
+        :param content: Optional[str] - The entry, as text.
+        :param embed: Optional[discord.Embed] - The entry, as an embed.
+        :return: bool - False if the dispatcher is closed, and the entry was dropped.
+        """
+        if (content is None) == (embed is None):
+            raise ValueError("Give exactly one of content and embed.")
+        if self._closed:
+            self.dropped += 1
+            return False
+        queue = self._queues.get(channel_id)
+        if queue is None:
+            queue = self._queues[channel_id] = _ChannelQueue(channel_id, TokenBucket(self.burst, self.burst / self.per))
+        if len(queue.entries) >= self.max_queue:
+            queue.entries.popleft()
+            self.dropped += 1
+        queue.entries.append((content[:MAX_CONTENT] if content is not None else None, embed))
+        self.queued += 1
+        if queue.task is None:
+            queue.task = self.bot.loop.create_task(self._deliver(queue))
+        return True
+
+    def listen(self, bot) -> None:
+        """
+        Logs deleted and edited messages (from the moderation message cache) to guilds' mod-log channels.
+
+        :param bot: The bot
+        :return: None
+        """
+        bot.add_listener(self.on_cached_message_delete)
+        bot.add_listener(self.on_cached_message_edit)
+
+    async def on_cached_message_delete(self, message):
+        embed = discord.Embed(title="Message deleted", description=message.content[:2048], colour=discord.Colour.red())
+        embed.add_field(name="Author", value=f"<@{message.author_id}>")
+        embed.add_field(name="Channel", value=f"<#{message.channel_id}>")
+        if message.attachments:
+            embed.add_field(name="Attachments", value="\n".join(message.attachments)[:1024], inline=False)
+        embed.set_footer(text=f"Message ID: {message.id}")
+        await self.log(message.guild_id, embed=embed)
+
+    async def on_cached_message_edit(self, before, after):
+        embed = discord.Embed(title="Message edited", colour=discord.Colour.orange())
+        embed.add_field(name="Before", value=before.content[:1024] or "\u200b", inline=False)
+        embed.add_field(name="After", value=after.content[:1024] or "\u200b", inline=False)
+        embed.add_field(name="Author", value=f"<@{after.author_id}>")
+        embed.add_field(name="Channel", value=f"<#{after.channel_id}>")
+        embed.set_footer(text=f"Message ID: {after.id}")
+        await self.log(after.guild_id, embed=embed)
+
+    async def log(self, guild_id: int, content: str = None, *, embed: discord.Embed = None) -> bool:
+        """
+        Queues an entry for a guild's mod-log channel, if it has one.
+
+        :param guild_id: The guild
+        :param content: Optional[str] - The entry, as text.
+        :param embed: Optional[discord.Embed] - The entry, as an embed.
+        :return: bool - whether the entry was queued.
+        """
+        model = await Guild.get(self.bot.database, guild_id)
+        if model is None or model.mod_log is None:
+            return False
+        return self.post(model.mod_log, content, embed=embed)
+
+    @staticmethod
+    def _batch(entries: deque) -> tuple:
+        # Takes as many entries as fit in one message, oldest first.
+        lines, embeds = [], []
+        length = characters = 0
+        while entries:
+            content, embed = entries[0]
+            if embed is not None:
+                size = len(embed)
+                if embeds and (len(embeds) == MAX_EMBEDS or characters + size > MAX_EMBED_CHARACTERS):
+                    break
+                embeds.append(embed)
+                characters += size
+            else:
+                size = len(content) + bool(lines)  # The newline joining it to the previous line.
+                if lines and length + size > MAX_CONTENT:
+                    break
+                lines.append(content)
+                length += size
+            entries.popleft()
+        return "\n".join(lines) or None, embeds, len(lines) + len(embeds)
+
+    async def _deliver(self, queue: _ChannelQueue):
+        try:
+            await asyncio.sleep(self.window)
+            while queue.entries:
+                await queue.bucket.acquire()
+                content, embeds, count = self._batch(queue.entries)
+                if await self._send(queue, content, embeds):
+                    self.sent += 1
+                    self.merged += count - 1
+                else:
+                    self.dropped += count
+        finally:
+            queue.task = None
+            if not queue.entries:
+                self._queues.pop(queue.channel_id, None)
+
+    async def _send(self, queue: _ChannelQueue, content, embeds) -> bool:
+        for attempt in range(self.retries + 1):
+            try:
+                await self.sender(queue.channel_id, content, embeds)
+                return True
+            except (discord.Forbidden, discord.NotFound) as e:
+                # Nothing else is getting through either.
+                logger.warning("Can't post to mod-log channel %s, dropping its queue.", queue.channel_id, exc_info=e)
+                self.dropped += len(queue.entries)
+                queue.entries.clear()
+                return False
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                status = getattr(e, "status", None)
+                if status == 429:
+                    queue.bucket.drain()  # Still rate limited after the HTTP client's own retries. Back off.
+                # The HTTP client has already retried these (or, for other 4xx, retrying won't help).
+                if (status is not None and (status < 500 or status in LIBRARY_RETRIES)) or attempt == self.retries:
+                    logger.error("Failed to post to mod-log channel %s.", queue.channel_id, exc_info=e)
+                    return False
+                self.retried += 1
+                delay = self.backoff * 2 ** attempt
+                logger.debug("Posting to mod-log channel %s failed (%s), retrying in %.1fs.", queue.channel_id,
+                             status or type(e).__name__, delay)
+                await asyncio.sleep(delay)
+        return False
+
+    async def _post(self, channel_id: int, content, embeds: list):
+        payload = {"allowed_mentions": {"parse": []}}
+        if content is not None:
+            payload["content"] = content
+        if embeds:
+            payload["embeds"] = [embed.to_dict() for embed in embeds]
+        route = Route("POST", "/channels/{channel_id}/messages", channel_id=channel_id)
+        await self.bot.http.request(route, json=payload)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """
+        Stops taking entries, and waits up to timeout seconds for the queues to be sent.
+
+        :param timeout: How long to wait, in seconds.
+        :return: None
+        """
+        self._closed = True
+        tasks = [queue.task for queue in self._queues.values() if queue.task is not None]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning("Gave up on %d mod-log entries at shutdown.", self.depth)
+            self.dropped += self.depth
+        for task in pending:
+            task.cancel()
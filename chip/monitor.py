@@ -0,0 +1,174 @@
+# Event loop health
+import asyncio
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class Stall:
+    """
+    One occasion where something held the event loop for longer than the threshold.
+    """
+
+    __slots__ = ("name", "duration", "stack", "when")
+
+    def __init__(self, name: str, duration: float, stack: str = None):
+        self.name = name
+        self.duration = duration
+        self.stack = stack
+        self.when = time.time()
+
+    def __lt__(self, other):
+        return self.duration < other.duration
+
+
+def describe_handle(handle) -> str:
+    """
+    Names what an asyncio Handle is about to run, e.g. the coroutine a task is stepping.
+
+    :param handle: asyncio.Handle
+    :return: str
+    """
+    callback = getattr(handle, "_callback", None)
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return "task " + getattr(coro, "__qualname__", repr(coro))
+    return getattr(callback, "__qualname__", repr(callback))
+
+
+class LoopMonitor:
+    """
+    Samples how late the event loop wakes up (its lag), and optionally traces what is blocking it.
+
+    Sampling is a single sleeping task, cheap enough to leave on. Tracing is opt-in: it times every callback the loop
+    runs, and a watchdog thread grabs the loop thread's stack while it is stuck, so each stall is recorded with the
+    name of the culprit and where it was when it was caught.
+    """
+
+    def __init__(self, *, interval: float = 0.5, threshold: float = 0.1, trace: bool = False, keep: int = 20):
+        """
+        :param interval: How often to sample the lag, in seconds.
+        :param threshold: How long (seconds) a callback may hold the loop before it counts as a stall.
+        :param trace: Whether to trace slow callbacks and capture stacks.
+        :param keep: How many of the worst (and most recent) stalls to keep.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.trace = trace
+        self.keep = keep
+        self.lag = Histogram()
+        self.recent = deque(maxlen=keep)
+        self._worst = []  # min-heap of the `keep` longest stalls
+        self._counter = itertools.count()
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+        self._last_tick = time.monotonic()
+        self._caught_stack = None
+        self._original_run = None
+
+    @property
+    def worst(self) -> list:
+        """The worst stalls seen, longest first."""
+        return sorted((stall for _, _, stall in self._worst), reverse=True)
+
+    def record(self, stall: Stall) -> None:
+        """Adds a stall to the ring buffer and, if it's bad enough, the worst offenders."""
+        self.recent.append(stall)
+        entry = (stall.duration, next(self._counter), stall)
+        if len(self._worst) < self.keep:
+            heapq.heappush(self._worst, entry)
+        elif stall.duration > self._worst[0][0]:
+            heapq.heapreplace(self._worst, entry)
+
+    def start(self, loop: asyncio.AbstractEventLoop = None) -> None:
+        """
+        Starts sampling (and tracing, if enabled). Call this from the loop's own thread.
+
+        :param loop: The loop to monitor. Defaults to the current one.
+        :return: None
+        """
+        self._loop = loop or asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._task = self._loop.create_task(self._sample())
+        if self.trace:
+            self._patch()
+            self._stopping.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="chip-loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def stop(self) -> None:
+        """Stops sampling and tracing."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._watchdog is not None:
+            self._stopping.set()
+            self._watchdog = None
+        self._unpatch()
+
+    async def _sample(self):
+        while True:
+            start = self._loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self._loop.time() - start - self.interval)
+            self.lag.observe(lag)
+            if lag > self.threshold and not self.trace:
+                # Without tracing, we at least know it happened.
+                self.record(Stall("unknown (enable tracing to identify)", lag))
+
+    def _tick(self):
+        self._last_tick = time.monotonic()
+
+    def _watch(self):
+        # Runs in its own thread. Asks the loop to tick, and if it doesn't within the threshold, it's stuck - so grab
+        # the loop thread's stack while it's still stuck.
+        while not self._stopping.wait(self.threshold / 2):
+            asked = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(self._tick)
+            except RuntimeError:  # loop closed
+                return
+            if self._stopping.wait(self.threshold):
+                return
+            if self._last_tick < asked:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._caught_stack = "".join(traceback.format_stack(frame, limit=15))
+                while self._last_tick < asked and not self._stopping.wait(self.threshold / 2):
+                    pass  # Wait for it to recover before asking again.
+
+    def _patch(self):
+        if self._original_run is not None:
+            return
+        self._original_run = original = asyncio.events.Handle._run
+        monitor = self
+
+        def _run(handle):
+            start = time.perf_counter()
+            original(handle)
+            duration = time.perf_counter() - start
+            if duration > monitor.threshold:
+                stack, monitor._caught_stack = monitor._caught_stack, None
+                name = describe_handle(handle)
+                monitor.record(Stall(name, duration, stack))
+                logger.warning("%s blocked the event loop for %.3fs.", name, duration)
+
+        asyncio.events.Handle._run = _run
+
+    def _unpatch(self):
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
@@ -0,0 +1,215 @@
+# Command prefix matching
+import logging
+import re
+from collections import Counter
+from typing import Iterable
+
+from .cache import LRUCache, MISSING
+from .sql import IN_CHUNK_SIZE, _chunks
+
+logger = logging.getLogger(__name__)
+
+# A guild's custom prefixes: the one on its guilds row, plus any in guild_prefixes.
+LOAD = (
+    "SELECT prefix FROM guilds WHERE id=? AND prefix IS NOT NULL "
+    "UNION SELECT prefix FROM guild_prefixes WHERE guild_id=?;"
+)
+LOAD_MANY = (
+    "SELECT id, prefix FROM guilds WHERE prefix IS NOT NULL AND id IN ({0}) "
+    "UNION SELECT guild_id, prefix FROM guild_prefixes WHERE guild_id IN ({0});"
+)
+
+
+class PrefixMatcher:
+    """
+    Matches message content against a fixed set of prefixes in a single pass.
+
+    The prefixes are compiled into one regular expression, longest first, so the longest matching prefix wins (with
+    "!" and "!!", "!!ban" is invoked with "!!"). Content that can't start with any prefix is rejected by looking at its
+    first character alone, which is what happens to most messages.
+    """
+
+    __slots__ = ("prefixes", "_first", "_pattern")
+
+    def __init__(self, prefixes: Iterable[str]):
+        """
+        :param prefixes: The prefixes to match. Empty ones are ignored.
+        :raises ValueError: If there are no (non-empty) prefixes.
+        """
+        self.prefixes = tuple(sorted({prefix for prefix in prefixes if prefix}, key=len, reverse=True))
+        if not self.prefixes:
+            raise ValueError("A PrefixMatcher needs at least one prefix.")
+        self._first = frozenset(prefix[0] for prefix in self.prefixes)
+        self._pattern = re.compile("|".join(map(re.escape, self.prefixes)))
+
+    def match(self, content: str):
+        """
+        Finds which prefix content starts with.
+
+        :param content: The message content
+        :return: Optional[str] - the (longest) matching prefix, or None.
+        """
+        if not content or content[0] not in self._first:
+            return None
+        found = self._pattern.match(content)
+        return found.group() if found else None
+
+    def __repr__(self):
+        return f"<PrefixMatcher prefixes={self.prefixes!r}>"
+
+
+class PrefixResolver:
+    """
+    Resolves the prefix a message was sent with, using a compiled PrefixMatcher per guild.
+
+    A guild's matcher covers its custom prefixes (if custom prefixes are allowed), the bot's mention forms (if
+    mentions are a prefix) and - for guilds without custom prefixes, or if keep_defaults is set - the default
+    prefixes. Matchers are cached per guild, and dropped with invalidate() when a guild's prefixes change.
+
+    Use get_prefix as the bot's command_prefix.
+    """
+
+    def __init__(self, bot, defaults: Iterable[str], *, mention: bool = True, custom: bool = True,
+                 keep_defaults: bool = False, max_size: int = 10000, ttl: float = None):
+        """
+        :param bot: The bot
+        :param defaults: The default prefixes
+        :param mention: Whether mentioning the bot works as a prefix.
+        :param custom: Whether guilds can have custom prefixes.
+        :param keep_defaults: Whether the defaults still work in guilds with custom prefixes.
+        :param max_size: How many guilds' matchers to cache.
+        :param ttl: Optional[float] - How long to cache a matcher for, in seconds.
+        """
+        self.bot = bot
+        self.defaults = (defaults,) if isinstance(defaults, str) else tuple(defaults)
+        self.mention = mention
+        self.custom = custom
+        self.keep_defaults = keep_defaults
+        self.cache = LRUCache(max_size, ttl)  # guild ID -> PrefixMatcher
+        self._default_matcher = None
+        # A load that was running when its guild was invalidated read the old prefixes, so it mustn't be cached.
+        # invalidate() bumps the generation; loads note it before querying, and compare afterwards.
+        self._generation = 0
+        self._cleared = 0  # The generation of the last invalidate-everything.
+        self._loading = Counter()  # guild ID -> loads in flight
+        self._invalidated = {}  # guild ID -> the generation it was last invalidated at, for guilds being loaded
+
+    def _mentions(self) -> tuple:
+        if not self.mention or self.bot.user is None:
+            return ()
+        return f"<@{self.bot.user.id}> ", f"<@!{self.bot.user.id}> "
+
+    def _cacheable(self) -> bool:
+        # Until the bot has logged in, its mention forms aren't known, so a matcher built now would be incomplete.
+        return not self.mention or self.bot.user is not None
+
+    def compile(self, custom: Iterable[str] = ()) -> PrefixMatcher:
+        """
+        Compiles the matcher for a guild with the given custom prefixes.
+
+        :param custom: The guild's custom prefixes
+        :return: PrefixMatcher
+        """
+        custom = tuple(custom) if self.custom else ()
+        if not custom:
+            if self._default_matcher is None:
+                matcher = PrefixMatcher((*self.defaults, *self._mentions()))
+                if not self._cacheable():
+                    return matcher
+                self._default_matcher = matcher
+            return self._default_matcher
+        return PrefixMatcher((*custom, *self._mentions(), *(self.defaults if self.keep_defaults else ())))
+
+    def invalidate(self, guild_id: int = None) -> None:
+        """
+        Forgets a guild's matcher, or every matcher.
+
+        :param guild_id: Optional[int] - The guild whose prefixes changed. Defaults to all of them.
+        :return: None
+        """
+        self._generation += 1
+        if guild_id is None:
+            self.cache.clear()
+            self._default_matcher = None
+            self._cleared = self._generation
+        else:
+            self.cache.invalidate(guild_id)
+            if guild_id in self._loading:
+                self._invalidated[guild_id] = self._generation
+
+    def _begin(self, guild_ids: Iterable[int]) -> int:
+        self._loading.update(guild_ids)
+        return self._generation
+
+    def _finish(self, guild_ids: Iterable[int], generation: int) -> set:
+        # Returns the guilds that were invalidated since the load began.
+        stale = set()
+        for guild_id in guild_ids:
+            if self._cleared > generation or self._invalidated.get(guild_id, 0) > generation:
+                stale.add(guild_id)
+            self._loading[guild_id] -= 1
+            if self._loading[guild_id] <= 0:
+                del self._loading[guild_id]
+                self._invalidated.pop(guild_id, None)
+        return stale
+
+    async def matcher_for(self, guild_id: int) -> PrefixMatcher:
+        """
+        Gets a guild's matcher, loading its custom prefixes if it isn't cached.
+
+        :param guild_id: The guild's ID
+        :return: PrefixMatcher
+        """
+        matcher = self.cache.get(guild_id)
+        if matcher is MISSING:
+            custom = ()
+            stale = False
+            if self.custom:
+                generation = self._begin((guild_id,))
+                try:
+                    async with self.bot.database.execute(LOAD, (guild_id, guild_id)) as cursor:
+                        custom = [row[0] for row in await cursor.fetchall()]
+                finally:
+                    stale = bool(self._finish((guild_id,), generation))
+                logger.debug("Got prefixes %s for guild '%s'.", custom, guild_id)
+            matcher = self.compile(custom)
+            if self._cacheable() and not stale:
+                self.cache.set(guild_id, matcher)
+        return matcher
+
+    async def warm(self, guild_ids: list) -> None:
+        """
+        Compiles matchers for many guilds at once, with as few queries as possible.
+
+        :param guild_ids: The guilds to compile matchers for
+        :return: None
+        """
+        guild_ids = list(guild_ids)
+        custom = {}
+        stale = set()
+        if self.custom:
+            generation = self._begin(guild_ids)
+            try:
+                for chunk in _chunks(guild_ids, IN_CHUNK_SIZE):
+                    query = LOAD_MANY.format(", ".join("?" * len(chunk)))
+                    async with self.bot.database.execute(query, (*chunk, *chunk)) as cursor:
+                        for guild_id, prefix in await cursor.fetchall():
+                            custom.setdefault(guild_id, []).append(prefix)
+            finally:
+                stale = self._finish(guild_ids, generation)
+        for guild_id in guild_ids:
+            if guild_id not in stale:
+                self.cache.set(guild_id, self.compile(custom.get(guild_id, ())))
+
+    async def get_prefix(self, bot, message):
+        """
+        The bot's command_prefix.
+
+        Returns the prefix the message starts with. discord.py doesn't accept "no prefix", so when nothing matches,
+        this returns one of the prefixes that was checked - which, having been checked, won't match either.
+        """
+        if message.guild is None:
+            matcher = self.compile()
+        else:
+            matcher = await self.matcher_for(message.guild.id)
+        return matcher.match(message.content) or matcher.prefixes[-1]
@@ -0,0 +1,42 @@
+# Startup profiling
+import time
+
+
+class StartupProfile:
+    """
+    Records how long each phase of startup took, as a sequence of marks.
+    """
+
+    def __init__(self, started: float = None):
+        """
+        :param started: Optional[float] - The time.perf_counter() value startup began at. Defaults to now.
+        """
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = []  # (name, seconds)
+        self._last = self.started
+
+    def mark(self, phase: str) -> None:
+        """
+        Ends a phase, timing it from the previous mark.
+
+        :param phase: The name of the phase that just finished
+        :return: None
+        """
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        """
+        Renders the phases as a small table, with each phase's share of the total.
+
+        :return: str
+        """
+        total = self._last - self.started
+        width = max((len(name) for name, _ in self.phases), default=5)
+        lines = [f"{'phase':<{width}}  {'ms':>9}  share"]
+        for name, seconds in self.phases:
+            share = seconds / total if total else 0
+            lines.append(f"{name:<{width}}  {seconds * 1000:>9.1f}  {share:>5.1%}")
+        lines.append(f"{'total':<{width}}  {total * 1000:>9.1f}")
+        return "\n".join(lines)
@@ -0,0 +1,246 @@
+# Change-aware extension reloading
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import time
+from types import ModuleType
+
+logger = logging.getLogger(__name__)
+
+
+def _touched(files: list, known: dict) -> bool:
+    for file in files:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return True
+        if known.get(file) != (stat.st_mtime_ns, stat.st_size):
+            return True
+    return False
+
+
+class ReloadResult:
+    """
+    How reloading one extension went.
+    """
+
+    __slots__ = ("extension", "seconds", "error", "reason")
+
+    def __init__(self, extension: str, seconds: float, error: Exception = None, reason: str = "requested"):
+        self.extension = extension
+        self.seconds = seconds
+        self.error = error
+        self.reason = reason  # "requested", "changed" or "dependent"
+
+    def to_dict(self) -> dict:
+        return {"seconds": self.seconds, "error": repr(self.error) if self.error else None, "reason": self.reason}
+
+
+class ExtensionReloader:
+    """
+    Reloads extensions, timing each one, and can tell which extensions' source files have changed since they were
+    (re)loaded so that only those - and the extensions that depend on them - are reloaded.
+
+    An extension's source is its module plus any of its submodules. An extension depends on another if any of its
+    modules holds a reference (an imported module, class or function) to the other's modules.
+    """
+
+    def __init__(self, bot, *, interval: float = 1.0):
+        """
+        :param bot: The bot whose extensions to reload
+        :param interval: How often the watcher checks for changes, in seconds.
+        """
+        self.bot = bot
+        self.interval = interval
+        self._hashes = {}  # extension -> hash of its source when last (re)loaded
+        self._stats = {}  # file -> (mtime, size), so the watcher only hashes files that were touched
+        self._remembering = {}  # extension -> the task hashing its source, since it was just (re)loaded
+        self._task = None
+
+    @staticmethod
+    def _modules(extension: str) -> list:
+        prefix = extension + "."
+        return [
+            module for name, module in list(sys.modules.items())
+            if module is not None and (name == extension or name.startswith(prefix))
+        ]
+
+    def _files(self, extension: str) -> list:
+        files = {getattr(module, "__file__", None) for module in self._modules(extension)}
+        return sorted(file for file in files if file and os.path.exists(file))
+
+    @staticmethod
+    def fingerprint(files: list) -> tuple:
+        """
+        Hashes source files. This reads them, so run it in an executor, and gather the files on the loop (see _files).
+
+        :param files: The files to hash
+        :return: (str, dict) - the hash, and each file's (mtime, size) when it was read.
+        """
+        digest, stats = hashlib.sha1(), {}
+        for file in files:
+            try:
+                with open(file, "rb") as source:
+                    digest.update(file.encode() + b"\0" + source.read())
+                stat = os.stat(file)
+            except OSError:  # Deleted since: it's changed, and the next look will notice again.
+                digest.update(file.encode() + b"\0")
+                continue
+            stats[file] = (stat.st_mtime_ns, stat.st_size)
+        return digest.hexdigest(), stats
+
+    @staticmethod
+    def _fingerprint_all(sources: dict, known: dict = None) -> dict:
+        # sources: extension -> files. With known (file -> (mtime, size)), extensions whose files all still match
+        # are skipped. Runs in an executor, so it only works on what it's given.
+        fingerprints = {}
+        for extension, files in sources.items():
+            if known is not None and not _touched(files, known):
+                continue
+            fingerprints[extension] = ExtensionReloader.fingerprint(files)
+        return fingerprints
+
+    def loaded(self, extension: str) -> None:
+        """
+        Records that an extension was just (re)loaded. Its source is hashed in the background - see settle().
+
+        :param extension: The extension's name
+        :return: None
+        """
+        self._remembering[extension] = self.bot.loop.create_task(self._remember(extension))
+
+    async def _remember(self, extension: str) -> None:
+        task = asyncio.current_task()
+        try:
+            digest, stats = await self.bot.executors.run(self.fingerprint, self._files(extension))
+            if self._remembering.get(extension) is task:  # Not reloaded or unloaded since.
+                self._hashes[extension] = digest
+                self._stats.update(stats)
+        finally:
+            if self._remembering.get(extension) is task:
+                del self._remembering[extension]
+
+    async def settle(self) -> None:
+        """Waits for the extensions that were just (re)loaded to be hashed."""
+        while self._remembering:
+            await asyncio.gather(*self._remembering.values(), return_exceptions=True)
+
+    def forget(self, extension: str) -> None:
+        """Stops tracking an (unloaded) extension."""
+        self._hashes.pop(extension, None)
+        task = self._remembering.pop(extension, None)
+        if task is not None:
+            task.cancel()
+
+    async def changed(self, extensions: list, *, quick: bool = False) -> list:
+        """
+        Finds which of the given extensions changed since they were loaded. Files are hashed in an executor.
+
+        :param extensions: The extensions to check
+        :param quick: Only hash extensions whose files' modification times or sizes changed.
+        :return: list
+        """
+        await self.settle()
+        sources = {extension: self._files(extension) for extension in extensions}
+        known = dict(self._stats) if quick else None  # A copy: the loop may update _stats while this runs.
+        fingerprints = await self.bot.executors.run(self._fingerprint_all, sources, known)
+        changed = []
+        for extension, (digest, stats) in fingerprints.items():
+            self._stats.update(stats)
+            if digest != self._hashes.get(extension):
+                changed.append(extension)
+        return changed
+
+    def _owner(self, module_name: str, extensions: list):
+        for extension in extensions:
+            if module_name == extension or module_name.startswith(extension + "."):
+                return extension
+        return None
+
+    def dependents(self, changed: list) -> list:
+        """
+        Finds every loaded extension that (directly or not) depends on the given ones.
+
+        :param changed: The extensions that changed
+        :return: list - in the order they should be reloaded, excluding the given extensions.
+        """
+        extensions = list(self.bot.extensions)
+        depends_on = {}  # extension -> extensions it refers to
+        for extension in extensions:
+            references = set()
+            for module in self._modules(extension):
+                for value in list(vars(module).values()):
+                    name = value.__name__ if isinstance(value, ModuleType) else getattr(value, "__module__", None)
+                    owner = self._owner(name, extensions) if isinstance(name, str) else None
+                    if owner is not None and owner != extension:
+                        references.add(owner)
+            depends_on[extension] = references
+
+        found, queue = [], list(changed)
+        while queue:
+            current = queue.pop(0)
+            for extension, references in depends_on.items():
+                if current in references and extension not in changed and extension not in found:
+                    found.append(extension)
+                    queue.append(extension)
+        return found
+
+    async def reload(self, extensions: list, *, reason: str = "requested") -> list:
+        """
+        Reloads extensions one at a time, yielding to the loop in between, and times each.
+
+        :param extensions: The extensions to reload
+        :param reason: Why they're being reloaded (reported in the results)
+        :return: List[ReloadResult]
+        """
+        results = []
+        for extension in extensions:
+            start = time.perf_counter()
+            try:
+                self.bot.reload_extension(extension)
+            except Exception as e:  # ExtensionError, or anything the extension's setup raised
+                logger.error("Failed to re-load extension %s.", extension, exc_info=e)
+                results.append(ReloadResult(extension, time.perf_counter() - start, e, reason))
+            else:
+                results.append(ReloadResult(extension, time.perf_counter() - start, None, reason))
+            await asyncio.sleep(0)
+        await self.settle()  # reload_extension() goes through ChipBot.load_extension, which calls loaded().
+        return results
+
+    async def reload_changed(self, *, quick: bool = False) -> list:
+        """
+        Reloads the extensions whose source changed, then their dependents.
+
+        :param quick: Only look at extensions whose files' modification times or sizes changed.
+        :return: List[ReloadResult] - empty if nothing changed.
+        """
+        extensions = list(self.bot.extensions)
+        changed = await self.changed(extensions, quick=quick)
+        if not changed:
+            return []
+        dependents = self.dependents(changed)
+        logger.info("Reloading changed extensions %s (and dependents %s).", changed, dependents)
+        return await self.reload(changed, reason="changed") + await self.reload(dependents, reason="dependent")
+
+    def start_watching(self) -> None:
+        """Starts polling extensions' source files, reloading them when they change."""
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._watch())
+
+    def stop_watching(self) -> None:
+        """Stops the watcher."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                for result in await self.reload_changed(quick=True):
+                    logger.info("Auto-reloaded %s (%s) in %.1fms%s.", result.extension, result.reason,
+                                result.seconds * 1000, f", failed: {result.error!r}" if result.error else "")
+            except Exception as e:
+                logger.error("Extension watcher failed.", exc_info=e)
@@ -0,0 +1,12 @@
+# Report rendering
+def render_tables(tables: list) -> list:
+    """
+    Renders tables with tabulate. This runs in the bot's CPU pool (see ExecutorService.run_cpu), so it only takes
+    plain, picklable data: gather the rows on the loop, and render them here.
+
+    :param tables: (rows, headers, options) for each table. options are passed on to tabulate.
+    :return: list - each table, as a string
+    """
+    from tabulate import tabulate  # Imported here, so importing this module (in the bot's process) stays cheap.
+
+    return [tabulate(rows, headers=headers, tablefmt="pretty", **options) for rows, headers, options in tables]
@@ -1,18 +1,63 @@
+import asyncio
+import json
 import logging
 
 import discord
 
-from .bot import ChipBot
+from .bot import ChipBot, ShardedChipBot
+from .profiling import StartupProfile
 
+logger = logging.getLogger(__name__)
 
-def run_bot(environment):
-    bot = ChipBot()
-    logging.info("Starting bot")
+
+def run_bot(environment, *, sharded: bool = False, profile_startup: bool = False, started: float = None):
+    """
+    Runs the bot until it's shut down.
+
+    :param environment: The token environment to run with. Defaults to the config's default.
+    :param sharded: Whether to run every shard Discord recommends, in this one process.
+    :param profile_startup: Whether to print how long each phase of startup took, once the bot is ready.
+    :param started: Optional[float] - The time.perf_counter() value the process started at, to include imports.
+    :return: None
+    """
+    startup = StartupProfile(started)
+    startup.mark("imports")
+    bot = (ShardedChipBot if sharded else ChipBot)(startup=startup, print_startup_profile=profile_startup)
+    logger.info("Starting bot")
     try:
         bot.run(bot.config["tokens"][environment or bot.config["tokens"]["default"]])
     except discord.LoginFailure as e:
-        logging.error("Invalid token for environment '{}'.".format(environment), e)
+        logger.error("Invalid token for environment '%s'.", environment, exc_info=e)
         raise
     except KeyboardInterrupt:
-        logging.critical("Please, have some patience, and don't spam KeyboardInterrupt. The bot needs to shut down.")
+        logger.critical("Please, have some patience, and don't spam KeyboardInterrupt. The bot needs to shut down.")
         raise
+
+
+def run_clusters(environment, clusters: int, *, shard_count: int = None, fake_gateway: bool = False):
+    """
+    Runs the bot as several processes (clusters), each with a share of the shards, until they're all shut down.
+
+    :param environment: The token environment to run with. Defaults to the config's default.
+    :param clusters: How many processes to run
+    :param shard_count: Optional[int] - The total number of shards. Defaults to Discord's recommendation, or one per
+        cluster with a fake gateway.
+    :param fake_gateway: Whether the clusters connect to a local FakeGateway instead of Discord, for local testing.
+    :return: None
+    """
+    from .cluster import ClusterLauncher, recommended_shard_count
+
+    with open("./config.json") as config_raw:
+        config = json.load(config_raw)
+    token = config["tokens"][environment or config["tokens"]["default"]]
+    if fake_gateway:
+        token = token or "fake"  # The fake gateway accepts any token, so it can be tried without one.
+    loop = asyncio.get_event_loop()
+    if shard_count is None:
+        if fake_gateway:
+            shard_count = clusters
+        else:
+            shard_count = max(clusters, loop.run_until_complete(recommended_shard_count(token)))
+    logger.info("Starting %s cluster(s) for %s shard(s)", clusters, shard_count)
+    launcher = ClusterLauncher(clusters, shard_count, token, fake_gateway=fake_gateway)
+    loop.run_until_complete(launcher.run())
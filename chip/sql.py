@@ -1,84 +1,603 @@
 # SQL Models
-from typing import List
+import re
+from collections.abc import Mapping
+from typing import Iterable, List
+
+from .cache import LRUCache, MISSING
+from .database import Database
+
+TABLE_CONSTRAINTS = ("PRIMARY", "UNIQUE", "FOREIGN", "CHECK", "CONSTRAINT")
+IN_CHUNK_SIZE = 500  # Well under SQLite's bound parameter limit, and caps how many IN (...) statements get cached.
+
+
+COLUMN_CONSTRAINTS = {"PRIMARY", "NOT", "NULL", "NULLABLE", "UNIQUE", "DEFAULT", "CHECK", "REFERENCES", "COLLATE",
+                      "CONSTRAINT", "GENERATED", "AS"}
+_DEFAULT = re.compile(r"\bDEFAULT\s+(\S+)", re.IGNORECASE)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|[+-]?\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|NULL|TRUE|FALSE", re.IGNORECASE)
+_INTEGER = re.compile(r"\s*[+-]?\d+\s*")
+_REAL = re.compile(r"\s*[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\s*")
+
+
+def _chunks(items: list, size: int):
+    for n in range(0, len(items), size):
+        yield items[n:n + size]
+
+
+def _affinity(declared: str) -> str:
+    # https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+    declared = declared.upper()
+    if "INT" in declared:
+        return "INTEGER"
+    if any(name in declared for name in ("CHAR", "CLOB", "TEXT")):
+        return "TEXT"
+    if "BLOB" in declared or not declared:
+        return "BLOB"
+    if any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+        return "REAL"
+    return "NUMERIC"
+
+
+def _convert(affinity: str, value):
+    # What SQLite stores for a value written to a column with this affinity, so cached rows match what a read returns.
+    if value is None or affinity == "BLOB":
+        return value
+    if isinstance(value, bool):
+        value = int(value)
+    if affinity == "TEXT":
+        return str(value) if isinstance(value, (int, float)) else value
+    if isinstance(value, str):
+        if _INTEGER.fullmatch(value):
+            value = int(value)
+        elif _REAL.fullmatch(value):
+            value = float(value)
+        else:
+            return value
+    if affinity == "REAL" and isinstance(value, int):
+        return float(value)
+    if isinstance(value, float) and affinity != "REAL" and value.is_integer() and abs(value) < 2 ** 63:
+        return int(value)
+    return value
+
+
+def _literal(text: str):
+    if text.startswith("'"):
+        return text[1:-1].replace("''", "'")
+    upper = text.upper()
+    if upper == "NULL":
+        return None
+    if upper in ("TRUE", "FALSE"):
+        return int(upper == "TRUE")
+    return float(text) if any(char in text for char in ".eE") else int(text)
+
+
+class Column:
+    """
+    Descriptor giving direct attribute access to one column of a model's row tuple.
+    """
+
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, index: int):
+        self.name = name
+        self.index = index
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._row[self.index]
+
+    def __set__(self, instance, value):
+        raise AttributeError(f"Please use {instance.__class__.__name__}.edit() over setting attributes.")
+
+
+class RowView(Mapping):
+    """
+    A read-only column: value mapping over a model's row. Nothing is copied.
+    """
+
+    __slots__ = ("_row", "_index")
+
+    def __init__(self, row: tuple, index: dict):
+        self._row = row
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._row[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def copy(self) -> dict:
+        """Copies the row into a new (mutable) dict."""
+        return dict(zip(self._index, self._row))
+
+    def __repr__(self):
+        return repr(self.copy())
 
-from aiosqlite import Connection
 
+class ModelMeta(type):
+    """
+    Gives every model class an empty __slots__ unless it declares its own, so instances never grow a __dict__.
+    """
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        namespace.setdefault("__slots__", ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
 
-class DBModel:
+
+class DBModel(metaclass=ModelMeta):
     """
     ABC To allow for unified use of database models.
+
+    Subclasses only need to define __rows__ (and optionally __tablename__ and __indexes__). Column names and the
+    primary key are read from __rows__ once, and every CRUD statement is generated from them, parametrised, and cached
+    per column combination - so SQLite can reuse its prepared statements.
+
+    Instances hold their row as a single tuple, with column names mapped to indexes once per class, so each one only
+    costs a small fixed-size object plus the tuple.
+
+    Each model also keeps an identity map: a bounded LRU of one live instance per primary key (including "no such
+    entry"). get() is served from it when possible, and edits and deletes update or evict entries in place.
     """
 
-    _state: Connection
+    __slots__ = ("_state", "_row")
+
+    _state: Database
+    _row: tuple
     __rows__: list
-    _data: dict
+    __tablename__: str
+    __indexes__: dict = {}  # index name: tuple of columns. Created alongside the table.
+    __columns__: tuple
+    __primary_key__: tuple
+    _index: dict
+    _key_index: tuple
+    _affinities: tuple  # SQLite's type affinity of each column
+    _defaults: tuple  # each column's DEFAULT
+    _listeners: list
+    _statements: dict
+    _identity: LRUCache
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._listeners = []
+        cls._statements = {}
+        cls._identity = LRUCache(10000)
+        if "__rows__" not in cls.__dict__:
+            return
+        if "__tablename__" not in cls.__dict__:
+            cls.__tablename__ = cls.__name__.lower()
+
+        columns, affinities, defaults = [], [], []
+        primary_key = ()
+        for row in cls.__rows__:
+            head = row.split(None, 1)[0]
+            if head.upper() in TABLE_CONSTRAINTS:
+                if row.upper().startswith("PRIMARY KEY"):
+                    inner = row[row.index("(") + 1:row.rindex(")")]
+                    primary_key = tuple(column.strip() for column in inner.split(","))
+                continue
+            columns.append(head)
+            declared = []
+            for word in row.split()[1:]:
+                if word.upper() in COLUMN_CONSTRAINTS:
+                    break
+                declared.append(word)
+            affinities.append(_affinity(" ".join(declared)))
+            default = _DEFAULT.search(row)
+            if default is not None and not _LITERAL.fullmatch(default.group(1)):
+                # create() caches what it wrote, so it has to know what the database fills in.
+                raise TypeError(f"{cls.__name__}.{head} has a DEFAULT that isn't a literal, which isn't supported.")
+            defaults.append(_convert(affinities[-1], _literal(default.group(1)) if default else None))
+            if "PRIMARY KEY" in row.upper():
+                primary_key = (head,)
+        if not primary_key:
+            raise TypeError(f"{cls.__name__}.__rows__ does not declare a primary key.")
+        cls.__columns__ = tuple(columns)
+        cls.__primary_key__ = primary_key
+        cls._index = {column: n for n, column in enumerate(columns)}
+        cls._key_index = tuple(cls._index[column] for column in primary_key)
+        cls._affinities = tuple(affinities)
+        cls._defaults = tuple(defaults)
+        for n, column in enumerate(columns):
+            if not hasattr(cls, column):  # Don't shadow methods. Those columns are still available as model[column].
+                setattr(cls, column, Column(column, n))
+
+    @classmethod
+    def _from_row(cls, row, state: Database):
+        model = cls.__new__(cls)
+        object.__setattr__(model, "_state", state)
+        object.__setattr__(model, "_row", tuple(row))
+        return model
+
+    @classmethod
+    def _from_values(cls, values: dict, state: Database):
+        # What the database stores for an insert of these values: converted by affinity, with defaults filled in.
+        return cls._from_row(
+            (
+                _convert(affinity, values[column]) if column in values else default
+                for column, affinity, default in zip(cls.__columns__, cls._affinities, cls._defaults)
+            ),
+            state,
+        )
+
+    @classmethod
+    def _normalise_key(cls, key):
+        # Keys are cached as they're stored (e.g. 1 for an INTEGER key), so a lookup for "1" has to become 1 too.
+        if len(cls._key_index) == 1:
+            return _convert(cls._affinities[cls._key_index[0]], key)
+        if not isinstance(key, tuple) or len(key) != len(cls._key_index):
+            return key
+        return tuple(_convert(cls._affinities[n], value) for n, value in zip(cls._key_index, key))
+
+    @classmethod
+    def set_cache_size(cls, max_size: int) -> None:
+        """
+        Replaces this model's identity map with an empty one of a different size.
+
+        :param max_size: How many entries (including known-missing ones) to keep.
+        :return: None
+        """
+        cls._identity = LRUCache(max_size)
+
+    @classmethod
+    def evict(cls, key) -> None:
+        """
+        Drops an entry from the identity map, e.g. when the bot leaves a guild. The database is untouched.
+
+        :param key: The primary key to drop. A tuple for composite keys.
+        :return: None
+        """
+        cls._identity.invalidate(cls._normalise_key(key))
+
+    @classmethod
+    def cached(cls, key):
+        """
+        Looks an entry up in the identity map only.
+
+        :param key: The primary key to look up. A tuple for composite keys.
+        :return: The model, None if the entry is known not to exist, or MISSING if it isn't cached.
+        """
+        return cls._identity.peek(cls._normalise_key(key))
+
+    @classmethod
+    def _remember(cls, model, *, written: bool = False):
+        # Keeps one instance per key: if we already hold one, hand that back instead. Every write patches the cached
+        # instance (or marks it deleted), so it's never older than a row that's just been read - which may have been
+        # read before a write that finished first. Only a write (written=True) replaces what's cached.
+        key = model.key
+        cached = cls._identity.peek(key)
+        if cached is MISSING or (cached is None and written):
+            cls._identity.set(key, model)
+            return model
+        if cached is None:
+            return model  # Deleted while it was being read. Don't bring it back.
+        if written:
+            object.__setattr__(cached, "_row", model._row)
+        return cached
+
+    @classmethod
+    def _remember_missing(cls, key) -> None:
+        # Same as _remember, for a read that found nothing: an entry created while it was running stays.
+        if cls._identity.peek(key) is MISSING:
+            cls._identity.set(key, None)
+
+    @classmethod
+    def _patch_cached(cls, key, columns, values) -> None:
+        cached = cls._identity.peek(key)
+        if cached is not MISSING and cached is not None:
+            cached._update_row(columns, values)
+
+    @classmethod
+    def _check_columns(cls, columns) -> tuple:
+        columns = tuple(columns)
+        unknown = set(columns).difference(cls.__columns__)
+        if unknown:
+            raise ValueError("Unknown column(s) for {}: {}".format(cls.__tablename__, ", ".join(sorted(unknown))))
+        return columns
+
+    @classmethod
+    def _statement(cls, kind: str, columns: tuple = ()) -> str:
+        """
+        Fetches (generating if needed) a parametrised statement for this table.
+
+        :param kind: One of insert, select, select_in, select_all, update, delete
+        :param columns: The columns involved. For select_in, the number of keys instead.
+        :return: str - The SQL
+        """
+        key = (kind, columns)
+        try:
+            return cls._statements[key]
+        except KeyError:
+            pass
+
+        table = cls.__tablename__
+        everything = ", ".join(cls.__columns__)
+        by_key = " AND ".join(f"{column}=?" for column in cls.__primary_key__)
+        if kind == "insert":
+            query = "INSERT INTO {} ({}) VALUES ({});".format(table, ", ".join(columns), ", ".join("?" * len(columns)))
+        elif kind == "select":
+            where = " AND ".join(f"{column}=?" for column in columns)
+            query = "SELECT {} FROM {} WHERE {} LIMIT 1;".format(everything, table, where)
+        elif kind == "select_in":
+            if len(cls.__primary_key__) == 1:
+                where = "{} IN ({})".format(cls.__primary_key__[0], ", ".join("?" * columns))
+            else:
+                row = "({})".format(", ".join("?" * len(cls.__primary_key__)))
+                where = "({}) IN (VALUES {})".format(", ".join(cls.__primary_key__), ", ".join([row] * columns))
+            query = "SELECT {} FROM {} WHERE {};".format(everything, table, where)
+        elif kind == "select_all":
+            query = "SELECT {} FROM {};".format(everything, table)
+        elif kind == "update":
+            query = "UPDATE {} SET {} WHERE {};".format(table, ", ".join(f"{column}=?" for column in columns), by_key)
+        elif kind == "delete":
+            query = "DELETE FROM {} WHERE {};".format(table, by_key)
+        else:
+            raise ValueError(f"Unknown statement kind '{kind}'.")
+        cls._statements[key] = query
+        return query
+
+    @classmethod
+    def add_listener(cls, callback) -> None:
+        """
+        Registers a callback to be run whenever an entry of this model is created, edited or deleted.
+
+        The callback is called with the entry's primary key and the list of edited column names (None for a creation or
+        a deletion).
+        It is called once the change is visible to reads, so it is safe to use for cache invalidation.
+
+        :param callback: A regular (non-async) callable.
+        :return: None
+        """
+        cls._listeners.append(callback)
 
     @classmethod
-    async def create_table(cls, connection: Connection, *rows, name=None) -> None:
-        """Creates the table.
+    def remove_listener(cls, callback) -> None:
+        """Unregisters a callback added with add_listener. Does nothing if it isn't registered."""
+        try:
+            cls._listeners.remove(callback)
+        except ValueError:
+            pass
 
-        :param connection: The aiosqlite connection object.
+    @classmethod
+    def _dispatch_change(cls, key, keys) -> None:
+        for callback in cls._listeners:
+            callback(key, keys)
+
+    @classmethod
+    async def create_table(cls, connection: Database, *rows, name=None) -> None:
+        """Creates the table. This waits for the table to be committed.
+
+        :param connection: The database to use.
         :param rows: A list of rows to create (name type constraints)
-        :param name: Optional[str] - The name of the table. Defaults to cls.__class__.__name__."""
+        :param name: Optional[str] - The name of the table. Defaults to cls.__tablename__."""
         if not rows:
             rows = cls.__rows__
-        query = "CREATE TABLE IF NOT EXISTS {} ({});".format(name or cls.__class__.__name__.lower(), ",\n".join(rows))
+        table = name or cls.__tablename__
+        query = "CREATE TABLE IF NOT EXISTS {} ({});".format(table, ",\n".join(rows))
         # The IF NOT EXISTS in there means this function can be called numerous times.
-        await connection.execute(query)
-        await connection.commit()
+        committed = await connection.write(query)
+        for index, columns in cls.__indexes__.items():
+            committed = await connection.write(
+                "CREATE INDEX IF NOT EXISTS {} ON {} ({});".format(index, table, ", ".join(columns))
+            )
+        await committed
 
     @classmethod
-    async def create(cls, state, **values):
+    async def create(cls, state: Database, *, durable: bool = False, **values):
         """
         [C]RUD - Creates an entry in the database.
 
-        :param values: column:value pairs to use.
+        :param values: column:value pairs to use. Missing columns get their DEFAULT (or NULL) in the database.
         :param state: The state to use
+        :param durable: Whether to wait for the entry to be committed before returning.
         :return: Resolved model
         """
-        raise NotImplementedError
+        columns = cls._check_columns(values)
+        committed = await state.write(cls._statement("insert", columns), tuple(values.values()))
+        if durable:
+            await committed
+        model = cls._remember(cls._from_values(values, state), written=True)
+        cls._dispatch_change(model.key, None)
+        return model
 
     @classmethod
-    async def get(cls, state, key, **other_comps):
+    async def create_many(cls, state: Database, rows: Iterable[dict], *, durable: bool = False) -> list:
         """
-        C[R]UD - Retrieve an entry from the database.
+        [C]RUD - Creates many entries at once, using one executemany per column combination.
 
         :param state: The state to use
-        :param key: The primary key to choose from, if **other_comps is not provided.
-        :param other_comps: A column:value pair.
-        :return: Resolved model
+        :param rows: column:value dicts, one per entry
+        :param durable: Whether to wait for the entries to be committed before returning.
+        :return: List of resolved models
+        """
+        groups = {}
+        for values in rows:
+            groups.setdefault(cls._check_columns(values), []).append(values)
+        models = []
+        for columns, group in groups.items():
+            committed = await state.write(
+                cls._statement("insert", columns), [tuple(values.values()) for values in group], many=True
+            )
+            for values in group:
+                model = cls._remember(cls._from_values(values, state), written=True)
+                cls._dispatch_change(model.key, None)
+                models.append(model)
+        if durable and groups:
+            await committed  # Commits are ordered, so the last one resolving means they all have.
+        return models
+
+    @classmethod
+    async def get(cls, state: Database, key=None, **other_comps):
+        """
+        C[R]UD - Retrieve an entry, from the identity map if possible, otherwise from the database.
+
+        :param state: The state to use
+        :param key: The primary key to choose from, if **other_comps is not provided. A tuple for composite keys.
+        :param other_comps: column:value pairs to match. These always query the database.
+        :return: Optional - Resolved model, or None if there's no such entry.
+        """
+        if other_comps:
+            columns = cls._check_columns(other_comps)
+            params = tuple(other_comps.values())
+        else:
+            key = cls._normalise_key(key)
+            cached = cls._identity.get(key)
+            if cached is not MISSING:
+                return cached
+            columns = cls.__primary_key__
+            params = key if isinstance(key, tuple) else (key,)
+        async with state.execute(cls._statement("select", columns), params) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            if not other_comps:
+                cls._remember_missing(key)
+            return None
+        return cls._remember(cls._from_row(row, state))
+
+    @classmethod
+    async def get_many(cls, state: Database, keys: Iterable) -> list:
+        """
+        C[R]UD - Retrieve many entries by primary key. Anything not in the identity map is fetched with as few
+        IN (...) queries as possible.
+
+        :param state: The state to use
+        :param keys: The primary keys to fetch. Tuples for composite keys.
+        :return: List of resolved models. Keys without an entry are skipped, and order is not guaranteed.
+        """
+        composite = len(cls.__primary_key__) > 1
+        models = []
+        missing = []
+        for key in dict.fromkeys(cls._normalise_key(key) for key in keys):
+            cached = cls._identity.get(key)
+            if cached is MISSING:
+                missing.append(key)
+            elif cached is not None:
+                models.append(cached)
+
+        for chunk in _chunks(missing, IN_CHUNK_SIZE):
+            params = tuple(value for key in chunk for value in key) if composite else tuple(chunk)
+            found = set()
+            async with state.execute(cls._statement("select_in", len(chunk)), params) as cursor:
+                for row in await cursor.fetchall():
+                    model = cls._remember(cls._from_row(row, state))
+                    found.add(model.key)
+                    models.append(model)
+            for key in chunk:
+                if key not in found:
+                    cls._remember_missing(key)
+        return models
+
+    @classmethod
+    async def all(cls, state: Database) -> list:
+        """
+        C[R]UD - Retrieve every entry in the table, in one query.
+
+        :param state: The state to use
+        :return: List of resolved models.
         """
-        raise NotImplementedError
+        async with state.execute(cls._statement("select_all")) as cursor:
+            return [cls._remember(cls._from_row(row, state)) for row in await cursor.fetchall()]
 
-    async def edit(self, keys: List[str], values) -> None:
+    @property
+    def key(self):
+        """
+        This entry's primary key.
+
+        :return: The primary key's value, or a tuple of values for composite keys.
+        """
+        values = tuple(self._row[n] for n in self._key_index)
+        return values if len(values) > 1 else values[0]
+
+    def _key_params(self, action: str) -> tuple:
+        params = tuple(self._row[n] for n in self._key_index)
+        if None in params:
+            raise ValueError(f"Missing primary key for {self.__class__.__name__} data model - unable to {action}.")
+        return params
+
+    async def edit(self, keys: List[str], values, *, durable: bool = False) -> None:
         """
         CR[U]D - Edits the entry on the database.
 
         .. warning::
-            This function commits directly to the database automatically. Make sure your datatypes are correct.
+            This function writes directly to the database automatically. Make sure your datatypes are correct.
 
         :param keys: The column names to update
         :param values: the values to update with
+        :param durable: Whether to wait for the edit to be committed before returning.
         :return: None
         """
-        raise NotImplementedError
+        columns = self._check_columns(keys)
+        committed = await self.state.write(self._statement("update", columns), (*values, *self._key_params("update")))
+        self._update_row(columns, values)
+        if self._identity.peek(self.key) is not self:
+            self._patch_cached(self.key, columns, values)
+        self._dispatch_change(self.key, list(columns))
+        if durable:
+            await committed
+
+    @classmethod
+    async def edit_many(cls, state: Database, keys: List[str], rows: Iterable, *, durable: bool = False) -> None:
+        """
+        CR[U]D - Edits the same columns on many entries, in one executemany.
 
-    async def delete(self) -> None:
+        :param state: The state to use
+        :param keys: The column names to update
+        :param rows: (primary key, values) pairs. Primary keys are tuples for composite keys.
+        :param durable: Whether to wait for the edits to be committed before returning.
+        :return: None
+        """
+        columns = cls._check_columns(keys)
+        rows = list(rows)
+        if not rows:
+            return
+        params = [(*values, *(key if isinstance(key, tuple) else (key,))) for key, values in rows]
+        committed = await state.write(cls._statement("update", columns), params, many=True)
+        for key, values in rows:
+            key = cls._normalise_key(key)
+            cls._patch_cached(key, columns, values)
+            cls._dispatch_change(key, list(columns))
+        if durable:
+            await committed
+
+    async def delete(self, *, durable: bool = False) -> None:
         """
         CRU[D] - Deletes this entry.
 
         .. warning::
             This is irreversible!
 
+        :param durable: Whether to wait for the deletion to be committed before returning.
         :return: Nothing. You won't be able to use this model again after.
         """
-        raise NotImplementedError
+        committed = await self.state.write(self._statement("delete"), self._key_params("delete"))
+        self._identity.set(self.key, None)
+        self._dispatch_change(self.key, None)
+        if durable:
+            await committed
+
+    def __init__(self, data: dict, *, state):
+        # __setattr__ is blocked for users, so go around it.
+        object.__setattr__(self, "_state", state)
+        object.__setattr__(self, "_row", tuple(data.get(column) for column in self.__columns__))
+
+    def _update_row(self, columns, values) -> None:
+        row = list(self._row)
+        for column, value in zip(columns, values):
+            n = self._index[column]
+            row[n] = _convert(self._affinities[n], value)
+        object.__setattr__(self, "_row", tuple(row))
 
     def __getattr__(self, item):
+        # Only reached for names that aren't a column descriptor (or a column shadowed by a method).
         if not isinstance(item, str):
             raise TypeError("Got type '{.__class__.__name__}' instead of 'str'.".format(item))
         try:
-            return self._data[item]
+            if item.startswith("_"):
+                raise KeyError(item)  # Unset internals, e.g. _row before __init__. Don't recurse looking for them.
+            return self._row[self._index[item]]
         except KeyError:
             raise AttributeError(self.__class__.__name__ + " has no attribute '{}'.".format(item))
 
@@ -92,22 +611,37 @@ class DBModel:
         raise AttributeError(f"Please use {self.__class__.__name__}.edit() over setting attributes.")
 
     @property
-    def state(self) -> Connection:
+    def state(self) -> Database:
         """
         The connection state
 
-        :return: aiosqlite.Connection - the current database connection
+        :return: Database - the current database
         """
         return self._state
 
     @property
-    def data(self) -> dict:
+    def data(self) -> RowView:
         """
-        The raw dictionary of data for this table.
+        The raw data for this table, as a read-only mapping. Use data.copy() if you need a dict.
 
-        :return: dict - key: value pairs
+        :return: RowView - key: value pairs
         """
-        return self._data.copy()
+        return RowView(self._row, self._index)
+
+
+def all_models() -> list:
+    """
+    Every model class that has a table.
+
+    :return: List[Type[DBModel]]
+    """
+    found, queue = [], list(DBModel.__subclasses__())
+    while queue:
+        model = queue.pop(0)
+        if "__columns__" in model.__dict__:
+            found.append(model)
+        queue.extend(model.__subclasses__())
+    return found
 
 
 class Guild(DBModel):
@@ -115,6 +649,7 @@ class Guild(DBModel):
     A database model representing a guild.
     """
 
+    __tablename__ = "guilds"
     __rows__ = [
         "id INTEGER PRIMARY KEY NOT NULL UNIQUE",
         "prefix TEXT NULLABLE DEFAULT NULL",
@@ -123,60 +658,74 @@ class Guild(DBModel):
         "case_id INTEGER",
     ]
 
-    def __init__(self, data: dict, *, state):
-        self._state = state
-        self._data = data
+
+class GuildPrefix(DBModel):
+    """
+    A database model representing one of a guild's custom prefixes, on top of Guild.prefix.
+    """
+
+    __tablename__ = "guild_prefixes"
+    __rows__ = [
+        "guild_id INTEGER NOT NULL",
+        "prefix TEXT NOT NULL",
+        "PRIMARY KEY (guild_id, prefix)",
+    ]
+
+
+class Case(DBModel):
+    """
+    A database model representing a moderation case.
+
+    Cases are numbered per guild. created_at is a UNIX timestamp.
+    """
+
+    __tablename__ = "cases"
+    __rows__ = [
+        "guild_id INTEGER NOT NULL",
+        "case_id INTEGER NOT NULL",
+        "target_id INTEGER NOT NULL",
+        "moderator_id INTEGER NOT NULL",
+        "action TEXT NOT NULL",
+        "reason TEXT DEFAULT NULL",
+        "created_at REAL NOT NULL",
+        "PRIMARY KEY (guild_id, case_id)",  # This is also the (guild_id, case_id) index.
+    ]
+    __indexes__ = {
+        # case_id breaks ties between cases created in the same instant, so pages never skip or repeat a case.
+        "cases_by_target": ("guild_id", "target_id", "created_at", "case_id"),
+    }
+
+    _GUILD_HISTORY = "SELECT {} FROM cases WHERE guild_id=? {}ORDER BY case_id DESC LIMIT ?;"
+    _TARGET_HISTORY = (
+        "SELECT {} FROM cases WHERE guild_id=? AND target_id=? {}ORDER BY created_at DESC, case_id DESC LIMIT ?;"
+    )
 
     @classmethod
-    async def create(cls, state: Connection, **kwargs):
-        query = """
-        INSERT INTO guilds VALUES (?, ?, ?, ?, ?);
+    async def history(cls, state: Database, guild_id: int, *, target_id: int = None, before=None, limit: int = 20):
         """
-        await state.execute(query, *kwargs.values())
-        await state.commit()
-        return cls(kwargs, state=state)
+        Fetches a page of a guild's cases, newest first.
 
-    @classmethod
-    async def get(cls, state, key, **other_comps):
-        query = """
-        SELECT * FROM guilds WHERE {} LIMIT 1;
+        This uses keyset pagination: pass the last case of the previous page as before to get the next one. Unlike
+        OFFSET, every page costs the same no matter how deep into the history it is.
+
+        :param state: The state to use
+        :param guild_id: The guild to fetch cases for
+        :param target_id: Optional[int] - Only fetch cases against this user.
+        :param before: Optional[Case] - Only fetch cases older than this one.
+        :param limit: The maximum number of cases to fetch.
+        :return: List[Case]
         """
-        if other_comps:
-            where = " AND ".join(f"{column}={value}" for column, value in other_comps.items())
+        paged = before is not None
+        if target_id is None:
+            kind, template, keyset = "guild_history", cls._GUILD_HISTORY, "AND case_id < ? "
+            params = (guild_id, *((before.case_id,) if paged else ()), limit)
         else:
-            where = "id=" + key
-        query = query.format(where)
-        data = {}
-        async with state.execute(query) as cursor:
-            row = await cursor.fetchone()
-            for key in row.keys():
-                data[key] = row[key]
-        return cls(data, state=state)
-
-    async def edit(self, keys: List[str], values):
-        if not hasattr(self, "id"):
-            raise ValueError("Missing ID for guild data model - unable to update")
-        query = """
-        UPDATE guilds
-        SET {}
-        WHERE id=?"""
-
-        _set = []
-        for n, key in enumerate(keys):
-            _set.append(f"{key}={values[n]}")
-        query = query.format(", ")
-        await self.state.execute(query, (self.id,))
-        await self.state.commit()
-
-    async def delete(self) -> None:
-        if not hasattr(self, "id"):
-            raise ValueError("Missing ID for guild data model - unable to delete.")
-        await self.state.execute(
-            """
-            DELETE FROM guilds
-            WHERE id=?
-            """,
-            (self.id,),
-        )
-        await self.state.commit()
-        return
+            kind, template, keyset = "target_history", cls._TARGET_HISTORY, "AND (created_at, case_id) < (?, ?) "
+            params = (guild_id, target_id, *((before.created_at, before.case_id) if paged else ()), limit)
+        query = cls._statements.get((kind, paged))
+        if query is None:
+            query = template.format(", ".join(cls.__columns__), keyset if paged else "")
+            cls._statements[(kind, paged)] = query
+        async with state.execute(query, params) as cursor:
+            # These skip the identity map - history pages are read-only, and would just churn it.
+            return [cls._from_row(row, state) for row in await cursor.fetchall()]
@@ -0,0 +1,185 @@
+# Bot-wide counts
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StatsSnapshot:
+    """
+    The bot's counts at one point in time.
+    """
+
+    __slots__ = ("guilds", "channels", "members", "users", "emojis", "reconciled_at")
+
+    def __init__(self, guilds: int, channels: int, members: int, users: int, emojis: int, reconciled_at: float):
+        self.guilds = guilds
+        self.channels = channels
+        self.members = members
+        self.users = users
+        self.emojis = emojis
+        self.reconciled_at = reconciled_at
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class StatsService:
+    """
+    Keeps guild, channel, member and emoji counts up to date from gateway events, so reading them is O(1) rather than
+    a walk over every cached object.
+
+    Counts are kept per guild, so an event (or a guild becoming available again after a reconnect) replaces that
+    guild's numbers instead of adding to them, and can't double count. A background task reconciles every guild's
+    counts against the cache every so often (and after each on_ready), a few guilds at a time so it never holds up the
+    loop. The number of unique users can't be tracked from member events - a user can be in several guilds - so it is
+    only updated when reconciling.
+    """
+
+    def __init__(self, bot, *, reconcile_every: float = 600, batch: int = 100):
+        """
+        :param bot: The bot
+        :param reconcile_every: How often to reconcile the counts against the cache, in seconds.
+        :param batch: How many guilds to reconcile before yielding to the loop.
+        """
+        self.bot = bot
+        self.reconcile_every = reconcile_every
+        self.batch = batch
+        self.drift = 0  # How far off the counts were, in total, at the last reconcile.
+        self._guilds = {}  # guild ID -> [channels, members, emojis]
+        self._channels = self._members = self._emojis = 0
+        self._users = 0
+        self._reconciled_at = 0.0
+        self._reconcile = asyncio.Event()
+        self._task = None
+        for event in ("guild_join", "guild_available", "guild_remove", "guild_unavailable", "guild_channel_create",
+                      "guild_channel_delete", "guild_emojis_update", "member_join", "member_remove", "ready"):
+            bot.add_listener(getattr(self, "on_" + event))
+
+    def snapshot(self) -> StatsSnapshot:
+        """
+        The current counts.
+
+        :return: StatsSnapshot
+        """
+        return StatsSnapshot(
+            len(self._guilds), self._channels, self._members, self._users, self._emojis, self._reconciled_at
+        )
+
+    def start(self) -> None:
+        """Starts the background reconciler."""
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._reconciler())
+
+    def stop(self) -> None:
+        """Stops the background reconciler."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def request_reconcile(self) -> None:
+        """Asks the background task to reconcile soon."""
+        self._reconcile.set()
+
+    def _set(self, guild, channels: int, members: int, emojis: int) -> int:
+        # Replaces a guild's counts, adjusting the totals. Returns by how much they changed.
+        old = self._guilds.get(guild.id, (0, 0, 0))
+        self._guilds[guild.id] = [channels, members, emojis]
+        self._channels += channels - old[0]
+        self._members += members - old[1]
+        self._emojis += emojis - old[2]
+        return abs(channels - old[0]) + abs(members - old[1]) + abs(emojis - old[2])
+
+    def _add_guild(self, guild) -> int:
+        return self._set(guild, len(guild.channels), guild.member_count or 0, len(guild.emojis))
+
+    def _remove_guild(self, guild_id: int) -> int:
+        # Returns how much the totals dropped by.
+        old = self._guilds.pop(guild_id, None)
+        if old is None:
+            return 0
+        self._channels -= old[0]
+        self._members -= old[1]
+        self._emojis -= old[2]
+        return sum(old)
+
+    def _adjust(self, guild, index: int, delta: int):
+        counts = self._guilds.get(guild.id)
+        if counts is None:  # Not seen yet - count all of it.
+            self._add_guild(guild)
+            return
+        counts[index] += delta
+        if index == 0:
+            self._channels += delta
+        elif index == 1:
+            self._members += delta
+        else:
+            self._emojis += delta
+
+    async def on_guild_join(self, guild):
+        self._add_guild(guild)
+
+    on_guild_available = on_guild_join
+
+    async def on_guild_remove(self, guild):
+        self._remove_guild(guild.id)
+
+    on_guild_unavailable = on_guild_remove
+
+    async def on_guild_channel_create(self, channel):
+        self._adjust(channel.guild, 0, 1)
+
+    async def on_guild_channel_delete(self, channel):
+        self._adjust(channel.guild, 0, -1)
+
+    async def on_member_join(self, member):
+        self._adjust(member.guild, 1, 1)
+
+    async def on_member_remove(self, member):
+        self._adjust(member.guild, 1, -1)
+
+    async def on_guild_emojis_update(self, guild, before, after):
+        self._adjust(guild, 2, len(after) - len(before))
+
+    async def on_ready(self):
+        self.request_reconcile()
+
+    async def reconcile(self) -> int:
+        """
+        Recounts every guild from the cache, a batch at a time, and drops guilds the bot is no longer in.
+
+        :return: int - the total drift that was corrected.
+        """
+        start = time.perf_counter()
+        drift = 0
+        seen = set()
+        for index, guild in enumerate(self.bot.guilds):
+            if index % self.batch == self.batch - 1:
+                await asyncio.sleep(0)
+            if self.bot.get_guild(guild.id) is not guild:  # Left (or reconnected) while we were yielding.
+                continue
+            seen.add(guild.id)
+            drift += self._add_guild(guild)
+        for guild_id in set(self._guilds) - seen:
+            if self.bot.get_guild(guild_id) is not None:  # Joined while we were yielding, and counted by the event.
+                continue
+            drift += self._remove_guild(guild_id)
+        self._users = len(self.bot._connection._users)  # bot.users copies the whole cache into a list.
+        self._reconciled_at = time.time()
+        self.drift = drift
+        logger.debug("Reconciled stats for %d guilds in %.3fs (drift %d).", len(seen), time.perf_counter() - start,
+                     drift)
+        return drift
+
+    async def _reconciler(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._reconcile.wait(), self.reconcile_every)
+            except asyncio.TimeoutError:
+                pass
+            self._reconcile.clear()
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error("Failed to reconcile stats.", exc_info=e)
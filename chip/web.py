@@ -0,0 +1,109 @@
+# Outgoing HTTP (other than discord's)
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from .cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse:
+    """
+    A cached JSON body, with what's needed to revalidate it.
+    """
+
+    __slots__ = ("data", "etag", "expires")
+
+    def __init__(self, data, etag: str, expires: float):
+        self.data = data
+        self.etag = etag
+        self.expires = expires
+
+
+class WebClient:
+    """
+    A bot-wide, pooled aiohttp session, with a TTL cache for JSON lookups.
+
+    Expired entries are revalidated with If-None-Match, so an unchanged resource costs a 304 rather than a full body
+    (and, for GitHub, doesn't count against the rate limit). If the upstream call fails, the stale value is served.
+    """
+
+    def __init__(self, *, ttl: float = 3600, max_size: int = 256, timeout: float = 10, user_agent: str = "ChipBot"):
+        """
+        :param ttl: How many seconds a response is served from cache before being revalidated.
+        :param max_size: How many URLs to cache.
+        :param timeout: The total timeout for a request, in seconds.
+        :param user_agent: The User-Agent header to send.
+        """
+        self.ttl = ttl
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.revalidated = 0
+        self.stale = 0
+        self._cache = LRUCache(max_size)
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The shared session. Created on first use, since it has to be made inside the running loop.
+
+        :return: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": self.user_agent},
+            )
+        return self._session
+
+    @property
+    def stats(self) -> dict:
+        """The cache's counters, plus how many responses were revalidated or served stale."""
+        return {**self._cache.stats, "revalidated": self.revalidated, "stale": self.stale}
+
+    async def get_json(self, url: str, *, ttl: float = None):
+        """
+        GETs a JSON resource, through the cache.
+
+        :param url: The URL to fetch
+        :param ttl: Optional[float] - Overrides the client's TTL for this URL.
+        :return: The decoded JSON
+        :raises aiohttp.ClientError: If the request fails and nothing (not even a stale value) is cached.
+        :raises asyncio.TimeoutError: Likewise, if the request times out.
+        """
+        entry = self._cache.get(url)
+        now = time.monotonic()
+        if entry is not MISSING and entry.expires > now:
+            return entry.data
+
+        headers = {}
+        if entry is not MISSING and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                if response.status == 304 and entry is not MISSING:
+                    entry.expires = now + (ttl or self.ttl)
+                    self.revalidated += 1
+                    return entry.data
+                response.raise_for_status()
+                data = await response.json()
+                etag = response.headers.get("ETag")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if entry is MISSING:
+                raise
+            logger.warning("Failed to refresh %s, serving the stale copy.", url, exc_info=e)
+            self.stale += 1
+            return entry.data
+
+        self._cache.set(url, CachedResponse(data, etag, now + (ttl or self.ttl)))
+        return data
+
+    async def close(self) -> None:
+        """Closes the shared session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
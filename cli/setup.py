@@ -73,7 +73,7 @@ def main():
     real = template.copy()
 
     # Yes, we're gonna hardcode this in. I'm too lazy to add auto type detection.
-    real["prefix"]["set"] = input("Please input a default prefix [//]: ") or "//"
+    real["prefix"]["set"] = (input("Please input the default prefixes, separated by spaces [//]: ") or "//").split()
     real["prefix"]["mention"] = conditional(input("Would you like to allow the bot's mention to be a prefix? [Y/N] "))
     real["prefix"]["custom"] = conditional(input("Would you like to allow custom prefixes? [Y/N] "))
     real["tokens"]["production"] = required("Please enter a primary (production) bot token: ")
@@ -83,6 +83,9 @@ def main():
     real["control"]["max_messages"] = interactive_attempt_map(
         "How large should the bot's max message cache be? [1000] ", int, is_required=False, default=1000
     )
+    real["message_cache"]["max_bytes"] = interactive_attempt_map(
+        "How much memory (in MiB) can the moderation message cache use? [64] ", int, is_required=False, default=64
+    ) * 1024 * 1024
     if conditional("Would you like to (at least temporarily) limit how many servers ChipBot can join? [Y/N] "):
         real["control"]["max_guilds"] = interactive_attempt_map(
             "How many servers can ChipBot join? [30] ", int, is_required=False, default=30
@@ -96,6 +99,22 @@ def main():
             input(f"Should the bot be allowed to mention {key}? [Y/N] (default: {default}) ") or str(default)
         )
 
+    policy = real["cache_policy"]
+    policy["intents"]["presences"] = conditional(
+        input("Does the bot need members' statuses and activities (presences)? This uses a lot of memory. [Y/N] "
+              "(default: N) ") or "n"
+    )
+    policy["member_cache_flags"]["joined"] = conditional(
+        input("Should members be kept in cache? Most moderation commands need this. [Y/N] (default: Y) ") or "y"
+    )
+    while True:
+        chunking = input("When should member lists be downloaded? startup, lazy (first command in a server) or never "
+                         "[lazy]: ").strip().lower() or "lazy"
+        if chunking in ("startup", "lazy", "never"):
+            policy["chunking"] = chunking
+            break
+        print("Please answer startup, lazy or never.")
+
     real["owners"] = (
         input("Please enter a list of owner user IDs (or hit enter for discord native bot ownership): ") or []
     )
@@ -0,0 +1,239 @@
+# Export, import and backup
+if __name__ == "__main__":
+    raise RuntimeError("Cannot run script as stand-alone.")
+
+import csv
+import itertools
+import json
+import os
+import sqlite3
+import time
+
+from chip.sql import all_models
+
+FETCH_SIZE = 10000  # Rows read (or inserted) at a time.
+TRANSACTION_ROWS = 1000000  # Rows per import transaction, so the journal doesn't grow without bound.
+NULL = "\\N"  # How CSV files spell NULL, so it isn't confused with an empty string.
+
+
+def connect(path: str) -> sqlite3.Connection:
+    # Autocommit mode: transactions are opened and committed explicitly. Wait for the bot if it's writing.
+    connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+    connection.execute("PRAGMA busy_timeout=30000;")
+    return connection
+
+
+def table_exists(connection: sqlite3.Connection, table: str) -> bool:
+    query = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;"
+    return connection.execute(query, (table,)).fetchone() is not None
+
+
+def _write_jsonl(file, columns: tuple, rows):
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+    file.writelines(encode(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+def _write_csv(file, columns: tuple, rows):
+    writer = csv.writer(file)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([NULL if value is None else value for value in row])
+
+
+def _fetch(cursor: sqlite3.Cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+class _Counter:
+    # Counts the rows going through an iterator.
+    __slots__ = ("rows", "count")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+def export(database: str, directory: str, fmt: str = "jsonl") -> dict:
+    """
+    Writes every model's table to directory/<table>.<fmt>, streaming, so memory use doesn't depend on table size.
+
+    Every table is read in one transaction, so the export is a consistent snapshot even while the bot is running.
+
+    :param database: The SQLite database's path
+    :param directory: Where to write the files. Created if needed.
+    :param fmt: jsonl or csv
+    :return: dict - table -> rows exported
+    """
+    os.makedirs(directory, exist_ok=True)
+    writer = _write_jsonl if fmt == "jsonl" else _write_csv
+    counts = {}
+    connection = connect(database)
+    try:
+        connection.execute("BEGIN;")
+        for model in all_models():
+            table = model.__tablename__
+            if not table_exists(connection, table):
+                continue
+            start = time.perf_counter()
+            cursor = connection.execute("SELECT {} FROM {};".format(", ".join(model.__columns__), table))
+            counter = _Counter(_fetch(cursor))
+            with open(os.path.join(directory, f"{table}.{fmt}"), "w", encoding="utf-8", newline="") as file:
+                writer(file, model.__columns__, counter)
+            counts[table] = counter.count
+            print(f"Exported {counter.count:,} rows from {table} in {time.perf_counter() - start:.2f}s.")
+        connection.execute("COMMIT;")
+    finally:
+        connection.close()
+    return counts
+
+
+def _read_jsonl(file, columns: tuple):
+    decode = json.JSONDecoder().decode
+    rows = (decode(line) for line in file if line.strip())
+    first = next(rows, None)
+    if first is None:
+        return
+    if set(columns).issubset(first):
+        # Files written by export() have every column on every line, so the rows can be bound by name as they are.
+        yield first
+        yield from rows
+    else:
+        for values in itertools.chain((first,), rows):
+            yield {column: values.get(column) for column in columns}
+
+
+def _read_csv(file, columns: tuple):
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return
+    unknown = set(header).difference(columns)
+    if unknown:
+        raise ValueError("Unknown column(s) in {}: {}".format(file.name, ", ".join(sorted(unknown))))
+    positions = [header.index(column) if column in header else None for column in columns]
+    for row in reader:
+        yield {
+            column: None if position is None or row[position] == NULL else row[position]
+            for column, position in zip(columns, positions)
+        }
+
+
+def _batches(rows, size: int):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_(database: str, directory: str, fmt: str = "jsonl") -> dict:
+    """
+    Loads directory/<table>.<fmt> files (as written by export()) into the database, creating missing tables. Rows
+    that already exist (by primary key) are replaced.
+
+    Rows are inserted with executemany in chunks, in large transactions. Indexes of newly created tables are built
+    after loading, which is much faster than keeping them up to date row by row.
+
+    :param database: The SQLite database's path
+    :param directory: Where to read the files from. Tables without a file are skipped.
+    :param fmt: jsonl or csv
+    :return: dict - table -> rows imported
+    """
+    reader = _read_jsonl if fmt == "jsonl" else _read_csv
+    counts = {}
+    connection = connect(database)
+    try:
+        for model in all_models():
+            table = model.__tablename__
+            source = os.path.join(directory, f"{table}.{fmt}")
+            if not os.path.exists(source):
+                continue
+            start = time.perf_counter()
+            created = not table_exists(connection, table)
+            connection.execute("CREATE TABLE IF NOT EXISTS {} ({});".format(table, ",\n".join(model.__rows__)))
+            query = "INSERT OR REPLACE INTO {} ({}) VALUES ({});".format(
+                table, ", ".join(model.__columns__), ", ".join(":" + column for column in model.__columns__)
+            )
+            count = 0
+            with open(source, encoding="utf-8", newline="") as file:
+                connection.execute("BEGIN;")
+                try:
+                    for batch in _batches(reader(file, model.__columns__), FETCH_SIZE):
+                        connection.executemany(query, batch)
+                        count += len(batch)
+                        if count % TRANSACTION_ROWS < len(batch):
+                            connection.execute("COMMIT;")
+                            connection.execute("BEGIN;")
+                    connection.execute("COMMIT;")
+                except BaseException:
+                    connection.execute("ROLLBACK;")
+                    raise
+            for index, columns in model.__indexes__.items():
+                connection.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({});".format(index, table, ", ".join(columns)))
+            counts[table] = count
+            print(
+                f"Imported {count:,} rows into {table}{' (new table)' if created else ''} "
+                f"in {time.perf_counter() - start:.2f}s."
+            )
+        connection.execute("PRAGMA optimize;")
+    finally:
+        connection.close()
+    return counts
+
+
+def backup(database: str, destination: str) -> None:
+    """
+    Copies the database to destination with SQLite's online backup API, in a single step. This is safe while the bot
+    is running: in WAL mode the copy reads one consistent snapshot, and the bot keeps writing while it's made. (A
+    stepped backup would restart whenever the bot committed, so it would never finish on a live database.)
+
+    :param database: The SQLite database's path
+    :param destination: Where to write the copy. Overwritten if it exists.
+    :return: None
+    """
+    start = time.perf_counter()
+    source = connect(database)
+    target = sqlite3.connect(destination)
+    try:
+        source.backup(target)  # pages=-1: everything in one step.
+    finally:
+        target.close()
+        source.close()
+    size = os.path.getsize(destination) / 1024 / 1024
+    print(f"Backed up {database} to {destination} ({size:,.1f} MiB) in {time.perf_counter() - start:.2f}s.")
+
+
+def database_path() -> str:
+    """
+    The bot's database, as set in config.json.
+
+    :return: str
+    """
+    try:
+        with open("./config.json") as file:
+            return json.load(file).get("sql") or "./main.db"
+    except FileNotFoundError:
+        return "./main.db"
+
+
+def main(*, export_to: str = None, import_from: str = None, backup_to: str = None, fmt: str = "jsonl",
+         database: str = None):
+    database = database or database_path()
+    if import_from is None and not os.path.exists(database):
+        raise FileNotFoundError(f"No database at {database}.")
+    if backup_to:
+        backup(database, backup_to)
+    if export_to:
+        export(database, export_to, fmt)
+    if import_from:
+        import_(database, import_from, fmt)
@@ -1,26 +1,66 @@
 import sys
+import time
 from argparse import ArgumentParser
 
+STARTED = time.perf_counter()  # For --profile-startup, so imports are counted too.
+
 
 parser = ArgumentParser()
 parser.add_argument("--setup", "-S", action="store_true")
 parser.add_argument("--run", "-R", action="store", choices=["production", "beta", "development"], required=False,
                     default=None)
-args = parser.parse_args()
-
-if args.setup:
-    from cli.setup import main
-
-    try:
-        main()
-    except PermissionError:
-        print("[FATAL] Unable to write configuration file")
-        sys.exit(1)
-    except Exception as e:
-        print(f"[FATAL] {e}")
-        sys.exit(1)
-
-if args.run:
-    print("Starting bot...")
-    from chip.run import run_bot
-    run_bot(args.run)
+parser.add_argument("--sharded", action="store_true", help="Run every shard in this one process.")
+parser.add_argument("--cluster", action="store", type=int, default=None, metavar="N",
+                    help="Run N processes, each with a share of the shards.")
+parser.add_argument("--shards", action="store", type=int, default=None,
+                    help="With --cluster, the total number of shards. Defaults to Discord's recommendation.")
+parser.add_argument("--fake-gateway", action="store_true",
+                    help="With --cluster, connect to a local fake gateway instead of Discord (for testing).")
+parser.add_argument("--profile-startup", action="store_true",
+                    help="Print how long each phase of startup took, once the bot is ready.")
+parser.add_argument("--export", action="store", default=None, metavar="DIRECTORY",
+                    help="Export every table to DIRECTORY, one file per table.")
+parser.add_argument("--import", action="store", dest="import_", default=None, metavar="DIRECTORY",
+                    help="Import the tables exported to DIRECTORY, replacing rows with the same keys.")
+parser.add_argument("--backup", action="store", default=None, metavar="FILE",
+                    help="Copy the database to FILE. Safe while the bot is running.")
+parser.add_argument("--format", action="store", choices=["jsonl", "csv"], default="jsonl",
+                    help="With --export or --import, the files' format.")
+parser.add_argument("--database", action="store", default=None,
+                    help="With --export, --import or --backup, the database to use. Defaults to config.json's.")
+
+# Spawned processes (clusters, the CPU pool) import this module as __mp_main__, so nothing may run on import.
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.setup:
+        from cli.setup import main
+
+        try:
+            main()
+        except PermissionError:
+            print("[FATAL] Unable to write configuration file")
+            sys.exit(1)
+        except Exception as e:
+            print(f"[FATAL] {e}")
+            sys.exit(1)
+
+    if args.export or args.import_ or args.backup:
+        import sqlite3
+        from cli.transfer import main
+
+        try:
+            main(export_to=args.export, import_from=args.import_, backup_to=args.backup, fmt=args.format,
+                 database=args.database)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"[FATAL] {e}")
+            sys.exit(1)
+
+    if args.cluster:
+        print(f"Starting {args.cluster} clusters...")
+        from chip.run import run_clusters
+        run_clusters(args.run, args.cluster, shard_count=args.shards, fake_gateway=args.fake_gateway)
+    elif args.run:
+        print("Starting bot...")
+        from chip.run import run_bot
+        run_bot(args.run, sharded=args.sharded, profile_startup=args.profile_startup, started=STARTED)